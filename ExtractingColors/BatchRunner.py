@@ -0,0 +1,177 @@
+import argparse
+import logging
+import os
+from multiprocessing import Pool
+from ExtractColors import probe_video, stream_frames
+from FilmAggregates import FilmAggregator
+from FilmBarcode import BarcodeRenderer
+from FrameRegions import frame_region_palettes, parse_regions, region_names, region_palettes
+from FrameSampling import SAMPLING_MODES, RowWeights
+from PaletteEngines import get_engine
+from PipelineMetrics import configure_logging
+from ResultSinks import open_sink
+
+logger = logging.getLogger(__name__)
+
+VIDEO_EXTENSIONS = ('.mkv', '.mp4', '.avi', '.mov', '.m4v', '.webm')
+
+def find_videos(paths):
+    # Expands directories into the video files they contain (recursively), keeping the given order
+    videos = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in sorted(os.walk(path)):
+                videos += [os.path.join(root, f) for f in sorted(files) if f.lower().endswith(VIDEO_EXTENSIONS)]
+        else:
+            videos.append(path)
+    return videos
+
+def film_name(video_path):
+    return os.path.splitext(os.path.basename(video_path))[0]
+
+def plan_segments(video_path, fps=3, segment_seconds=300):
+    # Splits a film into segments of a whole number of sampled frames, so frame i of segment j
+    # has the global frame index j * segment_frames + i + 1 whichever worker decodes it
+    _, _, duration = probe_video(video_path)
+    if duration is None:
+        raise ValueError(f"Could not read the duration of {video_path}")
+    segment_frames = max(1, int(round(segment_seconds * fps)))
+    total_frames = int(duration * fps + 0.5)
+
+    segments = []
+    for segment_number, first in enumerate(range(0, total_frames, segment_frames)):
+        frame_count = min(segment_frames, total_frames - first)
+        segments.append({
+            'video_path': video_path,
+            'segment_number': segment_number,
+            'start_time': first / fps,
+            'duration': frame_count / fps,
+            'first_frame': first + 1,
+            'frame_count': frame_count,
+        })
+    return segments
+
+def process_segment(task):
+    # Runs in a pool worker: decodes one time range with its own ffmpeg and computes its palettes
+    segment, fps, engine, num_colors, batch_size, sampling, threshold, cache_file, scale_width, quality, regions = task
+    palette_engine = get_engine(engine, num_colors, quality, cache_file)
+    last_frame = segment['first_frame'] + segment['frame_count'] - 1
+    rows = []
+
+    for frame_indices, frames in stream_frames(segment['video_path'], fps, segment['start_time'], segment['duration'], batch_size, segment['first_frame'], sampling, threshold, scale_width):
+        palettes = palette_engine.palettes(frames)
+        batch_regions = frame_region_palettes(region_palettes(palette_engine, frames, regions), len(frames)) if regions else None
+        for i, (frame_index, colors) in enumerate(zip(frame_indices, palettes)):
+            # ffmpeg may round one extra frame into the end of a time range; it belongs to the next segment
+            if colors and frame_index <= last_frame:
+                row = (frame_index, f"frame_{frame_index:06d}", colors)
+                rows.append(row if batch_regions is None else row + (batch_regions[i],))
+
+    palette_engine.close()
+    return segment['video_path'], segment['segment_number'], rows
+
+def run_batch(videos, output_root, fps=3, segment_seconds=300, num_workers=1, engine='colorthief', num_colors=10, batch_size=10,
+              results_name="dominant_colors.csv", sampling='fps', threshold=None, cache_file=None, scale_width=None, quality=10, aggregate=False,
+              regions=None, render=False):
+    regions = parse_regions(regions)
+    # Each film's results go to <output_root>/<film name>/, so two films of the same name would share them
+    paths_by_name = {}
+    for video_path in videos:
+        paths_by_name.setdefault(film_name(video_path), []).append(video_path)
+    duplicates = {name: paths for name, paths in paths_by_name.items() if len(paths) > 1}
+    if duplicates:
+        raise ValueError("Films with the same name would share a results directory: " +
+                         "; ".join(f"{name}: {', '.join(paths)}" for name, paths in sorted(duplicates.items())))
+    segments = {}
+    for video_path in videos:
+        segments[video_path] = plan_segments(video_path, fps, segment_seconds)
+        logger.info(f"{film_name(video_path)}: {len(segments[video_path])} segments")
+
+    sinks = {}
+    weights = {video_path: RowWeights() for video_path in videos}
+    aggregators = {}
+    renderers = {}
+    for video_path in videos:
+        film_dir = os.path.join(output_root, film_name(video_path))
+        os.makedirs(film_dir, exist_ok=True)
+        sinks[video_path] = open_sink(os.path.join(film_dir, results_name), num_colors=num_colors, regions=region_names(regions))
+        if aggregate:
+            aggregators[video_path] = FilmAggregator(sinks[video_path].path, num_colors, fps)
+        if render:
+            total_frames = sum(segment['frame_count'] for segment in segments[video_path])
+            renderers[video_path] = BarcodeRenderer(sinks[video_path].path, num_colors, total_frames)
+
+    # Interleave the films so every film makes progress from the start
+    tasks = []
+    for segment_number in range(max(len(film_segments) for film_segments in segments.values())):
+        for video_path in videos:
+            if segment_number < len(segments[video_path]):
+                tasks.append((segments[video_path][segment_number], fps, engine, num_colors, batch_size, sampling, threshold, cache_file, scale_width, quality, regions))
+
+    # Segments finish out of order; each film's sink only receives them in global frame order
+    pending = {video_path: {} for video_path in videos}
+    next_segment = {video_path: 0 for video_path in videos}
+
+    def write(video_path, rows, row_weights):
+        sinks[video_path].write(rows, row_weights)
+        if aggregate:
+            aggregators[video_path].update(rows, row_weights)
+        if render:
+            renderers[video_path].update(rows)
+
+    finished = set()
+
+    try:
+        with Pool(num_workers) as pool:
+            for video_path, segment_number, rows in pool.imap_unordered(process_segment, tasks):
+                logger.info(f"Finished {film_name(video_path)} segment {segment_number + 1}/{len(segments[video_path])}")
+                pending[video_path][segment_number] = rows
+                while next_segment[video_path] in pending[video_path]:
+                    rows = pending[video_path].pop(next_segment[video_path])
+                    # A row is written once the next one shows how many frames it stands for
+                    write(video_path, *weights[video_path].add(rows))
+                    next_segment[video_path] += 1
+                if next_segment[video_path] == len(segments[video_path]):
+                    finished.add(video_path)
+                    last_segment = segments[video_path][-1]
+                    write(video_path, *weights[video_path].finish(last_segment['first_frame'] + last_segment['frame_count'] - 1))
+                    sinks[video_path].close()
+                    if aggregate:
+                        aggregators[video_path].close()
+                    if render:
+                        renderers[video_path].close()
+                    logger.info(f"Finished {film_name(video_path)}: {sinks[video_path].path}")
+    finally:
+        # After a failed segment, the films still open keep the rows written so far; the last one
+        # without the frames after it, which were never seen
+        for video_path in videos:
+            if video_path not in finished:
+                sinks[video_path].write(*weights[video_path].finish())
+                sinks[video_path].close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract the dominant colors of several films, split into time-range segments across a process pool.")
+    parser.add_argument('videos', nargs='+', help="Video files, or directories to search for video files")
+    parser.add_argument('--output-root', default='.', help="Results are written to <output-root>/<film name>/")
+    parser.add_argument('--fps', type=float, default=3, help="Frames sampled per second of film")
+    parser.add_argument('--segment-seconds', type=float, default=300, help="Length of the time range decoded by each task")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Number of concurrent segment workers (default: number of cores)")
+    parser.add_argument('--engine', default='colorthief', help="Palette engine: colorthief, numpy or kmeans")
+    parser.add_argument('--results-name', default='dominant_colors.csv', help="Per-film results file name; the extension picks the format")
+    parser.add_argument('--sampling', choices=SAMPLING_MODES, default='fps', help="Which frames get a palette: every fps frame, scene changes, keyframes or histogram changes")
+    parser.add_argument('--threshold', type=float, default=None, help="Change threshold for the scene and histogram sampling modes")
+    parser.add_argument('--cache', default=None, help="SQLite palette cache file, reused across runs (default: no cache)")
+    parser.add_argument('--scale-width', type=int, default=None, help="Downscale frames to this width inside ffmpeg, e.g. 160 (default: full resolution)")
+    parser.add_argument('--quality', type=int, default=10, help="Pixel stride of the palette engine; 1 uses every pixel")
+    parser.add_argument('--verbose', action='store_true', help="Log every batch (debug level)")
+    parser.add_argument('--aggregate', action='store_true', help="Also write a summary palette and per-minute/per-scene rollups for each film")
+    parser.add_argument('--render', action='store_true', help="Also draw the film barcode and palette timeline of each film")
+    parser.add_argument('--regions', default=None, help="Also write palettes of frame regions, e.g. center,halves,sides,grid:3x3")
+    args = parser.parse_args()
+    configure_logging(logging.DEBUG if args.verbose else logging.INFO)
+
+    run_batch(find_videos(args.videos), args.output_root, fps=args.fps, segment_seconds=args.segment_seconds,
+              num_workers=max(1, args.workers), engine=args.engine, results_name=args.results_name,
+              sampling=args.sampling, threshold=args.threshold, cache_file=args.cache,
+              scale_width=args.scale_width, quality=max(1, args.quality), aggregate=args.aggregate,
+              regions=args.regions, render=args.render)
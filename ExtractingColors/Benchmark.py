@@ -0,0 +1,267 @@
+import argparse
+import json
+import os
+import platform
+import queue
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing import Process, Queue
+import numpy as np
+from ExtractColors import run_extraction, stream_frames
+from FrameRing import FrameRing
+from PaletteEngines import ENGINES, get_engine
+from ResultSinks import SINKS, open_sink
+
+# Reproducible throughput benchmark for the frame -> palette pipeline. Test videos are generated
+# locally from ffmpeg's lavfi sources, each stage is timed on its own (decode, queue transfer,
+# palette, sink) and the whole pipeline end to end, and everything is written to JSON so runs
+# can be compared with --compare.
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+def peak_rss_mb(who='self'):
+    # Peak resident set size in MB; ru_maxrss is in KB on Linux but bytes on macOS
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN).ru_maxrss
+    return usage / (1024 * 1024) if sys.platform == 'darwin' else usage / 1024
+
+def generate_test_video(path, source='testsrc', duration=60, size='1280x720', rate=24):
+    # testsrc is mostly static, mandelbrot changes every frame; both are deterministic
+    if not os.path.exists(path):
+        subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-f', 'lavfi',
+                        '-i', f'{source}=size={size}:rate={rate}', '-t', str(duration),
+                        '-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p', '-y', path], check=True)
+    return path
+
+def timed(function, *args, **kwargs):
+    started = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+def rate(frames, seconds):
+    return frames / seconds if seconds > 0 else None
+
+def bench_decode(video_path, fps, scale_width, batch_size=10, keep_frames=100):
+    # Decodes the whole video but keeps only the first keep_frames frames for the later stages
+    latencies = []
+    frames = []
+    count = 0
+    started = time.perf_counter()
+    batch_started = started
+    for _, batch in stream_frames(video_path, fps, batch_size=batch_size, scale_width=scale_width):
+        now = time.perf_counter()
+        latencies.append(now - batch_started)
+        batch_started = now
+        if count < keep_frames:
+            frames.append(batch[:keep_frames - count])
+        count += len(batch)
+    seconds = time.perf_counter() - started
+    frames = np.concatenate(frames)
+    return frames, {
+        'stage': 'decode', 'scale_width': scale_width, 'frames': count, 'seconds': seconds,
+        'frames_per_second': rate(count, seconds), 'batch_latency_ms': latency_summary(latencies),
+    }
+
+def drain_queue(frame_queue, done_queue, ring=None):
+    count = 0
+    while True:
+        item = frame_queue.get()
+        if item is None:
+            break
+        count += len(item[1][0])
+        if ring:
+            ring.release(item[1][1].slot)
+    if ring:
+        ring.close()
+    done_queue.put(count)
+
+def bench_queue(frames, batch_size=10, transport='pickle', slots=4):
+    # Producer -> consumer transfer of frame batches, no palette work: either the arrays are
+    # pickled through a multiprocessing Queue, or copied into a FrameRing slot and only the slot is queued
+    ring = FrameRing(slots, batch_size, *frames.shape[1:3]) if transport == 'ring' else None
+    frame_queue, done_queue = Queue(maxsize=slots), Queue()
+    consumer = Process(target=drain_queue, args=(frame_queue, done_queue, ring))
+    consumer.start()
+    started = time.perf_counter()
+    for batch_number, first in enumerate(range(0, len(frames), batch_size)):
+        batch = frames[first:first + batch_size]
+        frame_indices = list(range(first + 1, first + len(batch) + 1))
+        if ring:
+            ring.acquire()[:len(batch)] = batch
+            batch = ring.handoff(len(batch))
+        frame_queue.put((batch_number, (frame_indices, batch)))
+    frame_queue.put(None)
+    count = done_queue.get()
+    seconds = time.perf_counter() - started
+    consumer.join()
+    if ring:
+        ring.close(unlink=True)
+    return {
+        'stage': 'queue', 'transport': transport, 'frame_shape': list(frames.shape[1:]), 'frames': count, 'seconds': seconds,
+        'frames_per_second': rate(count, seconds), 'megabytes_per_second': rate(frames[:count].nbytes / 1e6, seconds),
+    }
+
+def bench_palette(frames, engine, batch_size=10, num_colors=10, quality=10):
+    palette_engine = get_engine(engine, num_colors, quality)
+    latencies = []
+    palettes = []
+    for first in range(0, len(frames), batch_size):
+        batch_palettes, seconds = timed(palette_engine.palettes, frames[first:first + batch_size])
+        latencies.append(seconds)
+        palettes += batch_palettes
+    seconds = sum(latencies)
+    return palettes, {
+        'stage': 'palette', 'engine': engine, 'frame_shape': list(frames.shape[1:]), 'frames': len(frames), 'seconds': seconds,
+        'frames_per_second': rate(len(frames), seconds), 'batch_latency_ms': latency_summary(latencies),
+    }
+
+def bench_sink(palettes, extension, directory, num_colors=10):
+    rows = [(i + 1, f"frame_{i + 1:06d}", palette) for i, palette in enumerate(palettes) if palette]
+    path = os.path.join(directory, f"sink_benchmark{extension}")
+    started = time.perf_counter()
+    sink = open_sink(path, num_colors=num_colors)
+    for first in range(0, len(rows), 10):
+        sink.write(rows[first:first + 10])
+    sink.close()
+    seconds = time.perf_counter() - started
+    return {'stage': 'sink', 'format': extension, 'frames': len(rows), 'seconds': seconds, 'frames_per_second': rate(len(rows), seconds)}
+
+def end_to_end_worker(settings, result_queue):
+    # Runs in its own process so peak RSS covers exactly one pipeline run (and its workers)
+    started = time.perf_counter()
+    try:
+        run_extraction(**settings)
+    except Exception as e:
+        result_queue.put({'error': f"{type(e).__name__}: {e}"})
+        raise
+    seconds = time.perf_counter() - started
+    result_queue.put({'seconds': seconds, 'main': peak_rss_mb('self'), 'largest_child': peak_rss_mb('children')})
+
+def wait_for_result(runner, result_queue):
+    # The runner's result, or an error if it died without one (e.g. killed, or out of memory)
+    while True:
+        try:
+            return result_queue.get(timeout=1)
+        except queue.Empty:
+            if runner.exitcode is not None:
+                break
+    try:
+        return result_queue.get(timeout=1)  # Put just before it exited
+    except queue.Empty:
+        return {'error': f"end-to-end runner exited with code {runner.exitcode}"}
+
+def bench_end_to_end(video_path, directory, fps, engine, num_workers, scale_width, batch_size=10):
+    results_file = os.path.join(directory, f"e2e_{engine}_{num_workers}_{scale_width or 'full'}.npy")
+    settings = dict(video_path=video_path, output_dir=os.path.join(directory, 'frames'), results_file=results_file,
+                    fps=fps, batch_size=batch_size, num_workers=num_workers, engine=engine, stream=True,
+                    checkpoint_file=os.path.join(directory, 'checkpoint.json'), scale_width=scale_width)
+    result_queue = Queue()
+    runner = Process(target=end_to_end_worker, args=(settings, result_queue))
+    runner.start()
+    outcome = wait_for_result(runner, result_queue)
+    runner.join()
+    case = {'stage': 'end_to_end', 'engine': engine, 'workers': num_workers, 'scale_width': scale_width}
+    if 'error' in outcome:
+        print(f"End-to-end case {engine}, {num_workers} workers, scale {scale_width or 'full'} failed: {outcome['error']}")
+        return dict(case, error=outcome['error'])
+    frames = len(np.load(results_file, mmap_mode='r'))
+    seconds = outcome['seconds']
+    return dict(case, frames=frames, seconds=seconds, frames_per_second=rate(frames, seconds),
+                peak_rss_mb={'main': outcome['main'], 'largest_child': outcome['largest_child']})
+
+def latency_summary(latencies):
+    if not latencies:
+        return None
+    milliseconds = 1000 * np.asarray(latencies)
+    return {'p50': float(np.percentile(milliseconds, 50)), 'p90': float(np.percentile(milliseconds, 90)),
+            'p99': float(np.percentile(milliseconds, 99)), 'max': float(milliseconds.max())}
+
+def environment():
+    ffmpeg_version = subprocess.run(['ffmpeg', '-version'], stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout.decode(errors='replace').split('\n')[0]
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.decode().strip() or None
+    except OSError:
+        commit = None
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+            'numpy': np.__version__, 'ffmpeg': ffmpeg_version, 'commit': commit, 'time': time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+def case_key(result):
+    return tuple((key, str(result.get(key))) for key in ('stage', 'video', 'engine', 'workers', 'scale_width', 'format', 'transport', 'frame_shape'))
+
+def compare_results(previous, current):
+    # Prints the frames/sec change of every case that appears in both runs
+    previous_cases = {case_key(result): result for result in previous['results']}
+    for result in current['results']:
+        before = previous_cases.get(case_key(result))
+        if before and before.get('frames_per_second') and result.get('frames_per_second'):
+            change = 100 * (result['frames_per_second'] / before['frames_per_second'] - 1)
+            label = ", ".join(f"{key}={value}" for key, value in case_key(result) if value != 'None')
+            print(f"{label}: {before['frames_per_second']:.1f} -> {result['frames_per_second']:.1f} frames/s ({change:+.1f}%)")
+
+def run_benchmarks(video_dir, sources, duration, size, fps, engines, worker_counts, scale_widths, skip_end_to_end=False):
+    results = []
+    with tempfile.TemporaryDirectory() as root:
+        for source in sources:
+            video_path = generate_test_video(os.path.join(video_dir, f"bench_{source}_{size}_{duration}s.mkv"), source, duration, size)
+            video = os.path.basename(video_path)
+            # Result files of one source only: the sinks resume from a file that already exists,
+            # so a shared name would append this source's rows to the last one's
+            directory = os.path.join(root, source)
+            os.makedirs(directory)
+
+            for scale_width in scale_widths:
+                frames, result = bench_decode(video_path, fps, scale_width)
+                results.append(dict(result, video=video))
+                for transport in ('pickle', 'ring'):
+                    results.append(dict(bench_queue(frames, transport=transport), video=video))
+                for engine in engines:
+                    palettes, result = bench_palette(frames, engine)
+                    results.append(dict(result, video=video, scale_width=scale_width))
+                    if engine == engines[0] and scale_width == scale_widths[0]:
+                        for extension in SINKS:
+                            try:
+                                results.append(dict(bench_sink(palettes, extension, directory), video=video))
+                            except ImportError as e:
+                                print(f"Skipping {extension} sink: {e}")
+
+            if not skip_end_to_end:
+                for engine in engines:
+                    for num_workers in worker_counts:
+                        for scale_width in scale_widths:
+                            results.append(dict(bench_end_to_end(video_path, directory, fps, engine, num_workers, scale_width), video=video))
+
+    for result in results:
+        print(json.dumps(result))
+    return {'environment': environment(), 'results': results}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the frame -> palette pipeline on generated test videos.")
+    parser.add_argument('--output', default='benchmark.json', help="JSON file for the results")
+    parser.add_argument('--compare', default=None, help="Earlier results JSON to compare frames/sec against")
+    parser.add_argument('--video-dir', default=tempfile.gettempdir(), help="Where generated test videos are kept between runs")
+    parser.add_argument('--sources', nargs='+', default=['testsrc', 'mandelbrot'], help="ffmpeg lavfi sources to generate test videos from")
+    parser.add_argument('--duration', type=int, default=60, help="Length of each test video in seconds")
+    parser.add_argument('--size', default='1280x720', help="Resolution of the test videos")
+    parser.add_argument('--fps', type=float, default=3, help="Frames sampled per second of video")
+    parser.add_argument('--engines', nargs='+', default=sorted(ENGINES), help="Palette engines to benchmark")
+    parser.add_argument('--workers', type=int, nargs='+', default=sorted({1, os.cpu_count() or 1}), help="Worker counts for the end-to-end runs")
+    parser.add_argument('--scale-widths', type=int, nargs='+', default=[0, 160], help="Decode widths; 0 means full resolution")
+    parser.add_argument('--skip-end-to-end', action='store_true', help="Only run the isolated stage benchmarks")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.video_dir, args.sources, args.duration, args.size, args.fps, args.engines, args.workers,
+                            [width or None for width in args.scale_widths], args.skip_end_to_end)
+    with open(args.output, "w") as json_file:
+        json.dump(report, json_file, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as json_file:
+            compare_results(json.load(json_file), report)
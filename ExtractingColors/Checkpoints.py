@@ -0,0 +1,62 @@
+import json
+import os
+import time
+
+def parse_timestamp(timestamp):
+    # 'HH:MM:SS(.ms)', 'MM:SS' or plain seconds -> seconds
+    if timestamp is None or timestamp == '':
+        return 0.0
+    if isinstance(timestamp, (int, float)):
+        return float(timestamp)
+    seconds = 0.0
+    for part in str(timestamp).split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+def format_timestamp(seconds):
+    hours, remainder = divmod(seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return f"{int(hours):02d}:{int(minutes):02d}:{seconds:06.3f}"
+
+class CheckpointManifest:
+    # JSON manifest with one entry per video: the last frame index durably written to the
+    # result sink and its timestamp. Frame i (1-based) of a run sampled at `fps` from
+    # `start_time` sits at start_time + (i - 1) / fps, which is where a restart seeks to.
+    def __init__(self, path="checkpoint.json"):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as manifest_file:
+                self.entries = json.load(manifest_file)
+
+    def key(self, video_path):
+        return os.path.abspath(video_path)
+
+    def get(self, video_path):
+        return self.entries.get(self.key(video_path))
+
+    def record(self, video_path, last_frame, fps, start_time, results_file):
+        start_seconds = parse_timestamp(start_time)
+        self.entries[self.key(video_path)] = {
+            "last_frame": int(last_frame),
+            "last_timestamp": format_timestamp(start_seconds + (last_frame - 1) / fps),
+            "fps": fps,
+            "start_time": format_timestamp(start_seconds),
+            "results_file": results_file,
+            "updated": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        # Write to a temporary file and rename, so a crash never leaves a half-written manifest
+        with open(self.path + ".tmp", "w") as manifest_file:
+            json.dump(self.entries, manifest_file, indent=2)
+        os.replace(self.path + ".tmp", self.path)
+
+    def resume_point(self, video_path, fps, start_time=None):
+        # Returns (seek timestamp, first frame index) for the next run of this video
+        entry = self.get(video_path)
+        if entry is None:
+            return (format_timestamp(parse_timestamp(start_time)), 1)
+        if entry["fps"] != fps:
+            raise ValueError(f"Checkpoint for {video_path} was recorded at fps={entry['fps']}, not fps={fps}")
+        start_seconds = parse_timestamp(entry["start_time"])
+        next_frame = entry["last_frame"] + 1
+        return (format_timestamp(start_seconds + (next_frame - 1) / fps), next_frame)
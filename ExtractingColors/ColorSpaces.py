@@ -0,0 +1,165 @@
+import math
+import numpy as np
+
+# Vectorized color-space conversions and color differences for palette arrays of any shape
+# (..., 3), e.g. the (N, K, 3) uint8 palettes from load_palettes. RGB is 8-bit sRGB, HSV has
+# hue in degrees and saturation/value in 0..1, Lab is CIELAB under the D65 white point.
+
+RGB_TO_XYZ = np.array([
+    [0.4124564, 0.3575761, 0.1804375],
+    [0.2126729, 0.7151522, 0.0721750],
+    [0.0193339, 0.1191920, 0.9503041],
+])
+XYZ_TO_RGB = np.linalg.inv(RGB_TO_XYZ)
+D65_WHITE = np.array([0.95047, 1.0, 1.08883])
+COLOR_SPACES = ('rgb', 'hsv', 'lab')
+METRICS = ('cie76', 'ciede2000')
+
+def srgb_to_linear(rgb):
+    # 0..255 sRGB -> 0..1 linear light
+    rgb = np.asarray(rgb, dtype=np.float64) / 255.0
+    return np.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+
+def linear_to_srgb(linear):
+    # 0..1 linear light -> 0..255 sRGB, rounded and clipped to uint8
+    linear = np.clip(linear, 0, 1)
+    rgb = np.where(linear <= 0.0031308, 12.92 * linear, 1.055 * linear ** (1 / 2.4) - 0.055)
+    return np.clip(np.rint(rgb * 255), 0, 255).astype(np.uint8)
+
+def rgb_to_lab(rgb):
+    xyz = srgb_to_linear(rgb) @ RGB_TO_XYZ.T / D65_WHITE
+    epsilon, kappa = 216 / 24389, 24389 / 27
+    f = np.where(xyz > epsilon, np.cbrt(xyz), (kappa * xyz + 16) / 116)
+    return np.stack([116 * f[..., 1] - 16, 500 * (f[..., 0] - f[..., 1]), 200 * (f[..., 1] - f[..., 2])], axis=-1)
+
+def lab_to_rgb(lab):
+    lab = np.asarray(lab, dtype=np.float64)
+    fy = (lab[..., 0] + 16) / 116
+    f = np.stack([fy + lab[..., 1] / 500, fy, fy - lab[..., 2] / 200], axis=-1)
+    epsilon, kappa = 216 / 24389, 24389 / 27
+    xyz = np.where(f ** 3 > epsilon, f ** 3, (116 * f - 16) / kappa) * D65_WHITE
+    return linear_to_srgb(xyz @ XYZ_TO_RGB.T)
+
+def rgb_to_hsv(rgb):
+    rgb = np.asarray(rgb, dtype=np.float64) / 255.0
+    value = rgb.max(axis=-1)
+    chroma = value - rgb.min(axis=-1)
+    safe_chroma = np.where(chroma == 0, 1, chroma)
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    hue = np.select([value == r, value == g], [((g - b) / safe_chroma) % 6, (b - r) / safe_chroma + 2], (r - g) / safe_chroma + 4)
+    hue = np.where(chroma == 0, 0, 60 * hue)
+    saturation = np.where(value == 0, 0, chroma / np.where(value == 0, 1, value))
+    return np.stack([hue, saturation, value], axis=-1)
+
+def hsv_to_rgb(hsv):
+    hsv = np.asarray(hsv, dtype=np.float64)
+    hue, saturation, value = hsv[..., 0] % 360 / 60, hsv[..., 1], hsv[..., 2]
+    chroma = value * saturation
+    x = chroma * (1 - np.abs(hue % 2 - 1))
+    zero = np.zeros_like(chroma)
+    sector = np.floor(hue).astype(int)[..., None]
+    rgb = np.select([sector == i for i in range(6)], [
+        np.stack(channels, axis=-1) for channels in
+        ((chroma, x, zero), (x, chroma, zero), (zero, chroma, x), (zero, x, chroma), (x, zero, chroma), (chroma, zero, x))
+    ])
+    return np.clip(np.rint((rgb + (value - chroma)[..., None]) * 255), 0, 255).astype(np.uint8)
+
+def convert(colors, source='rgb', target='lab'):
+    # Any of COLOR_SPACES to any other, going through RGB
+    if source not in COLOR_SPACES or target not in COLOR_SPACES:
+        raise ValueError(f"Unknown color space, expected one of {COLOR_SPACES}")
+    if source == target:
+        return np.asarray(colors)
+    rgb = {'rgb': lambda c: np.asarray(c), 'hsv': hsv_to_rgb, 'lab': lab_to_rgb}[source](colors)
+    return {'rgb': lambda c: np.asarray(c, dtype=np.uint8), 'hsv': rgb_to_hsv, 'lab': rgb_to_lab}[target](rgb)
+
+def delta_e_cie76(lab1, lab2):
+    # Euclidean distance in Lab; about 2.3 is a just noticeable difference
+    return np.linalg.norm(np.asarray(lab1, dtype=np.float64) - np.asarray(lab2, dtype=np.float64), axis=-1)
+
+def delta_e_ciede2000(lab1, lab2):
+    # CIEDE2000 (Sharma, Wu and Dalal 2005) with kL = kC = kH = 1; inputs broadcast against each other
+    lab1, lab2 = np.asarray(lab1, dtype=np.float64), np.asarray(lab2, dtype=np.float64)
+    l1, a1, b1 = lab1[..., 0], lab1[..., 1], lab1[..., 2]
+    l2, a2, b2 = lab2[..., 0], lab2[..., 1], lab2[..., 2]
+
+    mean_c = (np.hypot(a1, b1) + np.hypot(a2, b2)) / 2
+    g = 0.5 * (1 - np.sqrt(mean_c ** 7 / (mean_c ** 7 + 25 ** 7)))
+    a1, a2 = a1 * (1 + g), a2 * (1 + g)
+    c1, c2 = np.hypot(a1, b1), np.hypot(a2, b2)
+    h1 = np.degrees(np.arctan2(b1, a1)) % 360
+    h2 = np.degrees(np.arctan2(b2, a2)) % 360
+
+    delta_l = l2 - l1
+    delta_c = c2 - c1
+    chroma_product = c1 * c2
+    delta_h = h2 - h1
+    delta_h = np.where(delta_h > 180, delta_h - 360, np.where(delta_h < -180, delta_h + 360, delta_h))
+    delta_h = np.where(chroma_product == 0, 0, delta_h)
+    delta_big_h = 2 * np.sqrt(chroma_product) * np.sin(np.radians(delta_h) / 2)
+
+    mean_l = (l1 + l2) / 2
+    mean_c = (c1 + c2) / 2
+    hue_sum = h1 + h2
+    mean_h = np.where(np.abs(h1 - h2) > 180, np.where(hue_sum < 360, hue_sum + 360, hue_sum - 360), hue_sum) / 2
+    mean_h = np.where(chroma_product == 0, hue_sum, mean_h)
+
+    t = (1 - 0.17 * np.cos(np.radians(mean_h - 30)) + 0.24 * np.cos(np.radians(2 * mean_h))
+         + 0.32 * np.cos(np.radians(3 * mean_h + 6)) - 0.20 * np.cos(np.radians(4 * mean_h - 63)))
+    s_l = 1 + 0.015 * (mean_l - 50) ** 2 / np.sqrt(20 + (mean_l - 50) ** 2)
+    s_c = 1 + 0.045 * mean_c
+    s_h = 1 + 0.015 * mean_c * t
+    rotation = -2 * np.sqrt(mean_c ** 7 / (mean_c ** 7 + 25 ** 7)) * np.sin(np.radians(60 * np.exp(-((mean_h - 275) / 25) ** 2)))
+    return np.sqrt((delta_l / s_l) ** 2 + (delta_c / s_c) ** 2 + (delta_big_h / s_h) ** 2
+                   + rotation * (delta_c / s_c) * (delta_big_h / s_h))
+
+def delta_e(lab1, lab2, metric='cie76'):
+    if metric not in METRICS:
+        raise ValueError(f"Unknown color difference '{metric}', expected one of {METRICS}")
+    return delta_e_cie76(lab1, lab2) if metric == 'cie76' else delta_e_ciede2000(lab1, lab2)
+
+def pairwise_delta_e(lab1, lab2, metric='cie76'):
+    # (..., K, 3) and (..., L, 3) -> (..., K, L) differences between every color of each pair of palettes
+    return delta_e(np.asarray(lab1)[..., :, None, :], np.asarray(lab2)[..., None, :, :], metric)
+
+def palette_set_distance(lab1, lab2, metric='cie76', method='nearest'):
+    # Distance between palettes (..., K, 3) and (..., L, 3) in Lab, broadcast over the leading axes:
+    #   nearest:   mean over the colors of lab1 of the difference to the closest color of lab2
+    #              (directed, so an outfit matches a frame that contains its colors plus others)
+    #   symmetric: the mean of nearest in both directions
+    #   emd:       earth mover's distance with every color carrying equal weight, i.e. the mean
+    #              difference of the optimal one-to-one matching (needs scipy, K and L may differ)
+    differences = pairwise_delta_e(lab1, lab2, metric)
+    if method == 'nearest':
+        return differences.min(axis=-1).mean(axis=-1)
+    if method == 'symmetric':
+        return (differences.min(axis=-1).mean(axis=-1) + differences.min(axis=-2).mean(axis=-1)) / 2
+    if method == 'emd':
+        return earth_movers_distance(differences)
+    raise ValueError(f"Unknown palette distance '{method}', expected nearest, symmetric or emd")
+
+def earth_movers_distance(differences):
+    # Equal-weight EMD from (..., K, L) cost matrices: each color is split into L (or K) / gcd
+    # parts, so the transport problem becomes a square assignment solved exactly per pair
+    from scipy.optimize import linear_sum_assignment
+
+    differences = np.asarray(differences, dtype=np.float64)
+    k, l = differences.shape[-2:]
+    size = k * l // math.gcd(k, l)
+    costs = np.repeat(np.repeat(differences, size // k, axis=-2), size // l, axis=-1).reshape(-1, size, size)
+    distances = np.empty(len(costs))
+    for i, cost in enumerate(costs):
+        rows, columns = linear_sum_assignment(cost)
+        distances[i] = cost[rows, columns].mean()
+    return distances.reshape(differences.shape[:-2])
+
+def palette_distance_matrix(palettes1, palettes2, metric='cie76', method='nearest', chunk_size=1024):
+    # (N, K, 3) and (M, L, 3) uint8 RGB palettes -> (N, M) palette distances, computed in chunks
+    # of rows so the (chunk, M, K, L) difference array stays small
+    lab1 = rgb_to_lab(palettes1)
+    lab2 = rgb_to_lab(palettes2)
+    distances = np.empty((len(lab1), len(lab2)))
+    for first in range(0, len(lab1), chunk_size):
+        chunk = lab1[first:first + chunk_size]
+        distances[first:first + len(chunk)] = palette_set_distance(chunk[:, None], lab2[None], metric, method)
+    return distances
@@ -1,119 +1,233 @@
+import argparse
+import logging
 import os
+import re
 import subprocess
-from multiprocessing import Process, Queue
-from colorthief import ColorThief
-import csv
 import time
-
-def extract_dominant_colors(image_path, num_colors=10):
-    try:
-        color_thief = ColorThief(image_path)
-        palette = color_thief.get_palette(color_count=num_colors)
-        return palette  # Return the palette directly as RGB tuples
-    except Exception as e:
-        print(f"Error extracting colors from {image_path}: {e}")
-        return []
-
-def process_frames(frame_queue, num_colors=10):
-    csv_file = "dominant_colors.csv"
-    if not os.path.exists(csv_file):
-        with open(csv_file, "w") as csvfile:
-            writer = csv.writer(csvfile)
-            header = ["frame_path"]
-            for i in range(num_colors):
-                header += [f"color_{i+1}_r", f"color_{i+1}_g", f"color_{i+1}_b"]
-            writer.writerow(header)
-            print(f"CSV header written: {header}")
-
-    while True:
-        print("Waiting for frames to process...")
-        frames = frame_queue.get()
-        if frames is None:
-            print("Received termination signal. Exiting process_frames.")
-            break
-        print(f"Processing batch of {len(frames)} frames...")
-        for local_frame_path in frames:
+import numpy as np
+from FrameRing import RingBatch
+from FrameRegions import frame_region_palettes, region_palettes
+from FrameSampling import SAMPLING_MODES, DEFAULT_THRESHOLDS, HistogramSampler, TimestampReader, sampling_args, uses_timestamps
+from PipelineMetrics import configure_logging
+
+logger = logging.getLogger(__name__)
+
+def probe_video(video_path):
+    # ffmpeg prints the stream info on stderr when no output is given
+    result = subprocess.run(['ffmpeg', '-hide_banner', '-i', video_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    info = result.stderr.decode(errors='replace')
+
+    size = re.search(r'Stream #.*Video:.*?(\d{2,5})x(\d{2,5})', info)
+    if not size:
+        raise ValueError(f"Could not find a video stream in {video_path}")
+    width, height = int(size.group(1)), int(size.group(2))
+
+    duration = None
+    match = re.search(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)', info)
+    if match:
+        hours, minutes, seconds = match.groups()
+        duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+    return width, height, duration
+
+def batch_rows(palette_engine, frame_indices, frames, ring=None, metrics=None, regions=(), delete_frames=True):
+    # Result rows of one queued batch: a RingBatch in a shared-memory slot, a uint8 array of
+    # shape (n, height, width, 3), or a list of PNG paths (deleted once they have a palette)
+    batch_regions = None
+    started = time.perf_counter()
+    if isinstance(frames, RingBatch):
+        # Streamed batch in a shared-memory slot, handed back to the decoder as soon as it is read
+        frame_names = [f"frame_{frame_index:06d}" for frame_index in frame_indices]
+        frame_paths = []
+        try:
+            batch = ring.batch(frames)
+            palettes = palette_engine.palettes(batch)
+            if regions:
+                batch_regions = frame_region_palettes(region_palettes(palette_engine, batch, regions), len(frame_names))
+        finally:
+            ring.release(frames.slot)
+    elif isinstance(frames, np.ndarray):
+        # Streamed batch: uint8 array of shape (n, height, width, 3)
+        frame_names = [f"frame_{frame_index:06d}" for frame_index in frame_indices]
+        frame_paths = []
+        palettes = palette_engine.palettes(frames)
+        if regions:
+            batch_regions = frame_region_palettes(region_palettes(palette_engine, frames, regions), len(frame_names))
+    else:
+        # PNG batch: list of frame paths
+        frame_names = frame_paths = frames
+        palettes = palette_engine.palettes_from_paths(frame_paths)
+    if metrics:
+        metrics.observe('palette', time.perf_counter() - started, len(frame_names))
+
+    rows = []
+    for i, (frame_index, frame_name, colors) in enumerate(zip(frame_indices, frame_names, palettes)):
+        if colors:
+            rows.append((frame_index, frame_name, colors) if batch_regions is None else (frame_index, frame_name, colors, batch_regions[i]))
+
+    for local_frame_path, colors in zip(frame_paths if delete_frames else [], palettes):
+        if colors:
             try:
-                colors = extract_dominant_colors(local_frame_path, num_colors)
-                if colors:
-                    with open(csv_file, "a") as csvfile:
-                        writer = csv.writer(csvfile)
-                        row = [local_frame_path]
-                        for r, g, b in colors:
-                            row += [r, g, b]
-                        writer.writerow(row)
-                        print(f"Written to CSV: {row}")
-                    os.remove(local_frame_path)  # Remove the file after processing
-                    print(f"Processed and deleted {local_frame_path}")
+                os.remove(local_frame_path)  # Remove the file after processing
+                logger.debug(f"Processed and deleted {local_frame_path}")
             except Exception as e:
-                print(f"Failed to process {local_frame_path}: {e}")
-
-def extract_and_queue_frames(video_path, output_dir, frame_queue, fps=3, start_time=None, batch_size=10):
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-        print(f"Created output directory: {output_dir}")
-
-    command = ['ffmpeg']
+                logger.warning(f"Failed to delete {local_frame_path}: {e}")
+    return rows
+
+def read_frame(stream, buffer):
+    # Fill buffer completely from the pipe; returns False on a short read (end of video)
+    view = memoryview(buffer).cast('B')
+    filled = 0
+    while filled < len(view):
+        count = stream.readinto(view[filled:])
+        if not count:
+            return False
+        filled += count
+    return True
+
+def scaled_size(width, height, scale_width=None):
+    # Output size for a decode-time downscale to scale_width, keeping the aspect ratio (even height)
+    if not scale_width or scale_width >= width:
+        return width, height
+    return scale_width, max(2, int(round(height * scale_width / width / 2)) * 2)
+
+def stream_frames(video_path, fps=3, start_time=None, duration=None, batch_size=10, first_frame=1, sampling='fps', threshold=None, scale_width=None, allocate=None):
+    # Generator over (frame indices, uint8 array of shape (n, height, width, 3)) batches,
+    # decoded by ffmpeg straight to rgb24 on its stdout. Frame indices are positions on the
+    # fps grid, so frames dropped by the sampling mode leave gaps (see FrameSampling.py).
+    # scale_width downscales inside ffmpeg, so a 160px-wide frame is all that is ever copied.
+    # allocate(shape) returns the buffer the next batch is read into (default: a fresh array);
+    # a buffer is only replaced after its batch was yielded, e.g. FrameRing.acquire.
+    source_width, source_height, _ = probe_video(video_path)
+    width, height = scaled_size(source_width, source_height, scale_width)
+    scale = f"scale={width}:{height}:flags=area" if (width, height) != (source_width, source_height) else None
+    input_args, video_filter = sampling_args(sampling, fps, threshold, scale)
+    timestamped = uses_timestamps(sampling)
+
+    # showinfo logs at info level; its lines are parsed off stderr for the frame timestamps
+    command = ['ffmpeg', '-hide_banner', '-loglevel', 'info' if timestamped else 'error'] + input_args
     if start_time:
-        command += ['-ss', start_time]
+        command += ['-ss', str(start_time)]
+    if duration:
+        command += ['-t', str(duration)]
+    command += ['-i', video_path, '-vf', video_filter]
+    if timestamped:
+        command += ['-fps_mode', 'passthrough']
     command += [
-        '-i', video_path,
-        '-vf', f'fps={fps}',
-        os.path.join(output_dir, 'output_%04d.png')
+        '-f', 'rawvideo',
+        '-pix_fmt', 'rgb24',
+        'pipe:1'
     ]
 
     process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    print("FFmpeg command started...")
+    logger.info(f"FFmpeg streaming started ({width}x{height} rgb24 from {source_width}x{source_height}, {sampling} sampling)...")
+    timestamps = TimestampReader(process.stderr) if timestamped else None
+    sampler = HistogramSampler(DEFAULT_THRESHOLDS['histogram'] if threshold is None else threshold) if sampling == 'histogram' else None
 
-    batch = []
+    frame_index = first_frame - 1
+    if allocate is None:
+        # A fresh fixed-size buffer per batch, since Queue.put pickles it in the background
+        allocate = lambda shape: np.empty(shape, dtype=np.uint8)
 
     try:
-        while True:
-            output = process.stderr.readline()
-            if process.poll() is not None:
-                break
-            if output:
-                print(output.decode().strip())
-
-            frame_files = [f for f in os.listdir(output_dir) if f.startswith('output_') and f.endswith('.png')]
-            frame_files.sort()
-            for frame_file in frame_files:
-                local_frame_path = os.path.join(output_dir, frame_file)
-                batch.append(local_frame_path)
-                if len(batch) >= batch_size:
-                    frame_queue.put(batch)
-                    print(f"Queued batch of {len(batch)} frames for processing")
-                    batch = []
-
-            time.sleep(1)  # Sleep to simulate processing time and prevent excessive loop iteration
-
-        if batch:
-            frame_queue.put(batch)
-            print(f"Queued final batch of {len(batch)} frames for processing")
-
-    except KeyboardInterrupt:
-        process.terminate()
-        print("Process interrupted and terminated.")
-
-    frame_queue.put(None)
-    print("Frame extraction completed.")
+        finished = False
+        buffer = None
+        while not finished:
+            if buffer is None:
+                buffer = allocate((batch_size, height, width, 3))
+            frame_indices = []
+            while len(frame_indices) < batch_size:
+                if not read_frame(process.stdout, buffer[len(frame_indices)]):
+                    finished = True
+                    break
+                if timestamps:
+                    # Snap the frame to its position on the fps grid; two frames on one position keep the first
+                    grid_index = first_frame + int(round(timestamps.next_timestamp() * fps))
+                    if grid_index <= frame_index:
+                        continue
+                    frame_index = grid_index
+                else:
+                    frame_index += 1
+                frame_indices.append(frame_index)
+
+            count = len(frame_indices)
+            if sampler and count:
+                # Compact the kept frames to the front of the buffer, so they stay in it
+                keep = sampler.keep(buffer[:count])
+                buffer[:keep.sum()] = buffer[:count][keep]
+                frame_indices = [frame_index for frame_index, kept in zip(frame_indices, keep) if kept]
+
+            if frame_indices:
+                yield frame_indices, buffer[:len(frame_indices)]
+                buffer = None
+
+        process.wait()
+        errors = timestamps.errors() if timestamps else process.stderr.read().decode(errors='replace').strip()
+        if errors:
+            logger.error(errors)
+    finally:
+        if process.poll() is None:
+            process.terminate()
+
+def run_extraction(video_path, output_dir, results_file="dominant_colors.csv", fps=3, start_time=None, batch_size=10,
+                   num_workers=1, engine='colorthief', num_colors=10, stream=True, checkpoint_file="checkpoint.json", resume=False,
+                   sampling='fps', threshold=None, cache_file=None, scale_width=None, quality=10,
+                   queue_size=None, metrics_interval=10, metrics_port=None, log_level=logging.INFO, aggregate=False,
+                   archive_path=None, archive_width=160, regions=None, render=False, render_height=120):
+    # The extraction pipeline of PipelineStages.run_pipeline with num_workers palette processes
+    # stream: pipe raw frames from ffmpeg instead of writing PNGs to output_dir
+    # queue_size: batches in flight between the decoder and the workers (default: num_workers + 2);
+    #   the decoder, and with it ffmpeg, waits when they are all taken
+    # metrics_interval: seconds between progress summary lines; metrics_port: serve /metrics on localhost
+    # aggregate: keep film-level color statistics and rollups next to results_file while extracting
+    # archive_path: also keep every sampled frame as an archive_width thumbnail (see FrameArchive.py)
+    # regions: region spec such as 'center,halves,grid:3x3'; each region's palette gets its own columns
+    # render: draw the film barcode and palette timeline next to results_file while extracting
+    from PipelineStages import run_pipeline  # PipelineStages imports this module
+    stages = {'palette': {'workers': num_workers}}
+    if render:
+        stages['render'] = {}
+    run_pipeline(video_path, results_file, stages, fps=fps, start_time=start_time, batch_size=batch_size, engine=engine,
+                 num_colors=num_colors, sampling=sampling, threshold=threshold, cache_file=cache_file, scale_width=scale_width,
+                 quality=quality, regions=regions, output_dir=None if stream else output_dir, checkpoint_file=checkpoint_file,
+                 resume=resume, aggregate=aggregate, render_height=render_height, metrics_interval=metrics_interval,
+                 metrics_port=metrics_port, log_level=log_level, queue_size=queue_size, archive_path=archive_path,
+                 archive_width=archive_width)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract frames from a film and write their dominant colors to a CSV file.")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Number of color extraction processes (default: number of cores)")
+    parser.add_argument('--resume', action='store_true', help="Continue from the last checkpoint instead of starting over")
+    parser.add_argument('--sampling', choices=SAMPLING_MODES, default='fps', help="Which frames get a palette: every fps frame, scene changes, keyframes or histogram changes")
+    parser.add_argument('--threshold', type=float, default=None, help="Change threshold for the scene and histogram sampling modes")
+    parser.add_argument('--cache', default=None, help="SQLite palette cache file, reused across runs (default: no cache)")
+    parser.add_argument('--scale-width', type=int, default=None, help="Downscale frames to this width inside ffmpeg, e.g. 160 (default: full resolution)")
+    parser.add_argument('--quality', type=int, default=10, help="Pixel stride of the palette engine; 1 uses every pixel")
+    parser.add_argument('--queue-size', type=int, default=None, help="Frame batches in flight between decoder and workers (default: workers + 2)")
+    parser.add_argument('--metrics-interval', type=float, default=10, help="Seconds between progress summary lines")
+    parser.add_argument('--metrics-port', type=int, default=None, help="Serve Prometheus metrics on http://127.0.0.1:<port>/metrics (and JSON on /metrics.json)")
+    parser.add_argument('--verbose', action='store_true', help="Log every batch and frame (debug level)")
+    parser.add_argument('--aggregate', action='store_true', help="Keep a film summary palette and per-minute/per-scene rollups up to date while extracting")
+    parser.add_argument('--archive', default=None, help="Also keep every sampled frame as a thumbnail in this archive directory, for recomputing palettes later")
+    parser.add_argument('--archive-width', type=int, default=160, help="Width of the archived thumbnails")
+    parser.add_argument('--regions', default=None, help="Also write palettes of frame regions, e.g. center,halves,sides,grid:3x3")
+    parser.add_argument('--render', action='store_true', help="Draw the film barcode and palette timeline while extracting")
+    args = parser.parse_args()
+    log_level = logging.DEBUG if args.verbose else logging.INFO
+    configure_logging(log_level)
+
     video_path = '/Users/rsudhir/Documents/GitHub/Data-Science-Project---Outfits-from-Ghibli-Films/HowlsMovingCastle/MovieFile/Howls.Moving.Castle.2004.720p.BluRay.x264-x0r.mkv'
     output_dir = '/Users/rsudhir/Documents/GitHub/Data-Science-Project---Outfits-from-Ghibli-Films/HowlsMovingCastle/frames'
     start_time = '00:00:00'
-
-    frame_queue = Queue()
-
-    # Start the frame processing process
-    processor_process = Process(target=process_frames, args=(frame_queue,))
-    processor_process.start()
-
-    # Extract frames and queue them for processing
-    extract_process = Process(target=extract_and_queue_frames, args=(video_path, output_dir, frame_queue, 3, start_time, 10))
-    extract_process.start()
-
-    # Wait for the processes to finish
-    extract_process.join()
-    frame_queue.put(None)  # Ensure the processing loop terminates
-    processor_process.join()
+    stream = True  # Pipe raw frames from ffmpeg instead of writing PNGs to output_dir
+    engine = 'colorthief'  # Palette engine: 'colorthief' (reference), 'numpy' or 'kmeans'
+    results_file = "dominant_colors.csv"  # .csv, .parquet (needs pyarrow) or .npy
+    checkpoint_file = "checkpoint.json"  # Last completed frame per video, for --resume
+
+    run_extraction(video_path, output_dir, results_file, fps=3, start_time=start_time, batch_size=10,
+                   num_workers=max(1, args.workers), engine=engine, stream=stream,
+                   checkpoint_file=checkpoint_file, resume=args.resume, sampling=args.sampling, threshold=args.threshold,
+                   cache_file=args.cache, scale_width=args.scale_width, quality=max(1, args.quality),
+                   queue_size=args.queue_size, metrics_interval=args.metrics_interval, metrics_port=args.metrics_port, log_level=log_level,
+                   aggregate=args.aggregate, archive_path=args.archive, archive_width=args.archive_width,
+                   regions=args.regions, render=args.render)
@@ -0,0 +1,232 @@
+import json
+import os
+import numpy as np
+from PaletteEngines import palette_distance, quantize_bins
+
+# Film-level color statistics kept up to date while the palettes are written, in constant memory:
+#   - a color histogram of every palette color (bits per channel, like the numpy engine)
+#   - running k-means centroids of the palette colors, i.e. the film's summary palette
+#   - rollups per minute of film and per scene (a scene ends where consecutive palettes differ by
+#     more than scene_threshold), each written to <results>_rollups.jsonl as soon as it closes
+# Every palette counts as many times as the frames it stands for (its weight, see
+# FrameSampling.frame_weights), so a long shot kept as one frame weighs as much as it lasts.
+# The state is saved next to the results on every checkpoint, so --resume continues the same
+# statistics, and <results>_summary.json always holds the palettes of everything seen so far.
+
+class RunningKMeans:
+    # Online (MacQueen) k-means: every centroid is the running mean of the colors assigned to it.
+    # Until `clusters` distinct colors have been seen they are simply collected; the centroids are
+    # then seeded with k-means++ on them.
+    def __init__(self, clusters=8, seed=0):
+        self.clusters = clusters
+        self.random = np.random.default_rng(seed)
+        self.centers = None
+        self.counts = np.zeros(clusters)
+        self.seen = np.empty((0, 3))
+        self.seen_counts = np.empty(0)
+
+    def partial_fit(self, colors, weight=1):
+        # weight: how many times each of the colors counts
+        colors = np.asarray(colors, dtype=np.float64).reshape(-1, 3)
+        weights = np.full(len(colors), float(weight))
+        if self.centers is None:
+            seen, inverse = np.unique(np.concatenate([self.seen, colors]), axis=0, return_inverse=True)
+            self.seen_counts = np.bincount(inverse.ravel(), weights=np.concatenate([self.seen_counts, weights]), minlength=len(seen))
+            self.seen = seen
+            if len(seen) < self.clusters:
+                return
+            self.centers = self.seed_centers(seen, self.seen_counts)
+            colors, weights = seen, self.seen_counts
+            self.seen, self.seen_counts = np.empty((0, 3)), np.empty(0)
+
+        labels = np.argmin(((colors[:, None, :] - self.centers[None]) ** 2).sum(axis=2), axis=1)
+        added = np.bincount(labels, weights=weights, minlength=self.clusters)
+        sums = np.stack([np.bincount(labels, weights=weights * colors[:, channel], minlength=self.clusters) for channel in range(3)], axis=1)
+        self.counts += added
+        moved = added > 0
+        self.centers[moved] += (sums[moved] - added[moved, None] * self.centers[moved]) / self.counts[moved, None]
+
+    def seed_centers(self, colors, weights):
+        centers = [colors[self.random.choice(len(colors), p=weights / weights.sum())]]
+        for _ in range(1, self.clusters):
+            distances = np.min([((colors - center) ** 2).sum(axis=1) for center in centers], axis=0) * weights
+            centers.append(colors[self.random.choice(len(colors), p=distances / distances.sum())])
+        return np.array(centers)
+
+    def palette(self):
+        # (colors, weights) ordered by how many palette colors each centroid absorbed
+        if self.centers is None:
+            order = np.argsort(-self.seen_counts, kind='stable')
+            return self.seen[order], self.seen_counts[order]
+        order = np.argsort(-self.counts, kind='stable')
+        return self.centers[order], self.counts[order]
+
+class ColorHistogram:
+    # Counts and color sums per bin, so the dominant bins come out as mean colors, not bin corners
+    def __init__(self, bits=4):
+        self.bits = bits
+        self.counts = np.zeros(1 << (3 * bits))
+        self.sums = np.zeros((1 << (3 * bits), 3))
+
+    def add(self, colors, weight=1):
+        colors = np.asarray(colors, dtype=np.int64).reshape(-1, 3)
+        bins = quantize_bins(colors, self.bits)
+        self.counts += weight * np.bincount(bins, minlength=len(self.counts))
+        for channel in range(3):
+            self.sums[:, channel] += weight * np.bincount(bins, weights=colors[:, channel], minlength=len(self.counts))
+
+    def palette(self, num_colors=10):
+        top = np.argsort(-self.counts, kind='stable')[:num_colors]
+        top = top[self.counts[top] > 0]
+        return self.sums[top] / self.counts[top, None], self.counts[top]
+
+class Rollup:
+    # Statistics of one stretch of frames (a minute or a scene); frames counts the grid frames the
+    # palettes stand for, up to last_frame
+    def __init__(self, kind, key, first_frame, bits=4):
+        self.kind = kind
+        self.key = key
+        self.first_frame = first_frame
+        self.last_frame = first_frame
+        self.frames = 0
+        self.histogram = ColorHistogram(bits)
+
+    def add(self, frame_index, palette, weight=1):
+        self.last_frame = frame_index + weight - 1
+        self.frames += weight
+        self.histogram.add(palette, weight)
+
+    def record(self, fps, num_colors):
+        colors, counts = self.histogram.palette(num_colors)
+        mean = self.histogram.sums.sum(axis=0) / max(1, self.histogram.counts.sum())
+        return {
+            'kind': self.kind, 'first_frame': int(self.first_frame), 'last_frame': int(self.last_frame),
+            'start_seconds': (self.first_frame - 1) / fps, 'end_seconds': self.last_frame / fps, 'frames': self.frames,
+            'mean_color': rgb_list(mean), 'palette': [rgb_list(color) for color in colors], 'weights': counts.tolist(),
+        }
+
+def rgb_list(color):
+    return [int(value) for value in np.clip(np.rint(color), 0, 255)]
+
+def aggregate_paths(results_file):
+    stem = os.path.splitext(results_file.rstrip('/\\'))[0]
+    return stem + "_aggregates.npz", stem + "_rollups.jsonl", stem + "_summary.json"
+
+class FilmAggregator:
+    def __init__(self, results_file, num_colors=10, fps=3, clusters=8, bits=4, rollup_seconds=60, scene_threshold=40.0, resume=False):
+        self.state_path, self.rollups_path, self.summary_path = aggregate_paths(results_file)
+        self.num_colors = num_colors
+        self.fps = fps
+        self.bits = bits
+        self.rollup_seconds = rollup_seconds
+        self.scene_threshold = scene_threshold
+        self.kmeans = RunningKMeans(clusters)
+        self.histogram = ColorHistogram(bits)
+        self.frames = 0
+        self.last_frame = 0
+        self.last_palette = None
+        self.minute = None
+        self.scene = None
+        rollups_size = 0
+        if resume and os.path.exists(self.state_path):
+            rollups_size = self.load_state()
+        # Rollups written after the saved state are written again, so drop them
+        with open(self.rollups_path, "a") as rollups_file:
+            rollups_file.truncate(rollups_size)
+        self.rollups_file = open(self.rollups_path, "a")
+
+    def update(self, rows, weights=None):
+        # rows: (frame_index, frame_name, colors) in frame order, and their weights, as given to the
+        # result sink. Frames up to last_frame are already counted (a resumed run processes them again).
+        for row_number, (frame_index, _, colors, *_) in enumerate(rows):
+            weight = 1 if weights is None else int(weights[row_number])
+            if frame_index <= self.last_frame or not colors:
+                continue
+            palette = np.clip(np.array(colors[:self.num_colors], dtype=np.int64), 0, 255)
+            self.histogram.add(palette, weight)
+            self.kmeans.partial_fit(palette, weight)
+
+            minute = int((frame_index - 1) / self.fps // self.rollup_seconds)
+            if self.minute is not None and self.minute.key != minute:
+                self.emit(self.minute)
+                self.minute = None
+            if self.minute is None:
+                self.minute = Rollup('minute', minute, frame_index, self.bits)
+            self.minute.add(frame_index, palette, weight)
+
+            if self.scene is not None and palette_distance(self.last_palette.tolist(), palette.tolist()) > self.scene_threshold:
+                self.emit(self.scene)
+                self.scene = None
+            if self.scene is None:
+                self.scene = Rollup('scene', frame_index, frame_index, self.bits)
+            self.scene.add(frame_index, palette, weight)
+
+            self.last_palette = palette
+            self.last_frame = frame_index
+            self.frames += weight
+
+    def emit(self, rollup):
+        self.rollups_file.write(json.dumps(rollup.record(self.fps, self.num_colors)) + "\n")
+
+    def summary(self):
+        kmeans_colors, kmeans_weights = self.kmeans.palette()
+        histogram_colors, histogram_weights = self.histogram.palette(self.num_colors)
+        return {
+            'frames': self.frames, 'last_frame': int(self.last_frame),
+            'kmeans_palette': [rgb_list(color) for color in kmeans_colors], 'kmeans_weights': kmeans_weights.tolist(),
+            'histogram_palette': [rgb_list(color) for color in histogram_colors], 'histogram_weights': histogram_weights.tolist(),
+        }
+
+    def save(self):
+        # Called on every checkpoint: rollups, state and summary, each replaced atomically
+        self.rollups_file.flush()
+        os.fsync(self.rollups_file.fileno())
+        state = {
+            'frames': self.frames, 'last_frame': self.last_frame, 'rollups_size': self.rollups_file.tell(),
+            'histogram_counts': self.histogram.counts, 'histogram_sums': self.histogram.sums,
+            'kmeans_counts': self.kmeans.counts, 'kmeans_seen': self.kmeans.seen, 'kmeans_seen_counts': self.kmeans.seen_counts,
+        }
+        if self.kmeans.centers is not None:
+            state['kmeans_centers'] = self.kmeans.centers
+        if self.last_palette is not None:
+            state['last_palette'] = self.last_palette
+        for name, rollup in (('minute', self.minute), ('scene', self.scene)):
+            if rollup is not None:
+                state[f'{name}_info'] = np.array([rollup.key, rollup.first_frame, rollup.last_frame, rollup.frames])
+                state[f'{name}_counts'] = rollup.histogram.counts
+                state[f'{name}_sums'] = rollup.histogram.sums
+        with open(self.state_path + ".tmp", "wb") as state_file:
+            np.savez(state_file, **state)
+        os.replace(self.state_path + ".tmp", self.state_path)
+
+        with open(self.summary_path + ".tmp", "w") as summary_file:
+            json.dump(self.summary(), summary_file, indent=2)
+        os.replace(self.summary_path + ".tmp", self.summary_path)
+
+    def load_state(self):
+        state = np.load(self.state_path)
+        self.frames = int(state['frames'])
+        self.last_frame = int(state['last_frame'])
+        self.histogram.counts, self.histogram.sums = state['histogram_counts'], state['histogram_sums']
+        self.kmeans.counts, self.kmeans.seen, self.kmeans.seen_counts = state['kmeans_counts'], state['kmeans_seen'], state['kmeans_seen_counts']
+        if 'kmeans_centers' in state:
+            self.kmeans.centers = state['kmeans_centers']
+        if 'last_palette' in state:
+            self.last_palette = state['last_palette']
+        for name in ('minute', 'scene'):
+            if f'{name}_info' in state:
+                key, first_frame, last_frame, frames = state[f'{name}_info'].tolist()
+                rollup = Rollup(name, key, first_frame, self.bits)
+                rollup.last_frame, rollup.frames = last_frame, frames
+                rollup.histogram.counts, rollup.histogram.sums = state[f'{name}_counts'], state[f'{name}_sums']
+                setattr(self, name, rollup)
+        return int(state['rollups_size'])
+
+    def close(self):
+        # The open minute and scene are complete once the film is
+        for rollup in (self.minute, self.scene):
+            if rollup is not None:
+                self.emit(rollup)
+        self.minute = self.scene = None
+        self.save()
+        self.rollups_file.close()
@@ -0,0 +1,182 @@
+import argparse
+import json
+import logging
+import os
+import numpy as np
+from PaletteEngines import pad_palette
+from PipelineMetrics import configure_logging
+from ResultSinks import load_palettes
+
+logger = logging.getLogger(__name__)
+
+# Film barcode and palette timeline images, drawn column by column while the palettes are written:
+#   barcode:  one column per frame in the frame's dominant (first) palette color
+#   timeline: one column per frame with the whole palette stacked top to bottom
+# Column x is frame x + 1 on the fps grid, so the images are a true time axis. Frames dropped by
+# a sampling mode repeat the kept frame before them, as in FrameSampling.py. Each image is a
+# pyramid of levels: level k averages 2**k frames per column, down to about max_width columns
+# for the overview. Levels are raw memory-mapped arrays of shape (columns, height, 3) in
+# <results>_render/, one contiguous block per column, so memory use stays the same for any film
+# length. save() records progress for --resume, and close() writes every level as a PNG.
+
+KINDS = ('barcode', 'timeline')
+
+def render_dir(results_file):
+    return os.path.splitext(results_file.rstrip('/\\'))[0] + "_render"
+
+def level_count(columns, max_width=1024):
+    levels = 1
+    while columns > max_width << (levels - 1):
+        levels += 1
+    return levels
+
+class BarcodeRenderer:
+    def __init__(self, results_file, num_colors=10, total_frames=None, height=120, max_width=1024, resume=False):
+        # total_frames: grid frames in the film, if known, so the images are allocated once
+        self.path = render_dir(results_file)
+        self.num_colors = num_colors
+        meta_path = os.path.join(self.path, "meta.json")
+        if resume and os.path.exists(meta_path):
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+            self.height, self.levels, self.capacity, self.written = meta['height'], meta['levels'], meta['capacity'], meta['written']
+            self.max_width = meta.get('max_width', max_width)
+        else:
+            os.makedirs(self.path, exist_ok=True)
+            for file_name in os.listdir(self.path):
+                if file_name.endswith('.u8') or file_name.endswith('.png'):
+                    os.remove(os.path.join(self.path, file_name))
+            self.height = height
+            self.max_width = max_width
+            self.capacity = max(1, total_frames or 4096)
+            self.levels = level_count(self.capacity, max_width)
+            self.written = 0  # Level 0 columns drawn so far
+        # Color band of every pixel row in the timeline
+        self.bands = np.arange(self.height) * num_colors // self.height
+        self.open_levels(self.capacity)
+
+    def open_levels(self, capacity):
+        # Maps every level of both images with room for capacity level-0 columns, growing the files
+        self.capacity = capacity
+        self.images = {}
+        for kind in KINDS:
+            for level in range(self.levels):
+                file_path = os.path.join(self.path, f"{kind}_{level}.u8")
+                shape = (-(-capacity // (1 << level)), self.height, 3)
+                size = int(np.prod(shape))
+                with open(file_path, 'ab') as image_file:
+                    if image_file.tell() < size:
+                        image_file.truncate(size)
+                self.images[kind, level] = np.memmap(file_path, dtype=np.uint8, mode='r+', shape=shape)
+
+    def update(self, rows):
+        # rows: (frame_index, frame_name, colors, ...) in frame order, as given to the result sink
+        rows = [row for row in rows if row[2]]
+        if not rows:
+            return
+        frame_indices = np.array([row[0] for row in rows], dtype=np.int64)
+        palettes = np.clip(np.array([pad_palette(list(row[2]), self.num_colors)[:self.num_colors] for row in rows], dtype=np.int64), 0, 255).astype(np.uint8)
+
+        positions = frame_indices - 1
+        last = int(positions[-1])
+        if last >= self.capacity:
+            # A longer film than allocated for also needs more levels to keep the overview small;
+            # the new levels are filled from the columns drawn so far
+            self.flush()
+            levels = self.levels
+            capacity = max(2 * self.capacity, last + 1)
+            self.levels = max(levels, level_count(capacity, self.max_width))
+            self.open_levels(capacity)
+            if self.levels > levels and self.written:
+                self.update_levels(0, self.written - 1)
+        first = min(int(positions[0]), self.written)
+
+        # Every column from the first new one up to the next frame repeats that frame's palette;
+        # the column before the first row repeats the last drawn one (a resumed run redraws it)
+        columns = np.arange(first, last + 1)
+        owner = np.searchsorted(positions, columns, side='right') - 1
+        if (owner < 0).any():
+            if self.written:
+                previous = int(min(first, self.written) - 1)
+                self.images['barcode', 0][columns[owner < 0]] = self.images['barcode', 0][previous]
+                self.images['timeline', 0][columns[owner < 0]] = self.images['timeline', 0][previous]
+            columns, owner = columns[owner >= 0], owner[owner >= 0]
+        colors = palettes[owner]
+        self.images['barcode', 0][columns] = colors[:, None, 0, :]
+        self.images['timeline', 0][columns] = colors[:, self.bands, :]
+
+        self.written = max(self.written, last + 1)
+        self.update_levels(first, last)
+
+    def update_levels(self, first, last, partial=False):
+        # Redraws the columns of every coarser level that cover level-0 columns first..last. A column
+        # is only drawn once both halves are there, unless partial (the end of the film).
+        width = self.written
+        for level in range(1, self.levels):
+            lower_width, width = width, -(-width // 2)
+            first, last = first // 2, (last // 2 if partial else (last + 1) // 2 - 1)
+            last = min(last, width - 1)
+            if last < first:
+                break
+            for kind in KINDS:
+                lower = self.images[kind, level - 1]
+                pairs = np.asarray(lower[2 * first:min(2 * last + 2, lower_width)], dtype=np.uint16)
+                if len(pairs) % 2:
+                    pairs = np.concatenate([pairs, pairs[-1:]])
+                pairs = pairs.reshape(-1, 2, self.height, 3)
+                self.images[kind, level][first:last + 1] = ((pairs[:, 0] + pairs[:, 1] + 1) // 2).astype(np.uint8)
+
+    def flush(self):
+        for image in self.images.values():
+            image.flush()
+
+    def save(self):
+        # Called on every checkpoint, after the rows up to it were drawn
+        self.flush()
+        meta = {'height': self.height, 'levels': self.levels, 'capacity': self.capacity, 'written': self.written, 'num_colors': self.num_colors,
+                'max_width': self.max_width}
+        with open(os.path.join(self.path, "meta.json.tmp"), "w") as meta_file:
+            json.dump(meta, meta_file, indent=2)
+        os.replace(os.path.join(self.path, "meta.json.tmp"), os.path.join(self.path, "meta.json"))
+
+    def export(self):
+        # One PNG per image and level, e.g. barcode_0.png (every frame) to barcode_4.png (overview)
+        from PIL import Image
+        paths = []
+        width = self.written
+        for level in range(self.levels):
+            for kind in KINDS:
+                path = os.path.join(self.path, f"{kind}_{level}.png")
+                Image.fromarray(np.ascontiguousarray(self.images[kind, level][:width].transpose(1, 0, 2))).save(path)
+                paths.append(path)
+            width = -(-width // 2)
+        return paths
+
+    def close(self):
+        if self.written:
+            self.update_levels(self.written - 1, self.written - 1, partial=True)
+        self.save()
+        paths = self.export() if self.written else []
+        logger.info(f"Rendered {self.written} frame columns in {self.levels} levels to {self.path}")
+        return paths
+
+def render_results(results_file, num_colors=10, height=120, max_width=1024, chunk_size=5000):
+    # Renders an existing results file; the rows are fed in chunks, as during an extraction
+    frame_indices, palettes = load_palettes(results_file, num_colors)
+    renderer = BarcodeRenderer(results_file, num_colors, int(frame_indices[-1]) if len(frame_indices) else None, height, max_width)
+    for first in range(0, len(frame_indices), chunk_size):
+        rows = [(int(frame_index), None, palette) for frame_index, palette in zip(frame_indices[first:first + chunk_size], palettes[first:first + chunk_size].tolist())]
+        renderer.update(rows)
+    return renderer.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render the film barcode and palette timeline of a results file.")
+    parser.add_argument('results', help="Results file (.csv, .parquet or .npy)")
+    parser.add_argument('--num-colors', type=int, default=10, help="Colors per palette in the results file")
+    parser.add_argument('--height', type=int, default=120, help="Image height in pixels")
+    parser.add_argument('--max-width', type=int, default=1024, help="Width the coarsest level fits in")
+    args = parser.parse_args()
+    configure_logging(logging.INFO)
+
+    for path in render_results(args.results, args.num_colors, args.height, args.max_width):
+        print(path)
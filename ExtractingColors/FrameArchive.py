@@ -0,0 +1,233 @@
+import argparse
+import json
+import logging
+import os
+import time
+from multiprocessing import Pool
+import numpy as np
+from FrameRegions import frame_region_palettes, parse_regions, region_names, region_palettes
+from FrameSampling import RowWeights
+from PaletteEngines import ENGINES, get_engine
+from PipelineMetrics import configure_logging
+from ResultSinks import open_sink
+
+logger = logging.getLogger(__name__)
+
+# Archive of every sampled frame as a fixed-size uint8 thumbnail, so palettes can be recomputed
+# with another engine, num_colors or a lower sampling rate without decoding the film again.
+# An archive is a directory of raw memory-mapped arrays plus a small JSON header:
+#   frames.u8         (capacity, height, width, 3) uint8 thumbnails
+#   frame_indices.i8  (capacity,) int64 positions on the fps grid, as in the results files
+#   seconds.f8        (capacity,) float64 timestamps in the film
+#   meta.json         size, fps and the number of frames written so far (count)
+# The arrays grow by doubling. Only rows below count are valid. The header is replaced after
+# the rows it counts are flushed, so a crash never leaves an archive that claims unwritten frames.
+# Reading is zero-copy: archive.frames[i:j] is a view of the page cache, and the palette engines
+# take it as is.
+
+ARRAYS = (('frames', 'frames.u8', np.uint8), ('frame_indices', 'frame_indices.i8', np.int64), ('seconds', 'seconds.f8', np.float64))
+
+def area_weights(size, target):
+    # (target, size) matrix of the share each input pixel has in each output pixel, by how much
+    # of the output pixel's span it covers
+    edges = np.arange(target + 1) * (size / target)
+    pixels = np.arange(size)
+    overlap = np.minimum(edges[1:, None], pixels + 1) - np.maximum(edges[:-1, None], pixels)
+    overlap = np.clip(overlap, 0, None)
+    return (overlap / overlap.sum(axis=1, keepdims=True)).astype(np.float32)
+
+def downscale(frames, height, width):
+    # (n, H, W, 3) -> (n, height, width, 3) with area averaging, like ffmpeg's area scaler. Blocks
+    # of H // height by W // width pixels are summed first, which crops fewer than one block of
+    # border pixels (6 columns of a 1998 wide frame at 160); the blocks are then resampled to the
+    # exact size by covered area. Frames smaller than the thumbnail are stretched the same way.
+    frames = np.asarray(frames)
+    count, frame_height, frame_width = frames.shape[:3]
+    if (frame_height, frame_width) == (height, width):
+        return frames
+    block_height, block_width = max(1, frame_height // height), max(1, frame_width // width)
+    rows, columns = frame_height // block_height, frame_width // block_width
+    top = (frame_height - rows * block_height) // 2
+    left = (frame_width - columns * block_width) // 2
+    blocks = frames[:, top:top + rows * block_height, left:left + columns * block_width]
+    # Rows first, then columns: two contiguous reductions are much faster than one over both axes
+    sums = blocks.reshape(count, rows, block_height, -1).sum(axis=2, dtype=np.uint32)
+    sums = sums.reshape(count, rows, columns, block_width, 3).sum(axis=3)
+    area = block_height * block_width
+    if (rows, columns) == (height, width):
+        return ((sums + area // 2) // area).astype(np.uint8)
+    means = sums.astype(np.float32) / area
+    means = np.matmul(area_weights(rows, height), means.reshape(count, rows, columns * 3))
+    means = np.matmul(area_weights(columns, width), means.reshape(count * height, columns, 3))
+    means = means.reshape(count, height, width, 3)
+    return np.clip(np.rint(means), 0, 255).astype(np.uint8)
+
+class FrameArchive:
+    def __init__(self, path, mode='r'):
+        # mode 'r' opens read-only; 'r+' opens for appending (see create and resume)
+        self.path = path
+        self.mode = mode
+        with open(os.path.join(path, 'meta.json')) as meta_file:
+            self.meta = json.load(meta_file)
+        self.height, self.width = self.meta['height'], self.meta['width']
+        self.fps = self.meta['fps']
+        self.count = self.meta['count']
+        self.open_arrays(self.meta['capacity'])
+
+    @classmethod
+    def create(cls, path, height, width, fps, video=None, start_seconds=0.0, capacity=1024):
+        os.makedirs(path, exist_ok=True)
+        for _, file_name, _ in ARRAYS:
+            if os.path.exists(os.path.join(path, file_name)):
+                os.remove(os.path.join(path, file_name))
+        meta = {'video': video, 'fps': fps, 'start_seconds': start_seconds, 'height': height, 'width': width, 'count': 0, 'capacity': capacity}
+        write_meta(path, meta)
+        return cls(path, 'r+')
+
+    @classmethod
+    def resume(cls, path, first_frame):
+        # Drop archived frames from first_frame on, since the resumed decoder produces them again
+        archive = cls(path, 'r+')
+        archive.count = int(np.searchsorted(archive.frame_indices[:archive.count], first_frame))
+        archive.flush()
+        return archive
+
+    def __getstate__(self):
+        # Processes reopen the files by path rather than pickling the mapped arrays
+        return {'path': self.path, 'mode': self.mode}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['mode'])
+
+    def __len__(self):
+        return self.count
+
+    def open_arrays(self, capacity):
+        # Maps the three arrays with room for capacity rows, growing the files if needed
+        self.capacity = max(capacity, self.count)
+        for name, file_name, dtype in ARRAYS:
+            file_path = os.path.join(self.path, file_name)
+            shape = (self.capacity, self.height, self.width, 3) if name == 'frames' else (self.capacity,)
+            if self.mode == 'r':
+                # Read-only views stop at count, so nothing past the valid rows is visible
+                shape = (self.count,) + shape[1:]
+                array = np.memmap(file_path, dtype=dtype, mode='r', shape=shape) if self.count else np.empty(shape, dtype=dtype)
+            else:
+                size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+                with open(file_path, 'ab') as array_file:
+                    if array_file.tell() < size:
+                        array_file.truncate(size)
+                array = np.memmap(file_path, dtype=dtype, mode='r+', shape=shape)
+            setattr(self, name, array)
+
+    def append(self, frames, frame_indices):
+        # Thumbnails of one decoded batch; frames of any size are area-averaged down to the archive's
+        count = len(frame_indices)
+        if self.count + count > self.capacity:
+            self.flush_arrays()
+            self.open_arrays(max(2 * self.capacity, self.count + count))
+        rows = slice(self.count, self.count + count)
+        self.frames[rows] = downscale(frames[:count], self.height, self.width)
+        self.frame_indices[rows] = frame_indices
+        self.seconds[rows] = self.meta['start_seconds'] + (np.asarray(frame_indices) - 1) / self.fps
+        self.count += count
+
+    def flush_arrays(self):
+        for name, _, _ in ARRAYS:
+            getattr(self, name).flush()
+
+    def flush(self):
+        self.flush_arrays()
+        write_meta(self.path, dict(self.meta, count=self.count, capacity=self.capacity))
+
+    def close(self):
+        if self.mode == 'r+':
+            self.flush()
+
+    def batches(self, batch_size=100, every=1):
+        # (frame indices, frames) views of consecutive rows, keeping every `every`-th archived frame
+        for first in range(0, self.count, batch_size * every):
+            rows = slice(first, min(first + batch_size * every, self.count), every)
+            yield self.frame_indices[rows], self.frames[rows]
+
+def write_meta(path, meta):
+    with open(os.path.join(path, 'meta.json.tmp'), 'w') as meta_file:
+        json.dump(meta, meta_file, indent=2)
+    os.replace(os.path.join(path, 'meta.json.tmp'), os.path.join(path, 'meta.json'))
+
+# Each worker of recompute_palettes opens the archive and builds its engine once
+worker_state = {}
+
+def init_worker(archive_path, engine, num_colors, quality, cache_file, log_level, regions):
+    configure_logging(log_level)
+    worker_state['archive'] = FrameArchive(archive_path)
+    worker_state['engine'] = get_engine(engine, num_colors, quality, cache_file)
+    worker_state['regions'] = regions
+
+def palette_rows(rows):
+    archive, engine, regions = worker_state['archive'], worker_state['engine'], worker_state['regions']
+    frame_indices = archive.frame_indices[rows]
+    frames = archive.frames[rows]
+    palettes = engine.palettes(frames)
+    batch_regions = frame_region_palettes(region_palettes(engine, frames, regions), len(frames)) if regions else None
+    results = []
+    for i, (frame_index, palette) in enumerate(zip(frame_indices, palettes)):
+        if palette:
+            row = (int(frame_index), f"frame_{frame_index:06d}", palette)
+            results.append(row if batch_regions is None else row + (batch_regions[i],))
+    return results
+
+def recompute_palettes(archive_path, results_file, engine='numpy', num_colors=10, quality=10, fps=None, num_workers=1,
+                       batch_size=100, cache_file=None, log_level=logging.INFO, regions=None):
+    # Palettes of every archived frame (or of an fps-rate subset) into a new results file.
+    # Workers slice the shared page cache of the archive, so only row ranges cross processes.
+    if engine not in ENGINES:
+        # A Pool whose initializer fails keeps replacing its workers instead of raising
+        raise ValueError(f"Unknown palette engine '{engine}', expected one of {sorted(ENGINES)}")
+    archive = FrameArchive(archive_path)
+    regions = parse_regions(regions)
+    every = max(1, int(round(archive.fps / fps))) if fps else 1
+    ranges = [slice(first, min(first + batch_size * every, len(archive)), every) for first in range(0, len(archive), batch_size * every)]
+    sink = open_sink(results_file, num_colors=num_colors, regions=region_names(regions))
+    # With an fps subset, each palette stands for the archived frames up to the next one
+    weights = RowWeights()
+    started = time.perf_counter()
+    written = 0
+    with Pool(num_workers, initializer=init_worker, initargs=(archive_path, engine, num_colors, quality, cache_file, log_level, regions)) as pool:
+        for rows in pool.imap(palette_rows, ranges):
+            sink.write(*weights.add(rows))
+            written += len(rows)
+            logger.debug(f"{written} palettes written to {results_file}")
+    sink.write(*weights.finish(int(archive.frame_indices[len(archive) - 1]) if len(archive) else None))
+    sink.close()
+    seconds = time.perf_counter() - started
+    logger.info(f"{written} palettes from {archive_path} written to {results_file} in {seconds:.1f}s ({written / seconds if seconds else 0:.0f} frames/s)")
+    return written
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect a frame archive or recompute palettes from it without decoding the film.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    info_parser = subparsers.add_parser('info', help="Print the archive header")
+    info_parser.add_argument('archive', help="Archive directory written with --archive")
+    palettes_parser = subparsers.add_parser('palettes', help="Recompute palettes from the archived thumbnails")
+    palettes_parser.add_argument('archive', help="Archive directory written with --archive")
+    palettes_parser.add_argument('results', help="Results file to write; .csv, .parquet or .npy")
+    palettes_parser.add_argument('--engine', choices=sorted(ENGINES), default='numpy', help="Palette engine")
+    palettes_parser.add_argument('--num-colors', type=int, default=10, help="Colors per palette")
+    palettes_parser.add_argument('--quality', type=int, default=10, help="Pixel stride of the palette engine; 1 uses every pixel")
+    palettes_parser.add_argument('--fps', type=float, default=None, help="Use only this many of the archived frames per second (default: all)")
+    palettes_parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Number of palette processes")
+    palettes_parser.add_argument('--batch-size', type=int, default=100, help="Frames per task")
+    palettes_parser.add_argument('--cache', default=None, help="SQLite palette cache file")
+    palettes_parser.add_argument('--regions', default=None, help="Also write palettes of frame regions, e.g. center,halves,sides,grid:3x3")
+    palettes_parser.add_argument('--verbose', action='store_true', help="Log every batch (debug level)")
+    args = parser.parse_args()
+
+    if args.command == 'info':
+        archive = FrameArchive(args.archive)
+        print(json.dumps(dict(archive.meta, count=len(archive)), indent=2))
+    else:
+        log_level = logging.DEBUG if args.verbose else logging.INFO
+        configure_logging(log_level)
+        recompute_palettes(args.archive, args.results, args.engine, args.num_colors, max(1, args.quality), args.fps,
+                           max(1, args.workers), args.batch_size, args.cache, log_level, args.regions)
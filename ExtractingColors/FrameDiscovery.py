@@ -0,0 +1,91 @@
+import logging
+import os
+import re
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+class FrameWatcher:
+    # Finds every frame ffmpeg writes to output_dir exactly once, without polling the directory.
+    # ffmpeg is run with `-progress pipe:1`, which reports a `frame=N` counter on stdout as frames
+    # are written; image2 numbers its files sequentially, so the counter tells us which files exist.
+    def __init__(self, output_dir, pattern='output_%04d.png', start_number=1):
+        self.output_dir = output_dir
+        self.pattern = pattern
+        self.start_number = start_number
+        prefix, _, suffix = re.split(r'(%0?\d*d)', pattern, maxsplit=1)
+        self.regex = re.compile(f'^{re.escape(prefix)}(\\d+){re.escape(suffix)}$')
+
+    def progress_args(self):
+        return ['-progress', 'pipe:1', '-nostats']
+
+    def output_args(self):
+        return ['-start_number', str(self.start_number), os.path.join(self.output_dir, self.pattern)]
+
+    def frame_path(self, frame_number):
+        return os.path.join(self.output_dir, self.pattern % frame_number)
+
+    def frame_number(self, frame_path):
+        match = self.regex.match(os.path.basename(frame_path))
+        return int(match.group(1)) if match else None
+
+    def watch(self, process):
+        # Generator over completed frame paths, in frame order. The newest reported frame is
+        # held back until the next report (or the end of the run) in case it is still being written.
+        next_number = self.start_number
+        written = 0
+        for line in process.stdout:
+            key, _, value = line.decode(errors='replace').strip().partition('=')
+            if key == 'frame':
+                written = int(value)
+                complete = written - 1
+            elif key == 'progress' and value == 'end':
+                complete = written
+            else:
+                continue
+            while next_number < self.start_number + complete:
+                yield self.frame_path(next_number)
+                next_number += 1
+
+        # stdout closed: ffmpeg has exited, so everything on disk is complete
+        process.wait()
+        while os.path.exists(self.frame_path(next_number)):
+            yield self.frame_path(next_number)
+            next_number += 1
+
+    def existing_frames(self):
+        # One directory scan for frames left over from an earlier run, sorted by frame number
+        frame_files = [f for f in os.listdir(self.output_dir) if self.regex.match(f)]
+        frame_files.sort(key=lambda f: int(self.regex.match(f).group(1)))
+        return [os.path.join(self.output_dir, f) for f in frame_files]
+
+def extract_png_frames(video_path, output_dir, fps=3, start_time=None, batch_size=10, first_frame=1, pattern='output_%04d.png'):
+    # Generator over (frame numbers, frame paths) batches of the PNGs ffmpeg writes to output_dir,
+    # each frame reported once as soon as it is complete. Closing the generator stops ffmpeg.
+    os.makedirs(output_dir, exist_ok=True)
+    watcher = FrameWatcher(output_dir, pattern, start_number=first_frame)
+
+    command = ['ffmpeg', '-hide_banner', '-loglevel', 'error'] + watcher.progress_args()
+    if start_time:
+        command += ['-ss', str(start_time)]
+    command += ['-i', video_path, '-vf', f'fps={fps}'] + watcher.output_args()
+
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    logger.info("FFmpeg command started...")
+
+    batch = []
+    try:
+        for local_frame_path in watcher.watch(process):
+            batch.append(local_frame_path)
+            if len(batch) >= batch_size:
+                yield [watcher.frame_number(path) for path in batch], batch
+                batch = []
+        if batch:
+            yield [watcher.frame_number(path) for path in batch], batch
+
+        errors = process.stderr.read().decode(errors='replace').strip()
+        if errors:
+            logger.error(errors)
+    finally:
+        if process.poll() is None:
+            process.terminate()
@@ -0,0 +1,77 @@
+from collections import namedtuple
+import re
+import numpy as np
+
+# Palettes of parts of the frame (a center crop, the top and bottom halves, a grid of tiles),
+# computed from the frame buffer the global palette is computed from. A region spec is a comma
+# separated list of:
+#   center or center:F   the middle F of the width and height (default 0.5)
+#   halves               top and bottom
+#   sides                left and right
+#   grid:RxC             R rows of C tiles, named tile_<row>_<column> from tile_1_1
+# Regions are fractions of the frame, so the spec works at any decode size. Regions whose crops
+# come out the same size are stacked into one batch, so a 3x3 grid is a single engine call.
+
+Region = namedtuple('Region', ['name', 'top', 'bottom', 'left', 'right'])
+
+# ColorThief ignores near-white pixels, so a region that is all white has no palette
+EMPTY_REGION_COLOR = (255, 255, 255)
+
+def parse_regions(spec):
+    if not spec:
+        return []
+    regions = []
+    for part in spec.split(','):
+        part = part.strip()
+        name, _, argument = part.partition(':')
+        if name == 'center':
+            size = float(argument) if argument else 0.5
+            if not 0 < size <= 1:
+                raise ValueError(f"Center crop size must be in (0, 1], got {size}")
+            margin = (1 - size) / 2
+            regions.append(Region('center', margin, 1 - margin, margin, 1 - margin))
+        elif name == 'halves' and not argument:
+            regions += [Region('top', 0, 0.5, 0, 1), Region('bottom', 0.5, 1, 0, 1)]
+        elif name == 'sides' and not argument:
+            regions += [Region('left', 0, 1, 0, 0.5), Region('right', 0, 1, 0.5, 1)]
+        elif name == 'grid' and re.fullmatch(r'\d+x\d+', argument):
+            rows, columns = (int(value) for value in argument.split('x'))
+            regions += [Region(f"tile_{row + 1}_{column + 1}", row / rows, (row + 1) / rows, column / columns, (column + 1) / columns)
+                        for row in range(rows) for column in range(columns)]
+        else:
+            raise ValueError(f"Unknown region '{part}', expected center[:size], halves, sides or grid:RxC")
+    names = [region.name for region in regions]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Region spec '{spec}' names a region twice")
+    return regions
+
+def region_names(spec_or_regions):
+    regions = parse_regions(spec_or_regions) if isinstance(spec_or_regions, str) else spec_or_regions
+    return [region.name for region in regions]
+
+def crop_bounds(region, height, width):
+    # Pixel bounds, rounded so adjacent tiles share their edge and never overlap
+    return (int(round(region.top * height)), int(round(region.bottom * height)),
+            int(round(region.left * width)), int(round(region.right * width)))
+
+def region_palettes(engine, frames, regions):
+    # {region name: one palette per frame} for a (n, height, width, 3) batch, with one engine
+    # call per distinct crop size
+    frames = np.asarray(frames)
+    count, height, width = frames.shape[:3]
+    groups = {}
+    for region in regions:
+        top, bottom, left, right = crop_bounds(region, height, width)
+        groups.setdefault((bottom - top, right - left), []).append((region.name, top, left))
+
+    palettes = {}
+    for (crop_height, crop_width), members in groups.items():
+        crops = np.stack([frames[:, top:top + crop_height, left:left + crop_width] for _, top, left in members], axis=1)
+        group_palettes = engine.palettes(crops.reshape(-1, crop_height, crop_width, 3))
+        for position, (name, _, _) in enumerate(members):
+            palettes[name] = group_palettes[position::len(members)]
+    return palettes
+
+def frame_region_palettes(palettes, count):
+    # {region: [palette per frame]} -> [{region: palette} per frame], the 4th element of a result row
+    return [{name: region_list[i] for name, region_list in palettes.items()} for i in range(count)]
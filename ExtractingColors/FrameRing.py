@@ -0,0 +1,69 @@
+from collections import namedtuple
+from multiprocessing import Queue, shared_memory
+import numpy as np
+
+# A streamed batch that lives in slot `slot` of a FrameRing; only this small tuple goes through
+# the frame queue, the frames themselves never get pickled
+RingBatch = namedtuple('RingBatch', ['slot', 'count'])
+
+class FrameRing:
+    # Fixed number of batch-sized slots of uint8 frames in one multiprocessing.shared_memory block.
+    # The decoder acquires a free slot, lets ffmpeg's output be read straight into it and queues a
+    # RingBatch; the palette worker reads the frames in place and releases the slot. acquire()
+    # blocks while every slot is in flight, which is what holds back ffmpeg (through its stdout
+    # pipe) when the workers fall behind, so memory stays at `slots` batches however long the film.
+    # Created once by the parent, which must call close(unlink=True) after the children finish;
+    # pickling (as a Process argument) attaches to the same block by name.
+    def __init__(self, slots, batch_size, height, width):
+        self.shape = (slots, batch_size, height, width, 3)
+        self.memory = shared_memory.SharedMemory(create=True, size=int(np.prod(self.shape)))
+        self.free_slots = Queue()
+        for slot in range(slots):
+            self.free_slots.put(slot)
+        self.attach()
+
+    def attach(self):
+        self.frames = np.ndarray(self.shape, dtype=np.uint8, buffer=self.memory.buf)
+        self.current = None
+
+    def __getstate__(self):
+        return {'name': self.memory.name, 'shape': self.shape, 'free_slots': self.free_slots}
+
+    def __setstate__(self, state):
+        self.shape = state['shape']
+        self.free_slots = state['free_slots']
+        self.memory = shared_memory.SharedMemory(name=state['name'])
+        self.attach()
+
+    @property
+    def batch_shape(self):
+        return self.shape[1:]
+
+    def acquire(self, shape=None):
+        # Waits for a free slot and returns its buffer; the slot number is kept in `current`
+        # until handoff(), so it can be used as the `allocate` callback of stream_frames
+        if shape is not None and tuple(shape) != self.batch_shape:
+            raise ValueError(f"Frame ring slots are {self.batch_shape}, not {tuple(shape)}")
+        self.current = self.free_slots.get()
+        return self.frames[self.current]
+
+    def handoff(self, count):
+        # The batch in the current slot is complete; returns the RingBatch to queue for a worker
+        batch, self.current = RingBatch(self.current, count), None
+        return batch
+
+    def batch(self, ring_batch):
+        return self.frames[ring_batch.slot, :ring_batch.count]
+
+    def release(self, slot):
+        self.free_slots.put(slot)
+
+    def close(self, unlink=False):
+        # Views into the block must go before it can be closed
+        if self.current is not None:
+            self.release(self.current)
+            self.current = None
+        self.frames = None
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
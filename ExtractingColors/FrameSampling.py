@@ -0,0 +1,114 @@
+import queue
+import re
+import threading
+import numpy as np
+from PaletteEngines import quantize_bins
+
+# Sampling modes for the streaming decoder:
+#   fps:       every frame on the fixed fps grid (the original behaviour)
+#   scene:     ffmpeg keeps a grid frame only when select='gt(scene,threshold)' sees a scene change
+#   keyframes: only I-frames are decoded (-skip_frame nokey), the cheapest mode
+#   histogram: grid frames are decoded, but a frame whose color histogram is within
+#              `threshold` of the last kept frame is dropped before any palette work
+# Dropped frames reuse the palette of the kept frame before them: a kept frame stands for
+# every grid frame up to the next kept one, which frame_weights turns into a duration weight.
+SAMPLING_MODES = ('fps', 'scene', 'keyframes', 'histogram')
+DEFAULT_THRESHOLDS = {'scene': 0.3, 'histogram': 0.1}
+
+def sampling_args(sampling, fps, threshold=None, scale=None):
+    # Returns (input options, video filter) for ffmpeg; scale is an optional scale filter
+    # that runs right after frame selection, before anything else touches the pixels
+    if sampling not in SAMPLING_MODES:
+        raise ValueError(f"Unknown sampling mode '{sampling}', expected one of {SAMPLING_MODES}")
+    if threshold is None:
+        threshold = DEFAULT_THRESHOLDS.get(sampling)
+    filters = [] if sampling == 'keyframes' else [f"fps={fps}"]
+    if scale:
+        filters.append(scale)
+    if sampling == 'scene':
+        # Always keep the first frame, which has no previous frame to differ from
+        filters.append(f"select='eq(n\\,0)+gt(scene\\,{threshold})'")
+    if uses_timestamps(sampling):
+        filters.append("showinfo")
+    input_args = ['-skip_frame', 'nokey'] if sampling == 'keyframes' else []
+    return input_args, ",".join(filters)
+
+def uses_timestamps(sampling):
+    # Modes that drop frames inside ffmpeg, so grid positions come from showinfo timestamps
+    return sampling in ('scene', 'keyframes')
+
+class TimestampReader:
+    # Drains ffmpeg's stderr on a thread and hands out the pts_time of each frame showinfo logs,
+    # in output order; everything else ffmpeg logs is kept for error reporting
+    def __init__(self, stream):
+        self.timestamps = queue.Queue()
+        self.messages = []
+        self.thread = threading.Thread(target=self.read, args=(stream,), daemon=True)
+        self.thread.start()
+
+    def read(self, stream):
+        for line in stream:
+            line = line.decode(errors='replace')
+            match = re.search(r'Parsed_showinfo.*\bn:\s*\d+.*\bpts_time:(\S+)', line)
+            if match:
+                self.timestamps.put(float(match.group(1)))
+            elif 'Parsed_showinfo' not in line:
+                self.messages.append(line.rstrip())
+        self.timestamps.put(None)
+
+    def next_timestamp(self):
+        return self.timestamps.get()
+
+    def errors(self):
+        self.thread.join()
+        return "\n".join(message for message in self.messages if 'rror' in message)
+
+class HistogramSampler:
+    # Keeps a frame only if its coarse color histogram differs from the last kept frame's
+    # by more than `threshold` (half the L1 distance, so 0 = identical and 1 = disjoint)
+    def __init__(self, threshold=0.1, bits=3, stride=8):
+        self.threshold = threshold
+        self.bits = bits
+        self.stride = stride
+        self.last_histogram = None
+
+    def histograms(self, frames):
+        count = len(frames)
+        num_bins = 1 << (3 * self.bits)
+        bins = quantize_bins(frames[:, ::self.stride, ::self.stride].reshape(count, -1, 3), self.bits)
+        bins += (np.arange(count, dtype=np.int64) * num_bins)[:, None]
+        counts = np.bincount(bins.ravel(), minlength=count * num_bins).reshape(count, num_bins)
+        return counts / bins.shape[1]
+
+    def keep(self, frames):
+        keep = np.zeros(len(frames), dtype=bool)
+        for i, histogram in enumerate(self.histograms(frames)):
+            if self.last_histogram is None or 0.5 * np.abs(histogram - self.last_histogram).sum() > self.threshold:
+                keep[i] = True
+                self.last_histogram = histogram
+        return keep
+
+def frame_weights(frame_indices, last_frame=None):
+    # Number of grid frames each kept frame stands for: the gap to the next kept frame.
+    # The final frame covers up to last_frame when it is known, otherwise just itself.
+    frame_indices = np.asarray(frame_indices, dtype=np.int64)
+    if len(frame_indices) == 0:
+        return frame_indices
+    ends = np.append(frame_indices[1:], frame_indices[-1] + 1 if last_frame is None else max(last_frame, frame_indices[-1]) + 1)
+    return ends - frame_indices
+
+class RowWeights:
+    # frame_weights of result rows that arrive in frame order, a batch at a time: the last row is
+    # held back until the next one (or finish, with the last frame of the film) shows its weight
+    def __init__(self):
+        self.pending = []
+
+    def add(self, rows):
+        # (rows, weights) of the rows whose weight is now known
+        rows = self.pending + list(rows)
+        self.pending = rows[-1:]
+        return rows[:-1], frame_weights([row[0] for row in rows])[:-1].tolist()
+
+    def finish(self, last_frame=None):
+        rows, self.pending = self.pending, []
+        return rows, frame_weights([row[0] for row in rows], last_frame).tolist()
@@ -0,0 +1,255 @@
+import json
+import logging
+import os
+import random
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Uploading frames to object storage: a small storage interface with a Google Cloud Storage
+# implementation and a local-directory stand-in, and an Uploader that pushes files through a
+# bounded thread pool with retries and records every uploaded object in a manifest.
+
+class ObjectStore:
+    # Base class: puts local files into a bucket-like namespace of object names
+    def upload(self, local_path, object_name):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class GcsStore(ObjectStore):
+    # One google-cloud-storage client shared by every upload thread, with its HTTP connection pool
+    # widened to pool_size so the threads reuse connections instead of opening new ones.
+    # endpoint points the client at a fake-gcs-server (e.g. http://localhost:4443) for offline runs.
+    def __init__(self, bucket_name, credentials_file=None, endpoint=None, pool_size=16):
+        try:
+            from google.cloud import storage
+        except ImportError as e:
+            raise ImportError("Uploading to GCS needs google-cloud-storage (pip install google-cloud-storage)") from e
+        from requests.adapters import HTTPAdapter
+
+        if endpoint:
+            from google.auth.credentials import AnonymousCredentials
+            client = storage.Client(project='fake-gcs', credentials=AnonymousCredentials(), client_options={'api_endpoint': endpoint})
+        elif credentials_file:
+            client = storage.Client.from_service_account_json(credentials_file)
+        else:
+            client = storage.Client()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        client._http.mount('https://', adapter)
+        client._http.mount('http://', adapter)
+
+        self.client = client
+        self.bucket = client.bucket(bucket_name)
+        if endpoint and not self.bucket.exists():
+            self.bucket = client.create_bucket(bucket_name)
+
+    def upload(self, local_path, object_name):
+        self.bucket.blob(object_name).upload_from_filename(local_path)
+
+    def close(self):
+        self.client.close()
+
+class LocalStore(ObjectStore):
+    # Copies objects into a directory tree; latency (seconds per upload) and failure_rate simulate
+    # a remote store, so pool sizes and retry settings can be benchmarked without a network
+    def __init__(self, root, latency=0.0, failure_rate=0.0, seed=None):
+        self.root = root
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def upload(self, local_path, object_name):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate:
+            with self.lock:
+                failed = self.random.random() < self.failure_rate
+            if failed:
+                raise ConnectionError(f"Simulated upload failure for {object_name}")
+        path = os.path.join(self.root, *object_name.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(local_path, path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+def open_store(url, **options):
+    # gs://bucket, fake-gcs://host:port/bucket, or a local directory (optionally file://...)
+    if url.startswith('gs://'):
+        return GcsStore(url[len('gs://'):].strip('/'), **options)
+    if url.startswith('fake-gcs://'):
+        host, _, bucket_name = url[len('fake-gcs://'):].partition('/')
+        return GcsStore(bucket_name.strip('/'), endpoint=f"http://{host}", **options)
+    if url.startswith('file://'):
+        url = url[len('file://'):]
+    # Credentials only mean something to a bucket; the same command line may point at a directory
+    options.pop('credentials_file', None)
+    return LocalStore(url, **options)
+
+class UploadManifest:
+    # Append-only JSON lines file, one line per uploaded frame: its object name, the object it
+    # actually lives in (itself, or a packed .tar) and its size. Loaded on start so a rerun skips
+    # every frame that is already in the bucket.
+    def __init__(self, path="upload_manifest.jsonl"):
+        self.path = path
+        self.objects = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as manifest_file:
+                for line in manifest_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # A line cut short by a crash
+                    self.objects[entry['object']] = entry
+        self.file = open(path, 'a')
+
+    def __contains__(self, object_name):
+        return object_name in self.objects
+
+    def add(self, entries):
+        with self.lock:
+            for entry in entries:
+                self.objects[entry['object']] = entry
+                self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class Uploader:
+    # Uploads files through a pool of `workers` threads sharing one store (and so one client).
+    # At most 2 * workers uploads are queued at a time: submit() blocks beyond that, which holds
+    # back whoever produces the frames. Failed uploads are retried max_retries times with
+    # exponential backoff and jitter; frames that still fail are kept on disk and listed in `failed`.
+    # pack_size > 1 packs that many frames into one .tar object per request, which is much faster
+    # for small frames when the per-request overhead dominates.
+    def __init__(self, store, manifest_path="upload_manifest.jsonl", workers=8, pack_size=1, max_retries=5, backoff=0.5, delete_local=True):
+        self.store = store
+        self.manifest = UploadManifest(manifest_path)
+        self.pack_size = pack_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.delete_local = delete_local
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix='upload')
+        self.slots = threading.BoundedSemaphore(2 * workers)
+        self.pack = []
+        self.lock = threading.Lock()
+        self.uploaded = 0
+        self.skipped = 0
+        self.bytes = 0
+        self.failed = []
+        self.started = time.time()
+
+    def submit(self, local_path, object_name):
+        if object_name in self.manifest:
+            self.skipped += 1
+            self.remove(local_path)
+            return
+        if self.pack_size > 1:
+            self.pack.append((local_path, object_name))
+            if len(self.pack) >= self.pack_size:
+                items, self.pack = self.pack, []
+                self.run(self.upload_pack, items)
+        else:
+            self.run(self.upload_file, local_path, object_name)
+
+    def upload_batch(self, items):
+        # items: (local path, object name) pairs, as queued by the extraction scripts
+        for local_path, object_name in items:
+            self.submit(local_path, object_name)
+
+    def run(self, function, *args):
+        self.slots.acquire()
+        future = self.pool.submit(function, *args)
+        future.add_done_callback(lambda _: self.slots.release())
+
+    def with_retries(self, object_name, function, *args):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return function(*args)
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                logger.warning(f"Upload of {object_name} failed ({e}); retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+                time.sleep(delay)
+
+    def upload_file(self, local_path, object_name):
+        try:
+            size = os.path.getsize(local_path)
+            self.with_retries(object_name, self.store.upload, local_path, object_name)
+        except Exception as e:
+            logger.error(f"Failed to upload {local_path}: {e}")
+            with self.lock:
+                self.failed.append(local_path)
+            return
+        self.manifest.add([{'object': object_name, 'stored_in': object_name, 'bytes': size}])
+        self.finished(1, size)
+        logger.debug(f"Uploaded {local_path} to {object_name}")
+        self.remove(local_path)
+
+    def upload_pack(self, items):
+        # The pack is named after its first frame, next to where the frames would have gone
+        first_name = items[0][1]
+        pack_name = f"{os.path.splitext(first_name)[0]}_pack{len(items)}.tar"
+        descriptor, pack_path = tempfile.mkstemp(suffix='.tar', dir=os.path.dirname(items[0][0]) or None)
+        os.close(descriptor)
+        try:
+            with tarfile.open(pack_path, 'w') as pack:
+                for local_path, object_name in items:
+                    pack.add(local_path, arcname=os.path.basename(object_name))
+            size = os.path.getsize(pack_path)
+            self.with_retries(pack_name, self.store.upload, pack_path, pack_name)
+        except Exception as e:
+            logger.error(f"Failed to upload pack {pack_name}: {e}")
+            with self.lock:
+                self.failed += [local_path for local_path, _ in items]
+            return
+        finally:
+            os.remove(pack_path)
+        self.manifest.add([{'object': object_name, 'stored_in': pack_name, 'member': os.path.basename(object_name), 'bytes': os.path.getsize(local_path)}
+                           for local_path, object_name in items])
+        self.finished(len(items), size)
+        logger.debug(f"Uploaded {len(items)} frames to {pack_name}")
+        for local_path, _ in items:
+            self.remove(local_path)
+
+    def finished(self, count, size):
+        with self.lock:
+            self.uploaded += count
+            self.bytes += size
+
+    def remove(self, local_path):
+        if self.delete_local:
+            try:
+                os.remove(local_path)
+            except OSError as e:
+                logger.warning(f"Failed to remove {local_path}: {e}")
+
+    def stats(self):
+        seconds = time.time() - self.started
+        return (f"uploaded {self.uploaded} frames ({self.bytes / 1e6:.1f} MB) in {seconds:.1f}s "
+                f"({self.uploaded / seconds if seconds else 0:.1f} frames/s), {self.skipped} already uploaded, {len(self.failed)} failed")
+
+    def close(self):
+        # Uploads the last partial pack and waits for everything in flight
+        if self.pack:
+            items, self.pack = self.pack, []
+            self.run(self.upload_pack, items)
+        self.pool.shutdown(wait=True)
+        self.manifest.close()
+        self.store.close()
+        logger.info(self.stats())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,316 @@
+import argparse
+import json
+import logging
+import os
+import sys
+
+# ghibli-colors: one command line for the whole pipeline, so a new film needs a flag or a config
+# file instead of an edit to a script.
+#   extract  decode a film and write the palette of every sampled frame
+#   resume   continue an interrupted extract from its checkpoint
+#   upload   upload a directory of frames to a bucket (gs://, fake-gcs://, file://)
+#   archive  recompute palettes from a frame archive written with extract --archive
+#   index    build or query the nearest-palette search index
+#   bench    run the pipeline or upload benchmarks
+#   pipeline run extraction or upload as a graph of stages, each with its own kind and workers
+# Settings come from flags, then from --config (JSON, or TOML on Python 3.11+), then the
+# defaults below. The config file may hold shared keys at the top level and one table per
+# command, e.g. {"fps": 3, "extract": {"video": "Howls.mkv", "engine": "numpy"}}.
+# Only the standard library is imported here. Each command imports the modules it needs when it
+# runs, so the CLI starts fast, and workers spawned by one command do not load every other
+# command's dependencies (colorthief, PIL, google-cloud, scikit-learn).
+
+COMMANDS = ('extract', 'resume', 'upload', 'archive', 'index', 'bench', 'pipeline')
+# resume continues the same film, and pipeline runs the same extraction, so both read the extract
+# table before their own
+CONFIG_TABLES = {'resume': ('extract', 'resume'), 'pipeline': ('extract', 'pipeline')}
+# Spelled out instead of imported from PaletteEngines and FrameSampling, which load numpy
+ENGINE_NAMES = ('colorthief', 'numpy', 'kmeans')
+SAMPLING_NAMES = ('fps', 'scene', 'keyframes', 'histogram')
+METRIC_NAMES = ('cie76', 'ciede2000')
+METHOD_NAMES = ('nearest', 'symmetric', 'emd')
+
+def load_config(path):
+    if os.path.splitext(path)[1].lower() == '.toml':
+        try:
+            import tomllib
+        except ImportError:
+            raise ImportError("TOML config files need Python 3.11+, use a .json config instead")
+        with open(path, "rb") as config_file:
+            return tomllib.load(config_file)
+    with open(path) as config_file:
+        return json.load(config_file)
+
+def config_defaults(config, command):
+    # Shared top-level keys, overridden by the command's own table; keys may use - or _
+    settings = {key: value for key, value in config.items() if not isinstance(value, dict)}
+    for table in CONFIG_TABLES.get(command, (command,)):
+        settings.update(config.get(table, {}))
+    return {key.replace('-', '_'): value for key, value in settings.items()}
+
+def add_extraction_arguments(parser):
+    parser.add_argument('video', nargs='?', default=None, help="Video file to extract colors from")
+    parser.add_argument('--results', default='dominant_colors.csv', help="Results file; .csv, .parquet (needs pyarrow) or .npy")
+    parser.add_argument('--checkpoint', default='checkpoint.json', help="Checkpoint manifest of the last completed frame per video")
+    parser.add_argument('--output-dir', default='frames', help="Where PNG frames are written with --png")
+    parser.add_argument('--png', action='store_true', help="Write PNG frames to --output-dir instead of streaming raw frames from ffmpeg")
+    parser.add_argument('--fps', type=float, default=3, help="Frames sampled per second of film")
+    parser.add_argument('--start-time', default='00:00:00', help="Where to start in the film, hh:mm:ss")
+    parser.add_argument('--batch-size', type=int, default=10, help="Frames per batch handed to a worker")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Number of color extraction processes (default: number of cores)")
+    parser.add_argument('--engine', choices=ENGINE_NAMES, default='colorthief', help="Palette engine")
+    parser.add_argument('--num-colors', type=int, default=10, help="Colors per palette")
+    parser.add_argument('--sampling', choices=SAMPLING_NAMES, default='fps', help="Which frames get a palette: every fps frame, scene changes, keyframes or histogram changes")
+    parser.add_argument('--threshold', type=float, default=None, help="Change threshold for the scene and histogram sampling modes")
+    parser.add_argument('--cache', default=None, help="SQLite palette cache file, reused across runs (default: no cache)")
+    parser.add_argument('--scale-width', type=int, default=None, help="Downscale frames to this width inside ffmpeg, e.g. 160 (default: full resolution)")
+    parser.add_argument('--quality', type=int, default=10, help="Pixel stride of the palette engine; 1 uses every pixel")
+    parser.add_argument('--queue-size', type=int, default=None, help="Frame batches in flight between decoder and workers (default: workers + 2)")
+    parser.add_argument('--metrics-interval', type=float, default=10, help="Seconds between progress summary lines")
+    parser.add_argument('--metrics-port', type=int, default=None, help="Serve Prometheus metrics on http://127.0.0.1:<port>/metrics")
+    parser.add_argument('--aggregate', action='store_true', help="Keep a film summary palette and per-minute/per-scene rollups up to date")
+    parser.add_argument('--archive', default=None, help="Also keep every sampled frame as a thumbnail in this archive directory")
+    parser.add_argument('--archive-width', type=int, default=160, help="Width of the archived thumbnails")
+    parser.add_argument('--regions', default=None, help="Also write palettes of frame regions, e.g. center,halves,sides,grid:3x3")
+    parser.add_argument('--render', action='store_true', help="Draw the film barcode and palette timeline while extracting")
+    parser.add_argument('--render-height', type=int, default=120, help="Height of the rendered images")
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='ghibli-colors', description="Extract, upload, index and benchmark the colors of Ghibli films.")
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--config', default=None, help="JSON or TOML file with default settings, overridden by flags")
+    common.add_argument('--verbose', action='store_true', help="Log every batch and frame (debug level)")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    commands = {}
+
+    commands['extract'] = subparsers.add_parser('extract', parents=[common], help="Extract the dominant colors of a film")
+    commands['resume'] = subparsers.add_parser('resume', parents=[common], help="Continue an interrupted extraction from its checkpoint")
+    for command in ('extract', 'resume'):
+        add_extraction_arguments(commands[command])
+
+    upload = commands['upload'] = subparsers.add_parser('upload', parents=[common], help="Upload a directory of frames to a bucket")
+    upload.add_argument('frames', nargs='?', default=None, help="Directory of frames to upload")
+    upload.add_argument('--store', default=None, help="gs://bucket, fake-gcs://host:port/bucket, file:///path or a directory")
+    upload.add_argument('--prefix', default='frames', help="Object name prefix inside the bucket")
+    upload.add_argument('--credentials', default=None, help="Service account JSON for gs:// stores")
+    upload.add_argument('--manifest', default='upload_manifest.jsonl', help="Manifest of uploaded objects; these are skipped on the next run")
+    upload.add_argument('--workers', type=int, default=16, help="Concurrent uploads")
+    upload.add_argument('--pack-size', type=int, default=1, help="Frames per uploaded object; more than 1 uploads tar packs")
+    upload.add_argument('--retries', type=int, default=5, help="Retries per object before it counts as failed")
+    upload.add_argument('--keep', action='store_true', help="Keep local frames after they are uploaded")
+
+    archive = commands['archive'] = subparsers.add_parser('archive', parents=[common], help="Recompute palettes from a frame archive without decoding the film")
+    archive.add_argument('archive', nargs='?', default=None, help="Archive directory written with extract --archive")
+    archive.add_argument('results', nargs='?', default=None, help="Results file to write; without it the archive header is printed")
+    archive.add_argument('--engine', choices=ENGINE_NAMES, default='numpy', help="Palette engine")
+    archive.add_argument('--num-colors', type=int, default=10, help="Colors per palette")
+    archive.add_argument('--quality', type=int, default=10, help="Pixel stride of the palette engine; 1 uses every pixel")
+    archive.add_argument('--fps', type=float, default=None, help="Use only this many of the archived frames per second (default: all)")
+    archive.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Number of palette processes")
+    archive.add_argument('--batch-size', type=int, default=100, help="Frames per task")
+    archive.add_argument('--cache', default=None, help="SQLite palette cache file")
+    archive.add_argument('--regions', default=None, help="Also write palettes of frame regions, e.g. center,halves,sides,grid:3x3")
+
+    index = commands['index'] = subparsers.add_parser('index', parents=[common], help="Build or query the nearest-palette search index")
+    index.add_argument('action', nargs='?', choices=['build', 'query'], default=None, help="build an index from results files, or query one")
+    index.add_argument('index', nargs='?', default=None, help="Index file, e.g. palette_index.npz")
+    index.add_argument('items', nargs='*', help="build: results files, optionally named (howls=howls.csv); query: colors as #rrggbb or r,g,b")
+    index.add_argument('--fps', type=float, default=3, help="Frames per second the results were extracted at")
+    index.add_argument('--num-colors', type=int, default=10, help="Colors per palette in the results files")
+    index.add_argument('--region', default=None, help="build: index the palettes of this region instead of whole frames")
+    index.add_argument('-k', type=int, default=10, help="Number of results")
+    index.add_argument('--min-gap', type=int, default=0, help="Minimum distance in frames between two results from the same film")
+    index.add_argument('--metric', choices=METRIC_NAMES, default='cie76', help="Color difference used to score the candidates")
+    index.add_argument('--method', choices=METHOD_NAMES, default='nearest', help="How the color differences of two palettes combine into one distance")
+
+    bench = commands['bench'] = subparsers.add_parser('bench', parents=[common], help="Benchmark the extraction pipeline or the uploader")
+    bench.add_argument('suite', nargs='?', choices=['pipeline', 'upload'], default='pipeline', help="Which benchmark to run")
+    bench.add_argument('--output', default='benchmark.json', help="JSON file for the results")
+    bench.add_argument('--compare', default=None, help="pipeline: earlier results JSON to compare frames/sec against")
+    bench.add_argument('--workers', type=int, nargs='+', default=None, help="Worker counts (pipeline) or upload pool sizes (upload)")
+    bench.add_argument('--engines', nargs='+', default=None, help="pipeline: palette engines to benchmark")
+    bench.add_argument('--duration', type=int, default=60, help="pipeline: length of each generated test video in seconds")
+    bench.add_argument('--size', default='1280x720', help="pipeline: resolution of the test videos")
+    bench.add_argument('--fps', type=float, default=3, help="pipeline: frames sampled per second of video")
+    bench.add_argument('--skip-end-to-end', action='store_true', help="pipeline: only run the isolated stage benchmarks")
+    bench.add_argument('--store', default=None, help="upload: store URL instead of the simulated local store")
+    bench.add_argument('--frames', type=int, default=500, help="upload: number of frames per case")
+    bench.add_argument('--pack-sizes', type=int, nargs='+', default=[1, 25], help="upload: frames per uploaded object to test")
+
+    pipeline = commands['pipeline'] = subparsers.add_parser('pipeline', parents=[common], help="Run the extraction or upload as a graph of configurable stages")
+    pipeline.add_argument('video', nargs='?', default=None, help="Video file")
+    pipeline.add_argument('--stage', action='append', default=[], help="Add or configure a stage, e.g. render or palette:kind=thread,workers=4 (repeatable)")
+    pipeline.add_argument('--resume', action='store_true', help="Continue from the last checkpoint instead of starting over")
+    pipeline.add_argument('--results', default='dominant_colors.csv', help="Results file; .csv, .parquet (needs pyarrow) or .npy")
+    pipeline.add_argument('--checkpoint', default='checkpoint.json', help="Checkpoint manifest of the last completed frame per video")
+    pipeline.add_argument('--output-dir', default=None, help="Write PNG frames here instead of streaming raw frames (default 'frames' with the upload stage)")
+    pipeline.add_argument('--fps', type=float, default=3, help="Frames sampled per second of film")
+    pipeline.add_argument('--start-time', default='00:00:00', help="Where to start in the film, hh:mm:ss")
+    pipeline.add_argument('--batch-size', type=int, default=10, help="Frames per batch")
+    pipeline.add_argument('--engine', choices=ENGINE_NAMES, default='colorthief', help="Palette engine")
+    pipeline.add_argument('--num-colors', type=int, default=10, help="Colors per palette")
+    pipeline.add_argument('--sampling', choices=SAMPLING_NAMES, default='fps', help="Which frames get a palette: every fps frame, scene changes, keyframes or histogram changes")
+    pipeline.add_argument('--threshold', type=float, default=None, help="Change threshold for the scene and histogram sampling modes")
+    pipeline.add_argument('--cache', default=None, help="SQLite palette cache file, reused across runs (default: no cache)")
+    pipeline.add_argument('--scale-width', type=int, default=None, help="Downscale frames to this width inside ffmpeg, e.g. 160 (default: full resolution)")
+    pipeline.add_argument('--quality', type=int, default=10, help="Pixel stride of the palette engine; 1 uses every pixel")
+    pipeline.add_argument('--regions', default=None, help="Also write palettes of frame regions, e.g. center,halves,sides,grid:3x3")
+    pipeline.add_argument('--aggregate', action='store_true', help="Keep a film summary palette and per-minute/per-scene rollups up to date")
+    pipeline.add_argument('--queue-size', type=int, default=None, help="Frame batches in flight between decoder and palette workers, unless --stage sets it")
+    pipeline.add_argument('--archive', default=None, help="archive stage: keep every sampled frame as a thumbnail in this archive directory")
+    pipeline.add_argument('--archive-width', type=int, default=160, help="archive stage: width of the archived thumbnails")
+    pipeline.add_argument('--render-height', type=int, default=120, help="render stage: height of the rendered images")
+    pipeline.add_argument('--store', default=None, help="upload stage: gs://bucket, fake-gcs://host:port/bucket, file:///path or a directory")
+    pipeline.add_argument('--prefix', default='frames', help="upload stage: object name prefix inside the bucket")
+    pipeline.add_argument('--credentials', default=None, help="upload stage: service account JSON for gs:// stores")
+    pipeline.add_argument('--manifest', default='upload_manifest.jsonl', help="upload stage: manifest of uploaded objects")
+    pipeline.add_argument('--retries', type=int, default=5, help="upload stage: retries per object before it counts as failed")
+    pipeline.add_argument('--keep', action='store_true', help="upload stage: keep local frames after they are uploaded")
+    pipeline.add_argument('--metrics-interval', type=float, default=10, help="Seconds between progress summary lines")
+    pipeline.add_argument('--metrics-port', type=int, default=None, help="Serve Prometheus metrics on http://127.0.0.1:<port>/metrics")
+    # Stage settings from the config file, e.g. "stages": {"palette": {"workers": 12}, "render": {}}
+    pipeline.set_defaults(stages=None)
+    return parser, commands
+
+def parse_args(argv=None):
+    parser, commands = build_parser()
+    # --config has to be read before the real parse, so its settings can become the defaults
+    pre_parser = argparse.ArgumentParser(add_help=False)
+    pre_parser.add_argument('--config', default=None)
+    known, _ = pre_parser.parse_known_args(argv)
+    if known.config:
+        config = load_config(known.config)
+        for key in config:
+            if isinstance(config[key], dict) and key not in COMMANDS:
+                parser.error(f"Unknown command table '{key}' in {known.config}, expected one of {COMMANDS}")
+        for command, subparser in commands.items():
+            settings = config_defaults(config, command)
+            options = {action.dest for action in subparser._actions} | set(subparser._defaults)
+            # argparse checks choices only for values given on the command line, not for defaults
+            for action in subparser._actions:
+                if action.choices and action.dest in settings and settings[action.dest] not in action.choices:
+                    parser.error(f"Invalid {action.dest} '{settings[action.dest]}' in {known.config}, expected one of {tuple(action.choices)}")
+            subparser.set_defaults(**{key: value for key, value in settings.items() if key in options})
+    args = parser.parse_args(argv)
+    return parser, args
+
+def run_extract(args, resume=False):
+    from ExtractColors import run_extraction
+    run_extraction(args.video, args.output_dir, args.results, fps=args.fps, start_time=args.start_time, batch_size=args.batch_size,
+                   num_workers=max(1, args.workers), engine=args.engine, num_colors=args.num_colors, stream=not args.png,
+                   checkpoint_file=args.checkpoint, resume=resume, sampling=args.sampling, threshold=args.threshold,
+                   cache_file=args.cache, scale_width=args.scale_width, quality=max(1, args.quality),
+                   queue_size=args.queue_size, metrics_interval=args.metrics_interval, metrics_port=args.metrics_port,
+                   log_level=args.log_level, aggregate=args.aggregate, archive_path=args.archive, archive_width=args.archive_width,
+                   regions=args.regions, render=args.render, render_height=args.render_height)
+
+def run_stages(args):
+    from PipelineStages import parse_stage_option, run_pipeline
+    # Config stages (a list of names or a table per stage), then --stage flags on top
+    stages = args.stages or {}
+    stages = {name: dict(settings or {}) for name, settings in stages.items()} if isinstance(stages, dict) else {name: {} for name in stages}
+    for option in args.stage:
+        name, settings = parse_stage_option(option)
+        stages.setdefault(name, {}).update(settings)
+    run_pipeline(args.video, args.results, stages, fps=args.fps, start_time=args.start_time, batch_size=args.batch_size, engine=args.engine,
+                 num_colors=args.num_colors, sampling=args.sampling, threshold=args.threshold, cache_file=args.cache,
+                 scale_width=args.scale_width, quality=max(1, args.quality), regions=args.regions, output_dir=args.output_dir,
+                 checkpoint_file=args.checkpoint, resume=args.resume, aggregate=args.aggregate, render_height=args.render_height,
+                 store=args.store, prefix=args.prefix, manifest_path=args.manifest, credentials_file=args.credentials,
+                 max_retries=args.retries, keep_frames=args.keep, metrics_interval=args.metrics_interval, metrics_port=args.metrics_port,
+                 log_level=args.log_level, queue_size=args.queue_size, archive_path=args.archive, archive_width=args.archive_width)
+
+def run_archive(args):
+    from FrameArchive import FrameArchive, recompute_palettes
+    if args.results is None:
+        archive = FrameArchive(args.archive)
+        print(json.dumps(dict(archive.meta, count=len(archive)), indent=2))
+        return
+    recompute_palettes(args.archive, args.results, args.engine, args.num_colors, max(1, args.quality), args.fps,
+                       max(1, args.workers), args.batch_size, args.cache, args.log_level, args.regions)
+
+def run_upload(args):
+    from FrameUploader import Uploader, open_store
+    options = {'credentials_file': args.credentials} if args.credentials else {}
+    names = sorted(name for name in os.listdir(args.frames) if os.path.isfile(os.path.join(args.frames, name)))
+    with Uploader(open_store(args.store, **options), args.manifest, workers=args.workers, pack_size=args.pack_size,
+                  max_retries=args.retries, delete_local=not args.keep) as uploader:
+        uploader.upload_batch((os.path.join(args.frames, name), f"{args.prefix}/{name}") for name in names)
+    if uploader.failed:
+        print(f"{len(uploader.failed)} frames could not be uploaded and were left on disk")
+
+def run_index(parser, args):
+    from PaletteIndex import PaletteIndex, format_seconds, parse_color
+    if args.action == 'build':
+        index = PaletteIndex(args.num_colors)
+        for result in args.items:
+            name, _, path = result.rpartition('=')
+            index.add_results(path, name or None, args.fps, args.region)
+        index.save(args.index)
+        print(f"Indexed {len(index.frame_indices)} frames of {len(index.films)} films into {args.index}")
+        return
+    if not args.items:
+        parser.error("index query needs at least one color")
+    index = PaletteIndex.load(args.index)
+    results = index.search([parse_color(color) for color in args.items], args.k, args.min_gap, metric=args.metric, method=args.method)
+    for result in results:
+        when = format_seconds(result['seconds']) if result['seconds'] is not None else ""
+        colors = " ".join(f"#{r:02x}{g:02x}{b:02x}" for r, g, b in result['palette'])
+        print(f"{result['distance']:6.2f}  {result['film']}  frame {result['frame_index']} {when}  {colors}")
+
+def run_bench(args):
+    import tempfile
+    if args.suite == 'pipeline':
+        from Benchmark import compare_results, run_benchmarks
+        from PaletteEngines import ENGINES
+        report = run_benchmarks(tempfile.gettempdir(), ['testsrc', 'mandelbrot'], args.duration, args.size, args.fps,
+                                args.engines or sorted(ENGINES), args.workers or sorted({1, os.cpu_count() or 1}), [None, 160],
+                                args.skip_end_to_end)
+        if args.compare:
+            with open(args.compare) as json_file:
+                compare_results(json.load(json_file), report)
+    else:
+        from UploadBenchmark import run_case
+        results = []
+        with tempfile.TemporaryDirectory() as directory:
+            for workers in args.workers or [1, 8, 32]:
+                for pack_size in args.pack_sizes:
+                    results.append(run_case(directory, args.store, args.frames, 200 * 1024, workers, pack_size, 0.05, 0.02))
+                    print(json.dumps(results[-1]))
+        report = results
+    with open(args.output, "w") as json_file:
+        json.dump(report, json_file, indent=2)
+    print(f"Results written to {args.output}")
+
+def main(argv=None):
+    parser, args = parse_args(argv)
+    from PipelineMetrics import configure_logging
+    args.log_level = logging.DEBUG if args.verbose else logging.INFO
+    configure_logging(args.log_level)
+
+    # Positional settings may come from the config file, so they are checked here
+    required = {'extract': ('video', "a video file"), 'resume': ('video', "a video file"),
+                'upload': ('frames', "a frames directory"), 'archive': ('archive', "an archive directory"), 'index': ('index', "an index file"),
+                'pipeline': ('video', "a video file")}
+    if args.command in required and getattr(args, required[args.command][0]) is None:
+        parser.error(f"{args.command} needs {required[args.command][1]} (argument or config file)")
+    if args.command == 'upload' and args.store is None:
+        parser.error("upload needs --store (flag or config file)")
+    if args.command == 'index' and args.action is None:
+        parser.error("index needs an action: build or query")
+
+    if args.command in ('extract', 'resume'):
+        run_extract(args, resume=args.command == 'resume')
+    elif args.command == 'upload':
+        run_upload(args)
+    elif args.command == 'archive':
+        run_archive(args)
+    elif args.command == 'index':
+        run_index(parser, args)
+    elif args.command == 'pipeline':
+        run_stages(args)
+    else:
+        run_bench(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,77 @@
+import hashlib
+import sqlite3
+import time
+import numpy as np
+
+class PaletteCache:
+    # Persistent palette cache in SQLite, keyed by a hash of the downsampled frame plus the
+    # palette parameters. Holds at most max_entries palettes; the least recently used go first.
+    # Safe to share between worker processes: each opens its own connection and SQLite's WAL
+    # journal lets readers and the single writer proceed concurrently.
+    # Counting the table is a full scan, so the bound is only enforced every check_every inserted
+    # palettes (and once at open); each process may overshoot it by that many until then.
+    def __init__(self, path="palette_cache.sqlite", max_entries=1000000, grid=16, check_every=1000):
+        self.path = path
+        self.max_entries = max_entries
+        self.grid = grid
+        self.check_every = check_every
+        self.unchecked = 0
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS palettes (key BLOB PRIMARY KEY, palette BLOB NOT NULL, last_used REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS palettes_last_used ON palettes (last_used)")
+        self.evict()
+        self.connection.commit()
+
+    def frame_keys(self, frames, parameters):
+        # Mean color of each cell of a grid x grid layout, quantized to 5 bits per channel, so
+        # re-encodes of the same frame (and repeated black or credit frames) share a key
+        count, height, width, _ = frames.shape
+        cell_height, cell_width = max(1, height // self.grid), max(1, width // self.grid)
+        rows, columns = height // cell_height, width // cell_width
+        cells = frames[:, :rows * cell_height, :columns * cell_width].reshape(count, rows, cell_height, columns, cell_width, 3)
+        thumbnails = (cells.mean(axis=(2, 4)).astype(np.uint8) >> 3).reshape(count, -1)
+        prefix = repr(parameters).encode()
+        return [hashlib.blake2b(prefix + thumbnail.tobytes(), digest_size=16).digest() for thumbnail in thumbnails]
+
+    def get_many(self, keys):
+        found = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for key, palette in self.connection.execute(f"SELECT key, palette FROM palettes WHERE key IN ({placeholders})", chunk):
+                found[key] = [tuple(color) for color in np.frombuffer(palette, dtype=np.uint16).reshape(-1, 3).tolist()]
+        if found:
+            now = time.time()
+            self.connection.executemany("UPDATE palettes SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+            self.connection.commit()
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items):
+        now = time.time()
+        # uint16, because ColorThief's median cut can return channel values of 256
+        rows = [(key, np.array(palette, dtype=np.uint16).tobytes(), now) for key, palette in items if palette]
+        self.connection.executemany("INSERT OR REPLACE INTO palettes (key, palette, last_used) VALUES (?, ?, ?)", rows)
+        self.unchecked += len(rows)
+        if self.unchecked >= self.check_every:
+            self.evict()
+        self.connection.commit()
+
+    def evict(self):
+        # Drops the least recently used palettes above max_entries; the caller commits
+        self.unchecked = 0
+        excess = self.connection.execute("SELECT COUNT(*) FROM palettes").fetchone()[0] - self.max_entries
+        if excess > 0:
+            self.connection.execute("DELETE FROM palettes WHERE key IN (SELECT key FROM palettes ORDER BY last_used LIMIT ?)", (excess,))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        rate = 100 * self.hits / lookups if lookups else 0
+        return f"palette cache {self.path}: {self.hits} hits, {self.misses} misses ({rate:.1f}% hit rate)"
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,209 @@
+import logging
+import warnings
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+class PaletteEngine:
+    # Base class: turns a batch of uint8 RGB frames of shape (n, height, width, 3)
+    # into one palette per frame, each a list of num_colors (r, g, b) tuples
+    name = None
+
+    def __init__(self, num_colors=10, quality=10):
+        self.num_colors = num_colors
+        self.quality = quality
+
+    def palettes(self, frames):
+        raise NotImplementedError
+
+    def palettes_from_paths(self, image_paths):
+        return self.palettes(load_frames(image_paths))
+
+    def close(self):
+        pass
+
+    def sample_pixels(self, frame):
+        # Every quality-th pixel, minus the near-white ones, like ColorThief does
+        pixels = frame.reshape(-1, 3)[::self.quality]
+        return pixels[~np.all(pixels > 250, axis=1)]
+
+class ColorThiefEngine(PaletteEngine):
+    # Reference backend: ColorThief's pure-Python median cut (MMCQ). colorthief and PIL are imported
+    # on first use, so processes running the other engines never load them.
+    name = 'colorthief'
+
+    def palette(self, frame):
+        from colorthief import MMCQ
+        try:
+            return MMCQ.quantize(self.sample_pixels(frame).tolist(), self.num_colors).palette
+        except Exception as e:
+            logger.warning(f"Error extracting colors from frame array: {e}")
+            return []
+
+    def palettes(self, frames):
+        return [self.palette(frame) for frame in frames]
+
+    def palettes_from_paths(self, image_paths):
+        from colorthief import ColorThief
+        palettes = []
+        for image_path in image_paths:
+            try:
+                color_thief = ColorThief(image_path)
+                palettes.append(color_thief.get_palette(color_count=self.num_colors, quality=self.quality))
+            except Exception as e:
+                logger.warning(f"Error extracting colors from {image_path}: {e}")
+                palettes.append([])
+        return palettes
+
+class HistogramEngine(PaletteEngine):
+    # Vectorized backend: quantizes every pixel of the whole batch to `bits` per channel,
+    # counts the bins with one bincount and returns the mean color of the most populated bins
+    name = 'numpy'
+
+    def __init__(self, num_colors=10, quality=10, bits=4):
+        super().__init__(num_colors, quality)
+        self.bits = bits
+
+    def palettes(self, frames):
+        frames = np.asarray(frames, dtype=np.uint8)
+        count = len(frames)
+        if count == 0:
+            return []
+
+        # A 2D stride of sqrt(quality) keeps roughly the same pixel budget as ColorThief
+        stride = max(1, int(round(np.sqrt(self.quality))))
+        pixels = frames[:, ::stride, ::stride].reshape(count, -1, 3)
+        valid = ~np.all(pixels > 250, axis=2)
+
+        num_bins = 1 << (3 * self.bits)
+        bins = quantize_bins(pixels, self.bits)
+        bins += (np.arange(count, dtype=np.int64) * num_bins)[:, None]
+
+        bins = bins[valid]
+        pixels = pixels[valid]
+        total_bins = count * num_bins
+        counts = np.bincount(bins, minlength=total_bins).reshape(count, num_bins)
+        sums = np.stack(
+            [np.bincount(bins, weights=pixels[:, channel], minlength=total_bins) for channel in range(3)],
+            axis=1
+        ).reshape(count, num_bins, 3)
+
+        k = min(self.num_colors, num_bins)
+        top = np.argpartition(-counts, k - 1, axis=1)[:, :k]
+        top_counts = np.take_along_axis(counts, top, axis=1)
+        order = np.argsort(-top_counts, axis=1, kind='stable')
+        top = np.take_along_axis(top, order, axis=1)
+        top_counts = np.take_along_axis(top_counts, order, axis=1)
+        top_sums = np.take_along_axis(sums, top[..., None], axis=1)
+
+        palettes = []
+        for frame_counts, frame_sums in zip(top_counts, top_sums):
+            used = frame_counts > 0
+            if not used.any():
+                palettes.append([])
+                continue
+            colors = np.rint(frame_sums[used] / frame_counts[used][:, None]).astype(int)
+            palettes.append(pad_palette([tuple(color) for color in colors.tolist()], self.num_colors))
+        return palettes
+
+class KMeansEngine(PaletteEngine):
+    # Vectorized backend: MiniBatchKMeans over (at most max_pixels of) the sampled pixels
+    # of each frame, colors ordered by cluster size
+    name = 'kmeans'
+
+    def __init__(self, num_colors=10, quality=10, max_pixels=4096, random_state=0):
+        super().__init__(num_colors, quality)
+        self.max_pixels = max_pixels
+        self.random_state = random_state
+
+    def palette(self, frame):
+        from sklearn.cluster import MiniBatchKMeans
+
+        pixels = self.sample_pixels(frame)
+        step = max(1, -(-len(pixels) // self.max_pixels))  # Ceiling division
+        pixels = pixels[::step].astype(np.float32)
+        if len(pixels) == 0:
+            return []
+        if len(np.unique(pixels, axis=0)) <= self.num_colors:
+            colors, counts = np.unique(pixels.astype(int), axis=0, return_counts=True)
+            colors = colors[np.argsort(-counts, kind='stable')]
+            return pad_palette([tuple(color) for color in colors.tolist()], self.num_colors)
+
+        kmeans = MiniBatchKMeans(n_clusters=self.num_colors, n_init=1, batch_size=1024, max_no_improvement=3, random_state=self.random_state)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            labels = kmeans.fit_predict(pixels)
+        sizes = np.bincount(labels, minlength=self.num_colors)
+        centers = np.clip(np.rint(kmeans.cluster_centers_), 0, 255).astype(int)
+        centers = centers[np.argsort(-sizes, kind='stable')]
+        return [tuple(color) for color in centers.tolist()]
+
+    def palettes(self, frames):
+        return [self.palette(frame) for frame in frames]
+
+class CachedEngine(PaletteEngine):
+    # Looks every frame up in a PaletteCache first and only sends the misses to the wrapped engine
+    def __init__(self, engine, cache):
+        super().__init__(engine.num_colors, engine.quality)
+        self.engine = engine
+        self.cache = cache
+        self.name = engine.name
+        self.parameters = (engine.name, engine.num_colors, engine.quality)
+
+    def palettes(self, frames):
+        frames = np.asarray(frames, dtype=np.uint8)
+        keys = self.cache.frame_keys(frames, self.parameters)
+        found = self.cache.get_many(keys)
+
+        missing = [i for i, key in enumerate(keys) if key not in found]
+        if missing:
+            computed = self.engine.palettes(frames[missing])
+            self.cache.put_many([(keys[i], palette) for i, palette in zip(missing, computed)])
+            for i, palette in zip(missing, computed):
+                found[keys[i]] = palette
+        return [found[key] for key in keys]
+
+    def palettes_from_paths(self, image_paths):
+        # Hashing needs the pixels anyway, so decode once and use the array path of the engine
+        return self.palettes(load_frames(image_paths))
+
+    def close(self):
+        logger.info(self.cache.stats())
+        self.cache.close()
+        self.engine.close()
+
+ENGINES = {engine.name: engine for engine in (ColorThiefEngine, HistogramEngine, KMeansEngine)}
+
+def get_engine(name='colorthief', num_colors=10, quality=10, cache_file=None):
+    if name not in ENGINES:
+        raise ValueError(f"Unknown palette engine '{name}', expected one of {sorted(ENGINES)}")
+    engine = ENGINES[name](num_colors=num_colors, quality=quality)
+    if cache_file:
+        from PaletteCache import PaletteCache
+        engine = CachedEngine(engine, PaletteCache(cache_file))
+    return engine
+
+def load_frames(image_paths):
+    from PIL import Image
+    return np.stack([np.asarray(Image.open(image_path).convert('RGB')) for image_path in image_paths])
+
+def pad_palette(palette, num_colors):
+    # Repeat the last color so every palette has the same number of columns
+    if palette and len(palette) < num_colors:
+        palette = palette + [palette[-1]] * (num_colors - len(palette))
+    return palette
+
+def palette_distance(reference, candidate):
+    # Mean RGB distance from each reference color to its closest candidate color
+    if not reference or not candidate:
+        return float('nan')
+    reference = np.asarray(reference, dtype=np.float64)
+    candidate = np.asarray(candidate, dtype=np.float64)
+    distances = np.linalg.norm(reference[:, None, :] - candidate[None, :, :], axis=2)
+    return float(distances.min(axis=1).mean())
+
+def quantize_bins(pixels, bits):
+    # Bin number of every (..., 3) RGB pixel on a grid of 2**bits levels per channel, as int64
+    # in [0, 2**(3 * bits)); shared by the histogram engine, sampler and film histogram
+    quantized = (np.asarray(pixels) >> (8 - bits)).astype(np.int64)
+    return (quantized[..., 0] << (2 * bits)) | (quantized[..., 1] << bits) | quantized[..., 2]
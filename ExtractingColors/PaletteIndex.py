@@ -0,0 +1,144 @@
+import argparse
+import os
+import time
+import numpy as np
+from ColorSpaces import METRICS, palette_set_distance, rgb_to_lab
+from ResultSinks import load_palettes
+
+# Nearest-palette search over the results of any number of films. Every palette color is stored
+# in CIELAB, where Euclidean distance is the CIE76 color difference (about 2.3 = just noticeable),
+# and all of them go into one scikit-learn KD-tree. A query is a garment color or a 3-5 color
+# outfit; a frame scores the mean distance from each query color to its closest palette color, or
+# any other palette distance from ColorSpaces (CIEDE2000 differences, earth mover's distance).
+
+class PaletteIndex:
+    def __init__(self, num_colors=10):
+        self.num_colors = num_colors
+        self.films = []
+        self.film_fps = []
+        self.film_ids = np.empty(0, dtype=np.int32)
+        self.frame_indices = np.empty(0, dtype=np.int64)
+        self.palettes = np.empty((0, num_colors, 3), dtype=np.uint8)
+        self.lab = np.empty((0, num_colors, 3), dtype=np.float32)
+        self.tree = None
+
+    def add_film(self, name, frame_indices, palettes, fps=None):
+        # fps of the extraction run, if known, turns frame indices into timestamps in the results
+        palettes = np.asarray(palettes, dtype=np.uint8)[:, :self.num_colors]
+        self.films.append(name)
+        self.film_fps.append(fps)
+        self.film_ids = np.concatenate([self.film_ids, np.full(len(palettes), len(self.films) - 1, dtype=np.int32)])
+        self.frame_indices = np.concatenate([self.frame_indices, np.asarray(frame_indices, dtype=np.int64)])
+        self.palettes = np.concatenate([self.palettes, palettes])
+        self.lab = np.concatenate([self.lab, rgb_to_lab(palettes).astype(np.float32)])
+        self.tree = None
+
+    def add_results(self, path, name=None, fps=None, region=None):
+        # Any result sink file (.csv, .parquet or .npy); the film is named after the file by default.
+        # region indexes the palettes of one frame region (e.g. center) instead of the whole frame.
+        frame_indices, palettes = load_palettes(path, self.num_colors, region=region)
+        self.add_film(name or os.path.splitext(os.path.basename(path))[0], frame_indices, palettes, fps)
+
+    def build(self):
+        from sklearn.neighbors import KDTree
+        self.tree = KDTree(self.lab.reshape(-1, 3))
+        return self
+
+    def search(self, colors, k=10, min_gap=0, candidates=None, metric='cie76', method='nearest'):
+        # colors: one (r, g, b) garment color or a list of them. The tree supplies the frames that own
+        # the `candidates` palette colors nearest to each query color (default: enough for k results
+        # with room for min_gap pruning); those are then scored exactly and the best k returned.
+        # min_gap: skip hits less than this many frames from a better hit in the same film, so the
+        # results are different scenes rather than neighbouring frames of one shot.
+        # metric and method choose how the candidates are scored, see palette_set_distance.
+        if self.tree is None:
+            self.build()
+        query = rgb_to_lab(np.asarray(colors, dtype=np.float64).reshape(-1, 3))
+        total_colors = len(self.lab) * self.num_colors
+        if total_colors == 0:
+            return []
+        if candidates is None:
+            candidates = 50 * k * self.num_colors
+        _, nearest = self.tree.query(query, k=min(candidates, total_colors))
+        frames = np.unique(nearest // self.num_colors)
+
+        scores = palette_set_distance(query[None], self.lab[frames], metric, method)
+
+        results = []
+        kept = []
+        for position in np.argsort(scores, kind='stable'):
+            frame = frames[position]
+            film_id, frame_index = self.film_ids[frame], self.frame_indices[frame]
+            if min_gap and any(film_id == other_film and abs(frame_index - other_index) < min_gap for other_film, other_index in kept):
+                continue
+            kept.append((film_id, frame_index))
+            fps = self.film_fps[film_id]
+            results.append({
+                'film': self.films[film_id],
+                'frame_index': int(frame_index),
+                'seconds': (frame_index - 1) / fps if fps else None,
+                'distance': float(scores[position]),
+                'palette': [tuple(color) for color in self.palettes[frame].tolist()],
+            })
+            if len(results) == k:
+                break
+        return results
+
+    def save(self, path):
+        np.savez(path, films=np.array(self.films), film_fps=np.array([fps or np.nan for fps in self.film_fps], dtype=np.float64),
+                 film_ids=self.film_ids, frame_indices=self.frame_indices, palettes=self.palettes)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        index = cls(num_colors=data['palettes'].shape[1])
+        for film_id, (name, fps) in enumerate(zip(data['films'].tolist(), data['film_fps'].tolist())):
+            rows = data['film_ids'] == film_id
+            index.add_film(name, data['frame_indices'][rows], data['palettes'][rows], None if np.isnan(fps) else fps)
+        return index.build()
+
+def parse_color(text):
+    # '#rrggbb', 'rrggbb' or 'r,g,b'
+    if ',' in text:
+        return tuple(int(value) for value in text.split(','))
+    text = text.lstrip('#')
+    return tuple(int(text[i:i + 2], 16) for i in (0, 2, 4))
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(seconds, 60)
+    return f"{int(minutes // 60):02d}:{int(minutes % 60):02d}:{seconds:05.2f}"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or query a nearest-palette index over extracted film colors.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help="Index one or more results files")
+    build_parser.add_argument('index', help="Index file to write, e.g. palette_index.npz")
+    build_parser.add_argument('results', nargs='+', help="Results files, optionally named: howls=howls_dominant_colors.csv")
+    build_parser.add_argument('--fps', type=float, default=3, help="Frames per second the results were extracted at")
+    build_parser.add_argument('--num-colors', type=int, default=10, help="Colors per palette in the results files")
+    build_parser.add_argument('--region', default=None, help="Index the palettes of this region (written with --regions) instead of whole frames")
+    query_parser = subparsers.add_parser('query', help="Find the frames closest to a color or an outfit")
+    query_parser.add_argument('index', help="Index file written by build")
+    query_parser.add_argument('colors', nargs='+', help="Garment colors as #rrggbb or r,g,b")
+    query_parser.add_argument('-k', type=int, default=10, help="Number of results")
+    query_parser.add_argument('--min-gap', type=int, default=0, help="Minimum distance in frames between two results from the same film")
+    query_parser.add_argument('--metric', choices=METRICS, default='cie76', help="Color difference used to score the candidates")
+    query_parser.add_argument('--method', choices=['nearest', 'symmetric', 'emd'], default='nearest', help="How the color differences of two palettes combine into one distance")
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        index = PaletteIndex(args.num_colors)
+        for result in args.results:
+            name, _, path = result.rpartition('=')
+            index.add_results(path, name or None, args.fps, args.region)
+        index.save(args.index)
+        print(f"Indexed {len(index.frame_indices)} frames of {len(index.films)} films into {args.index}")
+    else:
+        index = PaletteIndex.load(args.index)
+        started = time.perf_counter()
+        results = index.search([parse_color(color) for color in args.colors], args.k, args.min_gap, metric=args.metric, method=args.method)
+        print(f"{len(results)} results in {1000 * (time.perf_counter() - started):.1f} ms")
+        for result in results:
+            when = format_seconds(result['seconds']) if result['seconds'] is not None else ""
+            colors = " ".join(f"#{r:02x}{g:02x}{b:02x}" for r, g, b in result['palette'])
+            print(f"{result['distance']:6.2f}  {result['film']}  frame {result['frame_index']} {when}  {colors}")
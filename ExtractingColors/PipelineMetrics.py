@@ -0,0 +1,174 @@
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Array, Lock, Value
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('decode', 'palette', 'sink')
+# Upper bounds (seconds) of the per-batch latency histogram buckets; the last one catches the rest
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+def configure_logging(level=logging.INFO):
+    # No-op when the process already has handlers (e.g. a worker forked from a configured parent)
+    logging.basicConfig(level=level, format="%(asctime)s %(processName)s %(levelname)s %(message)s")
+
+def format_duration(seconds):
+    if seconds is None:
+        return "--:--:--"
+    hours, remainder = divmod(int(seconds), 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+class PipelineMetrics:
+    # Frame counters and per-batch latency histograms for each pipeline stage, kept in shared
+    # memory so the decoder, the palette workers and the writer can all record into one object.
+    # Pass it to the child processes as a Process argument.
+    def __init__(self, total_frames=None):
+        self.total_frames = total_frames
+        self.started = time.time()
+        self.lock = Lock()
+        self.frames = {stage: Value('q', 0, lock=False) for stage in STAGES}
+        self.batches = {stage: Value('q', 0, lock=False) for stage in STAGES}
+        self.seconds = {stage: Value('d', 0.0, lock=False) for stage in STAGES}
+        self.buckets = {stage: Array('q', len(BUCKETS), lock=False) for stage in STAGES}
+
+    def observe(self, stage, seconds, frames):
+        bucket = next(i for i, bound in enumerate(BUCKETS) if seconds <= bound)
+        with self.lock:
+            self.frames[stage].value += frames
+            self.batches[stage].value += 1
+            self.seconds[stage].value += seconds
+            self.buckets[stage][bucket] += 1
+
+    def quantile(self, stage, q):
+        # Upper bound of the bucket holding the q-th quantile of batch latencies
+        counts = list(self.buckets[stage])
+        total = sum(counts)
+        if total == 0:
+            return None
+        running = 0
+        for bound, count in zip(BUCKETS, counts):
+            running += count
+            if running >= q * total:
+                return bound
+        return BUCKETS[-1]
+
+    def snapshot(self, queue_depth=None):
+        elapsed = time.time() - self.started
+        with self.lock:
+            stages = {}
+            for stage in STAGES:
+                frames = self.frames[stage].value
+                batches = self.batches[stage].value
+                stages[stage] = {
+                    'frames': frames,
+                    'frames_per_second': frames / elapsed if elapsed > 0 else 0.0,
+                    'batches': batches,
+                    'mean_batch_seconds': self.seconds[stage].value / batches if batches else None,
+                    'p50_batch_seconds': self.quantile(stage, 0.5),
+                    'p95_batch_seconds': self.quantile(stage, 0.95),
+                    'histogram': list(self.buckets[stage]),
+                }
+        processed = stages['sink']['frames']
+        rate = stages['sink']['frames_per_second']
+        eta = None
+        if self.total_frames and rate > 0:
+            eta = max(0.0, (self.total_frames - processed) / rate)
+        return {'elapsed_seconds': elapsed, 'total_frames': self.total_frames, 'queue_depth': queue_depth, 'eta_seconds': eta, 'stages': stages}
+
+    def summary_line(self, snapshot):
+        stages = snapshot['stages']
+        progress = f"{stages['sink']['frames']}"
+        if snapshot['total_frames']:
+            progress += f"/{snapshot['total_frames']} ({100 * stages['sink']['frames'] / snapshot['total_frames']:.1f}%)"
+        palette_p50 = stages['palette']['p50_batch_seconds']
+        return (f"decoded {stages['decode']['frames']} ({stages['decode']['frames_per_second']:.1f}/s) | "
+                f"processed {stages['palette']['frames']} ({stages['palette']['frames_per_second']:.1f}/s) | "
+                f"written {progress} | queue {'?' if snapshot['queue_depth'] is None else snapshot['queue_depth']} | "
+                f"palette p50 <= {'-' if palette_p50 is None else f'{palette_p50:g}s'}/batch | "
+                f"elapsed {format_duration(snapshot['elapsed_seconds'])} | ETA {format_duration(snapshot['eta_seconds'])}")
+
+    def prometheus_text(self, snapshot):
+        lines = [
+            "# TYPE ghibli_frames_total counter",
+            *[f'ghibli_frames_total{{stage="{stage}"}} {values["frames"]}' for stage, values in snapshot['stages'].items()],
+            "# TYPE ghibli_queue_depth gauge",
+            f"ghibli_queue_depth {-1 if snapshot['queue_depth'] is None else snapshot['queue_depth']}",
+            "# TYPE ghibli_eta_seconds gauge",
+            f"ghibli_eta_seconds {-1 if snapshot['eta_seconds'] is None else snapshot['eta_seconds']:.1f}",
+            "# TYPE ghibli_batch_seconds histogram",
+        ]
+        for stage in STAGES:
+            running = 0
+            for bound, count in zip(BUCKETS, snapshot['stages'][stage]['histogram']):
+                running += count
+                le = "+Inf" if bound == float('inf') else f"{bound:g}"
+                lines.append(f'ghibli_batch_seconds_bucket{{stage="{stage}",le="{le}"}} {running}')
+            lines.append(f'ghibli_batch_seconds_sum{{stage="{stage}"}} {self.seconds[stage].value:.6f}')
+            lines.append(f'ghibli_batch_seconds_count{{stage="{stage}"}} {running}')
+        return "\n".join(lines) + "\n"
+
+class MetricsReporter:
+    # Logs a summary line every `interval` seconds and, if a port is given, serves the metrics on
+    # http://127.0.0.1:<port>/metrics (Prometheus text) and /metrics.json until stop() is called
+    def __init__(self, metrics, frame_queue=None, interval=10, port=None):
+        self.metrics = metrics
+        self.frame_queue = frame_queue
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.server = None
+        if port:
+            self.server = ThreadingHTTPServer(('127.0.0.1', port), self.handler())
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            logger.info(f"Serving metrics on http://127.0.0.1:{port}/metrics")
+
+    def queue_depth(self):
+        try:
+            return self.frame_queue.qsize() if self.frame_queue is not None else None
+        except NotImplementedError:  # macOS
+            return None
+
+    def snapshot(self):
+        return self.metrics.snapshot(self.queue_depth())
+
+    def handler(self):
+        reporter = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                snapshot = reporter.snapshot()
+                if self.path == '/metrics':
+                    body, content_type = reporter.metrics.prometheus_text(snapshot), 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body, content_type = json.dumps(snapshot), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.end_headers()
+                self.wfile.write(body.encode())
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        return MetricsHandler
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            logger.info(self.metrics.summary_line(self.snapshot()))
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        logger.info(self.metrics.summary_line(self.snapshot()))
+        if self.server:
+            self.server.shutdown()
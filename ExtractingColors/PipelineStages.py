@@ -0,0 +1,453 @@
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+import numpy as np
+from Checkpoints import CheckpointManifest, parse_timestamp
+from ExtractColors import batch_rows, probe_video, scaled_size, stream_frames
+from FilmAggregates import FilmAggregator
+from FilmBarcode import BarcodeRenderer
+from FrameArchive import FrameArchive
+from FrameDiscovery import extract_png_frames
+from FrameRegions import parse_regions, region_names
+from FrameRing import FrameRing, RingBatch
+from FrameSampling import DEFAULT_THRESHOLDS, SAMPLING_MODES, HistogramSampler, RowWeights
+from PaletteEngines import ENGINES, get_engine
+from PipelineMetrics import MetricsReporter, PipelineMetrics, configure_logging
+from ResultSinks import load_palettes, open_sink
+from StageGraph import Stage, StageGraph, StageHandler
+
+logger = logging.getLogger(__name__)
+
+# The extraction and upload pipelines as stages of a StageGraph (see StageGraph.py):
+#   decode   ffmpeg, streaming raw frames into a FrameRing, or writing PNGs when uploading
+#   sample   histogram sampling (--sampling histogram), dropping frames close to the last kept one
+#   archive  thumbnails of every kept frame in a FrameArchive (archive_path), before the palettes
+#   palette  the palette engine, with region palettes; deletes PNG frames once they have a palette
+#   sink     the results file in frame order, film statistics (aggregate) and the checkpoint
+#   render   the film barcode and palette timeline (FilmBarcode.py)
+#   upload   PNG frames to a bucket, many at a time on an event loop
+# Which stages run, and how, is configuration: a stage name adds the stage, and its kind,
+# workers and queue_size override the defaults below, e.g.
+#   {"palette": {"workers": 12}, "render": {}}
+# Each stage takes its input from the first of its INPUTS that runs.
+
+STAGE_DEFAULTS = {
+    'decode': {'kind': 'process', 'workers': 1},
+    'sample': {'kind': 'thread', 'workers': 1},
+    'archive': {'kind': 'thread', 'workers': 1},
+    'palette': {'kind': 'process', 'workers': os.cpu_count() or 1},
+    'sink': {'kind': 'thread', 'workers': 1},
+    'render': {'kind': 'thread', 'workers': 1},
+    'upload': {'kind': 'asyncio', 'workers': 16},
+}
+INPUTS = {'sample': ('decode',), 'archive': ('sample', 'decode'), 'palette': ('archive', 'sample', 'decode'), 'sink': ('palette',),
+          'render': ('sink',), 'upload': ('decode',)}
+# Stages that see every item in frame order
+ORDERED = ('sample', 'archive', 'sink', 'render')
+SETTINGS = ('kind', 'workers', 'queue_size')
+
+def parse_stage_option(option):
+    # 'palette:kind=thread,workers=4' -> ('palette', {'kind': 'thread', 'workers': 4}); 'render' -> ('render', {})
+    name, _, assignments = option.partition(':')
+    settings = {}
+    for assignment in filter(None, assignments.split(',')):
+        key, _, value = assignment.partition('=')
+        key = key.strip().replace('-', '_')
+        settings[key] = value.strip() if key == 'kind' else int(value)
+    return name.strip(), settings
+
+def stage_settings(stages=None, sampling='fps', archive=False):
+    # stages: stage names, or {name: settings}. The decoder always runs; unless the upload stage
+    # is asked for, so do palette and sink. Histogram sampling adds the sample stage, and an
+    # archive path the archive stage.
+    if not isinstance(stages, dict):
+        stages = {name: {} for name in stages or ()}
+    stages = dict(stages)
+    for name in ('decode',) if 'upload' in stages else ('decode', 'palette', 'sink'):
+        stages.setdefault(name, {})
+    if sampling == 'histogram':
+        stages.setdefault('sample', {})
+    elif 'sample' in stages:
+        raise ValueError("The sample stage runs histogram sampling; use sampling='histogram'")
+    if archive:
+        stages.setdefault('archive', {})
+    elif 'archive' in stages:
+        raise ValueError("The archive stage needs an archive_path")
+
+    settings = {}
+    for name in STAGE_DEFAULTS:
+        if name in stages:
+            overrides = {key.replace('-', '_'): value for key, value in (stages[name] or {}).items()}
+            unknown = set(overrides) - set(SETTINGS)
+            if unknown:
+                raise ValueError(f"Unknown settings {sorted(unknown)} for stage '{name}', expected {SETTINGS}")
+            settings[name] = dict(STAGE_DEFAULTS[name], **overrides)
+    unknown = set(stages) - set(STAGE_DEFAULTS)
+    if unknown:
+        raise ValueError(f"Unknown stages {sorted(unknown)}, expected some of {tuple(STAGE_DEFAULTS)}")
+    return settings
+
+def close_ring(ring):
+    # Workers in child processes detach from the ring; the parent unlinks it after the run
+    if ring and multiprocessing.parent_process() is not None:
+        ring.close()
+
+class DecodeStage(StageHandler):
+    # Source: (frame indices, frames) batches, where frames is a RingBatch, or a list of PNG paths
+    # named after pattern when output_dir is given
+    def __init__(self, video_path, fps=3, start_time=None, batch_size=10, first_frame=1, sampling='fps', threshold=None,
+                 scale_width=None, ring=None, output_dir=None, metrics=None, pattern='output_%04d.png'):
+        self.video_path = video_path
+        self.fps = fps
+        self.start_time = start_time
+        self.batch_size = batch_size
+        self.first_frame = first_frame
+        self.sampling = sampling
+        self.threshold = threshold
+        self.scale_width = scale_width
+        self.ring = ring
+        self.output_dir = output_dir
+        self.metrics = metrics
+        self.pattern = pattern
+
+    def items(self):
+        if self.output_dir:
+            batches = extract_png_frames(self.video_path, self.output_dir, self.fps, self.start_time, self.batch_size, self.first_frame, self.pattern)
+        else:
+            batches = stream_frames(self.video_path, self.fps, self.start_time, None, self.batch_size, self.first_frame,
+                                    self.sampling, self.threshold, self.scale_width, allocate=self.ring.acquire if self.ring else None)
+        frame_count = 0
+        started = time.perf_counter()
+        try:
+            for frame_indices, frames in batches:
+                if self.metrics:
+                    self.metrics.observe('decode', time.perf_counter() - started, len(frame_indices))
+                if self.ring and not self.output_dir:
+                    frames = self.ring.handoff(len(frame_indices))
+                yield frame_indices, frames
+                frame_count += len(frame_indices)
+                started = time.perf_counter()
+        finally:
+            batches.close()
+        logger.info(f"Frame decoding completed. Total frames: {frame_count}")
+
+    def close(self):
+        close_ring(self.ring)
+
+class SampleStage(StageHandler):
+    # Keeps the frames of a batch whose color histogram changed (FrameSampling.HistogramSampler),
+    # compacted to the front of their ring slot; a batch with no frame left is dropped
+    def __init__(self, threshold=None, ring=None):
+        self.threshold = DEFAULT_THRESHOLDS['histogram'] if threshold is None else threshold
+        self.ring = ring
+
+    def open(self):
+        self.sampler = HistogramSampler(self.threshold)
+
+    def process(self, item):
+        frame_indices, frames = item
+        batch = self.ring.batch(frames) if isinstance(frames, RingBatch) else frames
+        keep = self.sampler.keep(batch)
+        count = int(keep.sum())
+        if count == 0:
+            if isinstance(frames, RingBatch):
+                self.ring.release(frames.slot)
+            return None
+        batch[:count] = batch[keep]
+        frame_indices = [frame_index for frame_index, kept in zip(frame_indices, keep) if kept]
+        return frame_indices, (RingBatch(frames.slot, count) if isinstance(frames, RingBatch) else batch[:count])
+
+    def close(self):
+        close_ring(self.ring)
+
+class ArchiveStage(StageHandler):
+    # Appends the thumbnails of every batch to the FrameArchive at path (created or resumed by
+    # run_pipeline) and passes the batch on; it runs before the palette stage releases the ring slot
+    def __init__(self, path, ring=None):
+        self.path = path
+        self.ring = ring
+
+    def open(self):
+        self.archive = FrameArchive(self.path, 'r+')
+
+    def process(self, item):
+        frame_indices, frames = item
+        self.archive.append(self.ring.batch(frames) if isinstance(frames, RingBatch) else frames, frame_indices)
+        self.archive.flush()
+        return item
+
+    def close(self):
+        self.archive.close()
+        close_ring(self.ring)
+
+class PaletteStage(StageHandler):
+    # (frame indices, frames) -> result rows (frame_index, frame_name, colors[, regions])
+    def __init__(self, num_colors=10, engine='colorthief', quality=10, cache_file=None, regions=(), ring=None, metrics=None):
+        self.num_colors = num_colors
+        self.engine = engine
+        self.quality = quality
+        self.cache_file = cache_file
+        self.regions = regions
+        self.ring = ring
+        self.metrics = metrics
+
+    def open(self):
+        self.palette_engine = get_engine(self.engine, self.num_colors, self.quality, self.cache_file)
+
+    def process(self, item):
+        frame_indices, frames = item
+        return batch_rows(self.palette_engine, frame_indices, frames, self.ring, self.metrics, self.regions)
+
+    def close(self):
+        self.palette_engine.close()
+        close_ring(self.ring)
+
+class SinkStage(StageHandler):
+    # Writes the rows in frame order with their weights and passes them on; after every flush of
+    # the sink the aggregator is saved and the checkpoint recorded. A row is written once the next
+    # one shows how many frames it stands for, the last one at close, covering up to last_frame.
+    def __init__(self, results_file, num_colors=10, regions=(), video_path=None, fps=3, origin=None, checkpoint_file=None,
+                 resume=False, aggregate=False, metrics=None, last_frame=None):
+        self.results_file = results_file
+        self.num_colors = num_colors
+        self.regions = regions
+        self.video_path = video_path
+        self.fps = fps
+        self.origin = origin
+        self.checkpoint_file = checkpoint_file
+        self.resume = resume
+        self.aggregate = aggregate
+        self.metrics = metrics
+        self.last_frame = last_frame
+
+    def open(self):
+        self.sink = open_sink(self.results_file, num_colors=self.num_colors, regions=self.regions)
+        self.weights = RowWeights()
+        self.skip_frames = self.sink.frame_indices() if self.resume else set()
+        self.aggregator = FilmAggregator(self.results_file, self.num_colors, self.fps, resume=self.resume) if self.aggregate else None
+        self.manifest = CheckpointManifest(self.checkpoint_file) if self.checkpoint_file else None
+        self.checkpointed_frame = None
+
+    def process(self, rows):
+        started = time.perf_counter()
+        self.write(*self.weights.add(row for row in rows if row[0] not in self.skip_frames))
+        if self.metrics:
+            self.metrics.observe('sink', time.perf_counter() - started, len(rows))
+        if self.sink.last_frame != self.checkpointed_frame:
+            self.checkpoint()
+        return rows
+
+    def write(self, rows, weights):
+        self.sink.write(rows, weights)
+        if self.aggregator:
+            self.aggregator.update(rows, weights)
+
+    def checkpoint(self):
+        self.checkpointed_frame = self.sink.last_frame
+        if self.aggregator:
+            self.aggregator.save()
+        if self.manifest and self.checkpointed_frame is not None:
+            self.manifest.record(self.video_path, self.checkpointed_frame, self.fps, self.origin, self.results_file)
+
+    def close(self):
+        self.write(*self.weights.finish(self.last_frame))
+        self.sink.close()
+        if self.sink.last_frame != self.checkpointed_frame:
+            self.checkpoint()
+        if self.aggregator:
+            self.aggregator.close()
+            logger.info(f"Film color summary written to {self.aggregator.summary_path}, rollups to {self.aggregator.rollups_path}")
+        logger.info(f"All rows written; {self.sink.rows_written} rows written to {self.sink.path}")
+
+class RenderStage(StageHandler):
+    # Draws the rows passed on by the sink. A resumed run first redraws the rows of the earlier
+    # run the renderer had not saved (earlier_rows, read before the sink starts appending).
+    def __init__(self, results_file, num_colors=10, total_frames=None, height=120, resume=False, earlier_rows=()):
+        self.results_file = results_file
+        self.num_colors = num_colors
+        self.total_frames = total_frames
+        self.height = height
+        self.resume = resume
+        self.earlier_rows = earlier_rows
+
+    def open(self):
+        self.renderer = BarcodeRenderer(self.results_file, self.num_colors, self.total_frames, self.height, resume=self.resume)
+        self.renderer.update([row for row in self.earlier_rows if row[0] > self.renderer.written])
+
+    def process(self, rows):
+        self.renderer.update(rows)
+        return rows
+
+    def close(self):
+        self.renderer.close()
+
+class UploadStage(StageHandler):
+    # Uploads each batch of PNG frames as <prefix>/<file name> through FrameUploader's Uploader,
+    # which retries, records the manifest and deletes the local file. In an asyncio stage the
+    # uploads of every batch in flight share the stage's `workers` threads.
+    def __init__(self, store, prefix='frames', manifest_path="upload_manifest.jsonl", credentials_file=None, max_retries=5, delete_local=True):
+        self.store = store
+        self.prefix = prefix
+        self.manifest_path = manifest_path
+        self.credentials_file = credentials_file
+        self.max_retries = max_retries
+        self.delete_local = delete_local
+
+    def open(self):
+        from FrameUploader import Uploader, open_store
+        options = {'credentials_file': self.credentials_file} if self.credentials_file else {}
+        # The uploads run on this stage's workers, so the Uploader's own pool stays idle
+        self.uploader = Uploader(open_store(self.store, **options), self.manifest_path, workers=1, max_retries=self.max_retries,
+                                 delete_local=self.delete_local)
+
+    async def process(self, item):
+        _, frame_paths = item
+        uploads = []
+        for local_path in frame_paths:
+            object_name = f"{self.prefix}/{os.path.basename(local_path)}"
+            if object_name in self.uploader.manifest:
+                self.uploader.skipped += 1
+                self.uploader.remove(local_path)
+            else:
+                uploads.append(asyncio.to_thread(self.uploader.upload_file, local_path, object_name))
+        await asyncio.gather(*uploads)
+        return item
+
+    def close(self):
+        self.uploader.close()
+        if self.uploader.failed:
+            logger.warning(f"{len(self.uploader.failed)} frames could not be uploaded and were left on disk")
+
+def earlier_rows(results_file, num_colors, before_frame):
+    # Rows of an earlier run below before_frame, for the renderer of a resumed run
+    try:
+        frame_indices, palettes = load_palettes(results_file, num_colors)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not read {results_file} to redraw the earlier run: {e}")
+        return []
+    keep = np.asarray(frame_indices) < before_frame
+    return [(int(frame_index), None, palette) for frame_index, palette in zip(np.asarray(frame_indices)[keep], np.asarray(palettes)[keep].tolist())]
+
+def run_pipeline(video_path, results_file="dominant_colors.csv", stages=None, fps=3, start_time=None, batch_size=10, engine='colorthief',
+                 num_colors=10, sampling='fps', threshold=None, cache_file=None, scale_width=None, quality=10, regions=None,
+                 output_dir=None, checkpoint_file="checkpoint.json", resume=False, aggregate=False, render_height=120,
+                 store=None, prefix='frames', manifest_path="upload_manifest.jsonl", credentials_file=None, max_retries=5, keep_frames=False,
+                 metrics_interval=10, metrics_port=None, log_level=logging.INFO, queue_size=None, archive_path=None, archive_width=160,
+                 frame_pattern='output_%04d.png'):
+    # stages: see stage_settings. Frames are PNGs in output_dir (named after frame_pattern) when the
+    # upload stage runs or output_dir is given, and stream through a shared-memory FrameRing otherwise.
+    # queue_size: batches in flight between the decoder and the palette workers, unless the palette
+    #   stage sets its own; the decoder, and with it ffmpeg, waits when they are all taken
+    # archive_path: also keep every sampled frame as an archive_width thumbnail (see FrameArchive.py)
+    # Checked here, before any stage starts
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown palette engine '{engine}', expected one of {sorted(ENGINES)}")
+    if sampling not in SAMPLING_MODES:
+        raise ValueError(f"Unknown sampling mode '{sampling}', expected one of {SAMPLING_MODES}")
+    settings = stage_settings(stages, sampling, archive=bool(archive_path))
+    png = bool(output_dir) or 'upload' in settings
+    if png and 'upload' in settings and 'palette' in settings:
+        raise ValueError("The palette and upload stages can't share PNG frames; run them as two pipelines")
+    if 'upload' in settings and not store:
+        raise ValueError("The upload stage needs a store")
+    if png and sampling != 'fps':
+        raise ValueError("PNG frames are only sampled with sampling='fps'")
+    if png and scale_width:
+        raise ValueError("Decode-time scaling needs streamed frames")
+    if png and archive_path:
+        raise ValueError("The frame archive needs streamed frames")
+    output_dir = output_dir or "frames"
+    regions = parse_regions(regions)
+    if regions and png:
+        raise ValueError("Region palettes need streamed frames")
+    if queue_size and 'palette' in settings:
+        settings['palette'].setdefault('queue_size', queue_size)
+
+    manifest = CheckpointManifest(checkpoint_file)
+    first_frame = 1
+    if resume and 'sink' in settings:
+        # Seek ffmpeg to the frame after the last checkpointed one; the sink skips what it already has
+        start_time, first_frame = manifest.resume_point(video_path, fps, start_time)
+        logger.info(f"Resuming {video_path} at frame {first_frame} ({start_time})")
+    elif 'sink' in settings and manifest.get(video_path):
+        logger.info(f"Checkpoint found for {video_path}; starting over because resume is off")
+    origin = manifest.get(video_path)["start_time"] if resume and manifest.get(video_path) else start_time
+
+    # Frames left on the fps grid, for the ETA and the weight of the last row; unknown if ffmpeg reports no duration
+    source_width, source_height, duration = probe_video(video_path)
+    total_frames = max(0, int((duration - parse_timestamp(start_time)) * fps + 0.5)) if duration else None
+    last_frame = first_frame - 1 + total_frames if total_frames else None
+    metrics = PipelineMetrics(total_frames)
+
+    # Ring slots for every batch that can be between the decoder and the palette workers
+    ring = None
+    if not png:
+        width, height = scaled_size(source_width, source_height, scale_width)
+        between = [settings[name] for name in ('sample', 'archive', 'palette') if name in settings]
+        slots = 1 + sum((stage.get('queue_size') or stage['workers'] + 2) + stage['workers'] for stage in between)
+        ring = FrameRing(slots, batch_size, height, width)
+
+    if archive_path:
+        if resume and os.path.exists(os.path.join(archive_path, 'meta.json')):
+            archive = FrameArchive.resume(archive_path, first_frame)
+        else:
+            # Never larger than the decoded frames: a thumbnail can't hold more detail than they have
+            archive_size = scaled_size(width, height, archive_width)
+            archive = FrameArchive.create(archive_path, archive_size[1], archive_size[0], fps, video_path, parse_timestamp(origin),
+                                          capacity=max(1024, total_frames or 0))
+        logger.info(f"Archiving {archive.width}x{archive.height} thumbnails to {archive_path} ({len(archive)} frames already archived)")
+        archive.close()
+
+    handlers = {
+        'decode': lambda: DecodeStage(video_path, fps, start_time, batch_size, first_frame, 'fps' if sampling == 'histogram' else sampling,
+                                      threshold, scale_width, ring, output_dir if png else None, metrics, frame_pattern),
+        'sample': lambda: SampleStage(threshold, ring),
+        'archive': lambda: ArchiveStage(archive_path, ring),
+        'palette': lambda: PaletteStage(num_colors, engine, quality, cache_file, regions, ring, metrics),
+        'sink': lambda: SinkStage(results_file, num_colors, region_names(regions), video_path, fps, origin, checkpoint_file, resume, aggregate,
+                                  metrics, last_frame),
+        'render': lambda: RenderStage(results_file, num_colors, last_frame, render_height,
+                                      resume, earlier_rows(results_file, num_colors, first_frame) if resume and os.path.exists(results_file) else ()),
+        'upload': lambda: UploadStage(store, prefix, manifest_path, credentials_file, max_retries, not keep_frames),
+    }
+    graph_stages = []
+    for name, stage in settings.items():
+        inputs = [next((candidate for candidate in INPUTS[name] if candidate in settings), None)] if name in INPUTS else []
+        if None in inputs:
+            raise ValueError(f"Stage '{name}' needs one of {INPUTS[name]}")
+        graph_stages.append(Stage(name, handlers[name](), stage['kind'], stage['workers'], stage.get('queue_size'), inputs, name in ORDERED))
+    graph = StageGraph(graph_stages, log_level)
+
+    reporter = MetricsReporter(metrics, graph.queues.get('palette'), metrics_interval, metrics_port).start()
+    try:
+        graph.run()
+    finally:
+        reporter.stop()
+        if ring:
+            ring.close(unlink=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the extraction (or upload) pipeline as a graph of configurable stages.")
+    parser.add_argument('video', help="Video file")
+    parser.add_argument('--results', default='dominant_colors.csv', help="Results file; .csv, .parquet or .npy")
+    parser.add_argument('--stage', action='append', default=[], help="Add or configure a stage, e.g. render or palette:kind=thread,workers=4 (repeatable)")
+    parser.add_argument('--fps', type=float, default=3, help="Frames sampled per second of film")
+    parser.add_argument('--engine', default='colorthief', help="Palette engine: colorthief, numpy or kmeans")
+    parser.add_argument('--sampling', choices=SAMPLING_MODES, default='fps', help="Which frames get a palette")
+    parser.add_argument('--scale-width', type=int, default=None, help="Downscale frames to this width inside ffmpeg")
+    parser.add_argument('--resume', action='store_true', help="Continue from the last checkpoint instead of starting over")
+    parser.add_argument('--store', default=None, help="upload stage: gs://bucket, fake-gcs://host:port/bucket or a directory")
+    parser.add_argument('--verbose', action='store_true', help="Log every batch (debug level)")
+    args = parser.parse_args()
+    log_level = logging.DEBUG if args.verbose else logging.INFO
+    configure_logging(log_level)
+
+    stages = {}
+    for option in args.stage:
+        name, settings = parse_stage_option(option)
+        stages.setdefault(name, {}).update(settings)
+    run_pipeline(args.video, args.results, stages, fps=args.fps, engine=args.engine, sampling=args.sampling, scale_width=args.scale_width,
+                 resume=args.resume, store=args.store, log_level=log_level)
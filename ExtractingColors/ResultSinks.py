@@ -0,0 +1,316 @@
+import csv
+import logging
+import os
+import re
+import numpy as np
+from FrameRegions import EMPTY_REGION_COLOR
+from FrameSampling import frame_weights
+from PaletteEngines import pad_palette
+
+logger = logging.getLogger(__name__)
+
+def color_columns(num_colors):
+    columns = []
+    for i in range(num_colors):
+        columns += [f"color_{i+1}_r", f"color_{i+1}_g", f"color_{i+1}_b"]
+    return columns
+
+def region_columns(region, num_colors):
+    return [f"{region}_{column}" for column in color_columns(num_colors)]
+
+def region_path(path, region):
+    # Where the .npy sink keeps the palettes of one region: howls.npy -> howls_center.npy
+    stem, extension = os.path.splitext(path)
+    return f"{stem}_{region}{extension}"
+
+def weights_path(path):
+    # Where the .npy sink keeps the weights: howls.npy -> howls_weights.npy
+    return os.path.splitext(path)[0] + "_weights.npy"
+
+def frame_index_from_name(frame_name):
+    # 'frame_000042' or '.../output_0042.png' -> 42
+    match = re.search(r'(\d+)(?:\.\w+)?$', frame_name)
+    return int(match.group(1)) if match else None
+
+class ResultSink:
+    # Buffers (frame_index, frame_name, colors) rows and writes them out flush_every rows at a time.
+    # With regions (see FrameRegions.py), rows carry a 4th element, {region: colors}, and every
+    # region gets its own set of color columns. Every row also gets a weight: the number of grid
+    # frames it stands for (see FrameSampling.frame_weights), 1 unless the writer knows better.
+    def __init__(self, path, num_colors=10, flush_every=500, regions=()):
+        self.path = path
+        self.num_colors = num_colors
+        self.flush_every = flush_every
+        self.regions = list(regions)
+        self.buffer = []
+        self.weights = []
+        self.rows_written = 0
+        self.last_frame = None  # Last grid frame the flushed rows stand for: the last one's index plus its weight - 1
+
+    def write(self, rows, weights=None):
+        self.buffer.extend(rows)
+        self.weights.extend([1] * len(rows) if weights is None else weights)
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        rows, self.buffer = self.buffer, []
+        weights, self.weights = self.weights, []
+        self.write_rows(rows, weights)
+        self.rows_written += len(rows)
+        self.last_frame = rows[-1][0] + weights[-1] - 1
+        logger.debug(f"Flushed {len(rows)} rows to {self.path} ({self.rows_written} this run)")
+
+    def write_rows(self, rows, weights):
+        raise NotImplementedError
+
+    def frame_indices(self):
+        # Frame indices already stored by this or an earlier run
+        raise NotImplementedError
+
+    def palette_array(self, rows, region=None):
+        # (n, num_colors, 3) uint8; short palettes repeat their last color (ColorThief often returns one fewer)
+        # and channels are clipped to 255 (its median cut can round up to 256)
+        if region is None:
+            palettes = [row[2] for row in rows]
+        else:
+            palettes = [row[3].get(region) or [EMPTY_REGION_COLOR] for row in rows]
+        palettes = np.array([pad_palette(list(colors), self.num_colors)[:self.num_colors] for colors in palettes], dtype=np.int64)
+        return np.clip(palettes, 0, 255).astype(np.uint8)
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class CsvSink(ResultSink):
+    # Same layout as the original dominant_colors.csv: frame_path, color_1_r, ..., color_N_b,
+    # followed by <region>_color_1_r, ... for each region, and the weight. A file written before
+    # there was a weight column is continued without one.
+    def __init__(self, path, num_colors=10, flush_every=500, regions=()):
+        super().__init__(path, num_colors, flush_every, regions)
+        extra_columns = [column for region in self.regions for column in region_columns(region, num_colors)]
+        self.weighted = True
+        if not os.path.exists(path):
+            with open(path, "w", newline="") as csvfile:
+                csv.writer(csvfile).writerow(["frame_path"] + color_columns(num_colors) + extra_columns + ["weight"])
+        else:
+            with open(path, newline="") as csvfile:
+                header = next(csv.reader(csvfile), [])
+            self.weighted = "weight" in header
+            if [column for column in header[1:] if not column.startswith("color_") and column != "weight"] != extra_columns:
+                raise ValueError(f"{path} was written with other regions than {self.regions or 'none'}")
+
+    def frame_indices(self):
+        with open(self.path, newline="") as csvfile:
+            reader = csv.reader(csvfile)
+            next(reader, None)
+            return set(frame_index_from_name(row[0]) for row in reader if row)
+
+    def write_rows(self, rows, weights):
+        with open(self.path, "a", newline="") as csvfile:
+            writer = csv.writer(csvfile)
+            if self.regions or self.weighted:
+                # Padded palettes, so every region's columns and the weight line up with the header
+                palettes = [self.palette_array(rows)] + [self.palette_array(rows, region) for region in self.regions]
+                values = np.concatenate([palette.reshape(len(rows), -1) for palette in palettes], axis=1)
+                for row, row_values, weight in zip(rows, values.tolist(), weights):
+                    writer.writerow([row[1]] + row_values + ([weight] if self.weighted else []))
+                return
+            for row in rows:
+                csv_row = [row[1]]
+                for r, g, b in row[2]:
+                    csv_row += [r, g, b]
+                writer.writerow(csv_row)
+
+class ParquetSink(ResultSink):
+    # A Parquet dataset directory: every flush writes one complete part file, so a crash
+    # never loses more than the current buffer. pandas.read_parquet(path) reads the whole film.
+    def __init__(self, path, num_colors=10, flush_every=5000, regions=()):
+        super().__init__(path, num_colors, flush_every, regions)
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("The Parquet result sink requires pyarrow (pip install pyarrow)")
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        os.makedirs(path, exist_ok=True)
+        self.part_number = len([f for f in os.listdir(path) if f.endswith('.parquet')])
+
+    def frame_indices(self):
+        if self.part_number == 0:
+            return set()
+        return set(self.pq.read_table(self.path, columns=["frame_index"]).column("frame_index").to_pylist())
+
+    def write_rows(self, rows, weights):
+        columns = {
+            "frame_index": self.pa.array([row[0] for row in rows], type=self.pa.int64()),
+            "frame_path": self.pa.array([row[1] for row in rows], type=self.pa.string()),
+            "weight": self.pa.array(weights, type=self.pa.int64()),
+        }
+        for region in [None] + self.regions:
+            palettes = self.palette_array(rows, region).reshape(len(rows), -1)
+            names = color_columns(self.num_colors) if region is None else region_columns(region, self.num_colors)
+            for column_number, column in enumerate(names):
+                columns[column] = self.pa.array(palettes[:, column_number], type=self.pa.uint8())
+
+        # Dot-prefixed files are ignored by Parquet readers, so a crash mid-write leaves the dataset readable
+        part_name = f"part-{self.part_number:05d}.parquet"
+        temporary_path = os.path.join(self.path, f".{part_name}.tmp")
+        self.pq.write_table(self.pa.table(columns), temporary_path)
+        os.replace(temporary_path, os.path.join(self.path, part_name))
+        self.part_number += 1
+
+class NpySink(ResultSink):
+    # Compact columnar output: <name>.npy holds a (frames, num_colors, 3) uint8 array,
+    # <name>_frames.npy the matching int64 frame indices and <name>_weights.npy their weights;
+    # each region adds <name>_<region>.npy. While running, rows are appended to raw .part files;
+    # close() turns them into the .npy files, which np.load(mmap_mode='r') maps.
+    def __init__(self, path, num_colors=10, flush_every=500, regions=()):
+        super().__init__(path, num_colors, flush_every, regions)
+        self.index_path = os.path.splitext(path)[0] + "_frames.npy"
+        self.index_part = self.index_path + ".part"
+        self.weights_path = weights_path(path)
+        self.weights_part = self.weights_path + ".part"
+        self.palette_paths = [path] + [region_path(path, region) for region in self.regions]
+        self.row_bytes = num_colors * 3
+
+        if not os.path.exists(self.index_part):
+            # Start from the results of an earlier run, if there are any
+            with open(self.index_part, "wb") as index_file, open(self.weights_part, "wb") as weights_file:
+                if os.path.exists(path):
+                    frame_indices = np.load(self.index_path).astype(np.int64)
+                    index_file.write(frame_indices.tobytes())
+                    # Results from before the weights were kept count each frame once
+                    weights = np.load(self.weights_path) if os.path.exists(self.weights_path) else np.ones(len(frame_indices))
+                    weights_file.write(weights.astype(np.int64).tobytes())
+            for palette_path in self.palette_paths:
+                if os.path.exists(path) and not os.path.exists(palette_path):
+                    raise ValueError(f"{path} was written without the palettes in {palette_path}")
+                with open(palette_path + ".part", "wb") as palette_file:
+                    if os.path.exists(path):
+                        palette_file.write(np.load(palette_path).astype(np.uint8).tobytes())
+        else:
+            # Left behind by a crash: drop any partially written trailing row
+            rows = min([os.path.getsize(palette_path + ".part") // self.row_bytes for palette_path in self.palette_paths]
+                       + [os.path.getsize(self.index_part) // 8, os.path.getsize(self.weights_part) // 8])
+            for palette_path in self.palette_paths:
+                with open(palette_path + ".part", "r+b") as palette_file:
+                    palette_file.truncate(rows * self.row_bytes)
+            for part in (self.index_part, self.weights_part):
+                with open(part, "r+b") as part_file:
+                    part_file.truncate(rows * 8)
+
+    def frame_indices(self):
+        return set(np.fromfile(self.index_part, dtype=np.int64).tolist())
+
+    def write_rows(self, rows, weights):
+        for region, palette_path in zip([None] + self.regions, self.palette_paths):
+            with open(palette_path + ".part", "ab") as palette_file:
+                palette_file.write(self.palette_array(rows, region).tobytes())
+        with open(self.weights_part, "ab") as weights_file:
+            weights_file.write(np.array(weights, dtype=np.int64).tobytes())
+        with open(self.index_part, "ab") as index_file:
+            index_file.write(np.array([row[0] for row in rows], dtype=np.int64).tobytes())
+
+    def close(self):
+        self.flush()
+        rows = os.path.getsize(self.index_part) // 8
+        for palette_path in self.palette_paths:
+            palettes = np.lib.format.open_memmap(palette_path + ".tmp", mode="w+", dtype=np.uint8, shape=(rows, self.num_colors, 3))
+            palettes[:] = np.fromfile(palette_path + ".part", dtype=np.uint8).reshape(rows, self.num_colors, 3)
+            palettes.flush()
+            del palettes
+        np.save(self.index_path + ".tmp.npy", np.fromfile(self.index_part, dtype=np.int64))
+        np.save(self.weights_path + ".tmp.npy", np.fromfile(self.weights_part, dtype=np.int64))
+        for palette_path in self.palette_paths:
+            os.replace(palette_path + ".tmp", palette_path)
+            os.remove(palette_path + ".part")
+        os.replace(self.weights_path + ".tmp.npy", self.weights_path)
+        os.remove(self.weights_part)
+        os.replace(self.index_path + ".tmp.npy", self.index_path)
+        os.remove(self.index_part)
+
+SINKS = {'.csv': CsvSink, '.parquet': ParquetSink, '.npy': NpySink}
+
+def open_sink(path, num_colors=10, flush_every=None, regions=()):
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in SINKS:
+        raise ValueError(f"Unknown result format '{extension}', expected one of {sorted(SINKS)}")
+    if flush_every is None:
+        return SINKS[extension](path, num_colors, regions=regions)
+    return SINKS[extension](path, num_colors, flush_every, regions)
+
+def load_palettes(path, num_colors=10, color_space='rgb', region=None):
+    # Returns (frame_indices, palettes) with palettes as a (frames, num_colors, 3) uint8 array, or
+    # as float arrays in 'hsv' or 'lab' (see ColorSpaces) for analysis in a perceptual space.
+    # region picks the palettes of one region instead of the whole frame.
+    frame_indices, palettes = read_palettes(path, num_colors, region)
+    if color_space != 'rgb':
+        from ColorSpaces import convert
+        palettes = convert(palettes, 'rgb', color_space)
+    return frame_indices, palettes
+
+def load_weights(path):
+    # The weight of every row of a results file, in the order of load_palettes. Files written
+    # before the weights were kept get them from the gaps between their frame indices.
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.npy':
+        if os.path.exists(weights_path(path)):
+            return np.load(weights_path(path))
+        frame_indices = np.load(os.path.splitext(path)[0] + "_frames.npy")
+    elif extension == '.parquet':
+        import pyarrow.parquet as pq
+        if "weight" in pq.read_schema(next(os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith('.parquet'))).names:
+            return pq.read_table(path, columns=["weight"]).column("weight").to_numpy()
+        frame_indices = pq.read_table(path, columns=["frame_index"]).column("frame_index").to_numpy()
+    elif extension == '.csv':
+        with open(path, newline="") as csvfile:
+            reader = csv.reader(csvfile)
+            header = next(reader)
+            rows = list(reader)
+        if "weight" in header:
+            column = header.index("weight")
+            return np.array([int(row[column]) for row in rows], dtype=np.int64)
+        frame_indices = [frame_index_from_name(row[0]) for row in rows]
+    else:
+        raise ValueError(f"Unknown result format '{extension}', expected one of {sorted(SINKS)}")
+    return frame_weights(frame_indices)
+
+def read_palettes(path, num_colors=10, region=None):
+    extension = os.path.splitext(path)[1].lower()
+    columns = color_columns(num_colors) if region is None else region_columns(region, num_colors)
+    if extension == '.npy':
+        index_path = os.path.splitext(path)[0] + "_frames.npy"
+        return np.load(index_path), np.load(path if region is None else region_path(path, region), mmap_mode='r')
+    if extension == '.parquet':
+        import pyarrow.parquet as pq
+        table = pq.read_table(path, columns=["frame_index"] + columns)
+        palettes = np.stack([table.column(column).to_numpy() for column in columns], axis=1)
+        return table.column("frame_index").to_numpy(), palettes.astype(np.uint8).reshape(-1, num_colors, 3)
+    if extension == '.csv':
+        frame_indices, palettes = [], []
+        with open(path, newline="") as csvfile:
+            reader = csv.reader(csvfile)
+            header = next(reader)
+            if region is not None and columns[0] not in header:
+                raise ValueError(f"{path} has no palettes for region '{region}'")
+            # Region columns follow the num_colors frame columns; a results file without regions
+            # may hold shorter rows (raw ColorThief output), so it is read triple by triple
+            first = 1 if region is None else header.index(columns[0])
+            last = first + 3 * num_colors if len(header) > 1 + 3 * num_colors else None
+            for row in reader:
+                end = len(row) if last is None else last
+                colors = [tuple(int(value) for value in row[i:i + 3]) for i in range(first, end - 2, 3)]
+                frame_indices.append(frame_index_from_name(row[0]))
+                palettes.append(pad_palette(colors, num_colors)[:num_colors])
+        # Older CSVs hold raw ColorThief output, which can round a channel up to 256
+        return np.array(frame_indices, dtype=np.int64), np.clip(np.array(palettes, dtype=np.int64), 0, 255).astype(np.uint8).reshape(-1, num_colors, 3)
+    raise ValueError(f"Unknown result format '{extension}', expected one of {sorted(SINKS)}")
@@ -0,0 +1,78 @@
+import argparse
+import json
+import time
+import numpy as np
+from ExtractColors import stream_frames
+from PaletteEngines import get_engine, palette_distance
+
+# Measures what decode-time downscaling (--scale-width) and pixel stride (--quality) cost in
+# palette accuracy: every setting is compared, frame by frame, with palettes computed from the
+# full-resolution frames at the reference quality.
+
+def decode(video_path, fps, start_time, duration, scale_width):
+    started = time.perf_counter()
+    frame_indices, batches = [], []
+    for indices, frames in stream_frames(video_path, fps, start_time, duration, batch_size=50, scale_width=scale_width):
+        frame_indices += indices
+        batches.append(frames)
+    frames = np.concatenate(batches) if batches else np.empty((0, 0, 0, 3), dtype=np.uint8)
+    return frame_indices, frames, time.perf_counter() - started
+
+def run_benchmark(video_path, widths, qualities, engine='colorthief', num_colors=10, fps=1, start_time=None, duration=60, reference_quality=10):
+    reference_indices, reference_frames, reference_decode = decode(video_path, fps, start_time, duration, None)
+    started = time.perf_counter()
+    reference = get_engine(engine, num_colors, reference_quality).palettes(reference_frames)
+    reference_palette_seconds = time.perf_counter() - started
+    reference_seconds = (reference_decode + reference_palette_seconds) / max(1, len(reference_frames))
+    reference_palettes = dict(zip(reference_indices, reference))
+    print(f"Reference: {len(reference_frames)} frames of {reference_frames.shape[2]}x{reference_frames.shape[1]}, quality {reference_quality}, {1000 * reference_seconds:.1f} ms/frame")
+
+    results = []
+    for width in widths:
+        frame_indices, frames, decode_seconds = decode(video_path, fps, start_time, duration, width)
+        for quality in qualities:
+            started = time.perf_counter()
+            palettes = get_engine(engine, num_colors, quality).palettes(frames)
+            palette_seconds = time.perf_counter() - started
+
+            distances = [palette_distance(reference_palettes[i], palette) for i, palette in zip(frame_indices, palettes) if i in reference_palettes]
+            count = max(1, len(frames))
+            result = {
+                'width': int(frames.shape[2]) if len(frames) else width,
+                'height': int(frames.shape[1]) if len(frames) else None,
+                'quality': quality,
+                'frames': len(frames),
+                'bytes_per_frame': int(frames[0].nbytes) if len(frames) else 0,
+                'decode_ms_per_frame': 1000 * decode_seconds / count,
+                'palette_ms_per_frame': 1000 * palette_seconds / count,
+                'speedup': reference_seconds / ((decode_seconds + palette_seconds) / count),
+                'mean_rgb_distance': float(np.nanmean(distances)) if distances else None,
+            }
+            results.append(result)
+            # A width that decoded no frames has no size (full resolution not even a width) and nothing to compare
+            width = result['width'] if result['width'] is not None else 'full'
+            height = result['height'] if result['height'] is not None else '?'
+            distance = f"{result['mean_rgb_distance']:.2f}" if result['mean_rgb_distance'] is not None else 'n/a'
+            print(f"{width:>5}x{height:<5} quality {quality:>2}: "
+                  f"decode {result['decode_ms_per_frame']:7.2f} ms, palette {result['palette_ms_per_frame']:8.2f} ms, "
+                  f"{result['speedup']:6.1f}x faster, mean RGB distance to reference {distance}")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare palette accuracy and speed of downscaled decoding against the full-resolution reference.")
+    parser.add_argument('video_path')
+    parser.add_argument('--widths', type=int, nargs='+', default=[0, 640, 320, 160, 80], help="Decode widths to test; 0 means full resolution")
+    parser.add_argument('--qualities', type=int, nargs='+', default=[1, 5, 10], help="Pixel strides to test")
+    parser.add_argument('--engine', default='colorthief', help="Palette engine: colorthief, numpy or kmeans")
+    parser.add_argument('--fps', type=float, default=1, help="Frames sampled per second of film")
+    parser.add_argument('--start-time', default=None, help="Where to start sampling, e.g. 00:10:00")
+    parser.add_argument('--duration', type=float, default=60, help="Seconds of film to sample")
+    parser.add_argument('--reference-quality', type=int, default=10, help="Pixel stride of the full-resolution reference")
+    parser.add_argument('--json', default=None, help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.video_path, [width or None for width in args.widths], args.qualities, engine=args.engine,
+                            fps=args.fps, start_time=args.start_time, duration=args.duration, reference_quality=args.reference_quality)
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(results, json_file, indent=2)
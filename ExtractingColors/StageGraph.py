@@ -0,0 +1,316 @@
+import asyncio
+import copy
+import inspect
+import logging
+import multiprocessing
+import pickle
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from PipelineMetrics import configure_logging
+
+logger = logging.getLogger(__name__)
+
+# A pipeline declared as a graph of stages instead of hand-wired Process pairs. Every stage has
+#   kind        how its workers run: 'thread', 'process', or 'asyncio' (one event loop thread
+#               running `workers` tasks, for I/O-bound stages such as uploads)
+#   workers     how many items it works on at once
+#   queue_size  the bound of its input queue; a full queue blocks the stages feeding it, which
+#               is what holds back the decoder (and ffmpeg) when a later stage falls behind
+#   inputs      the stages whose output it takes; a stage without inputs is a source
+#   ordered     items are handled in the order the source produced them (one worker only)
+# Items travel as (sequence, item), numbered by the source. A stage that drops an item still
+# passes (sequence, None) on, so an ordered stage further down never waits on a gap.
+# Shutdown runs in graph order: once every worker of a stage has finished, the stages it feeds
+# get one None sentinel per receiver. An exception in any worker stops every stage, and run()
+# raises PipelineError from it.
+
+KINDS = ('thread', 'process', 'asyncio')
+
+class PipelineError(Exception):
+    pass
+
+class Stopped(Exception):
+    # Raised inside a worker when another stage failed; not an error of its own
+    pass
+
+class StageHandler:
+    # What a stage runs. Each thread or process worker gets its own copy (pickled into the
+    # process, copied for the thread) and calls open() before its first item and close() after
+    # its last; the tasks of an asyncio stage share one. A source implements items(), a generator
+    # of output items; every other stage implements process(item), which returns the output
+    # item or None to drop it, and may be an async def.
+    def open(self):
+        pass
+
+    def items(self):
+        raise NotImplementedError
+
+    def process(self, item):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class Stage:
+    def __init__(self, name, handler, kind='thread', workers=1, queue_size=None, inputs=(), ordered=False):
+        if kind not in KINDS:
+            raise ValueError(f"Unknown kind '{kind}' for stage '{name}', expected one of {KINDS}")
+        if workers < 1:
+            raise ValueError(f"Stage '{name}' needs at least one worker")
+        if (ordered or not inputs) and workers != 1:
+            raise ValueError(f"Stage '{name}' is {'ordered' if inputs else 'a source'} and runs with one worker only")
+        self.name = name
+        self.handler = handler
+        self.kind = kind
+        self.workers = workers
+        self.queue_size = queue_size or workers + 2
+        self.inputs = [inputs] if isinstance(inputs, str) else list(inputs)
+        self.ordered = ordered
+
+    def receivers(self):
+        # Sentinels a finished input has to send: one per worker, or one for the event loop
+        return 1 if self.kind == 'asyncio' else self.workers
+
+def get(inbox, stop):
+    while True:
+        try:
+            return inbox.get(timeout=0.1)
+        except queue.Empty:
+            if stop.is_set():
+                raise Stopped()
+
+def put(outbox, message, stop):
+    while True:
+        try:
+            outbox.put(message, timeout=0.1)
+            return
+        except queue.Full:
+            if stop.is_set():
+                raise Stopped()
+
+def receive(name, inbox, stop, ordered):
+    # Generator over the (sequence, item) messages of a stage, in sequence order if ordered
+    pending = {}
+    next_sequence = 0
+    while True:
+        message = get(inbox, stop)
+        if message is None:
+            break
+        if not ordered:
+            yield message
+            continue
+        pending[message[0]] = message[1]
+        while next_sequence in pending:
+            yield next_sequence, pending.pop(next_sequence)
+            next_sequence += 1
+    if pending:
+        logger.error(f"Stage '{name}' is missing item {next_sequence}; {len(pending)} later items were not handled")
+
+def call(handler, item):
+    # An async process() outside an asyncio stage gets an event loop per item
+    if inspect.iscoroutinefunction(handler.process):
+        return asyncio.run(handler.process(item))
+    return handler.process(item)
+
+def report(errors, name, error):
+    # The exception itself if it survives pickling (it may come from a process), else its text
+    try:
+        pickle.dumps(error)
+    except Exception:
+        error = None
+    errors.put((name, error, traceback.format_exc()))
+
+def run_worker(name, handler, inbox, outboxes, stop, errors, ordered=False, log_level=None):
+    # One thread or process worker of a stage; inbox is None for a source
+    if log_level is not None:
+        configure_logging(log_level)
+    items = None
+    try:
+        handler.open()
+        if inbox is None:
+            items = handler.items()
+            for sequence, item in enumerate(items):
+                for outbox in outboxes:
+                    put(outbox, (sequence, item), stop)
+                if stop.is_set():
+                    raise Stopped()
+        else:
+            for sequence, item in receive(name, inbox, stop, ordered):
+                if item is not None:
+                    item = call(handler, item)
+                for outbox in outboxes:
+                    put(outbox, (sequence, item), stop)
+        handler.close()
+    except Stopped:
+        # Nobody reads the rest of the queues, so don't wait to flush them on exit
+        for outbox in outboxes:
+            if hasattr(outbox, 'cancel_join_thread'):
+                outbox.cancel_join_thread()
+    except BaseException as e:
+        report(errors, name, e)
+        stop.set()
+    finally:
+        if items is not None:
+            items.close()  # A source generator stops its decoder in its finally block
+
+def run_async_stage(name, handler, inbox, outboxes, stop, errors, ordered=False, workers=1):
+    try:
+        asyncio.run(serve(name, handler, inbox, outboxes, stop, ordered, workers))
+    except Stopped:
+        pass
+    except BaseException as e:
+        report(errors, name, e)
+        stop.set()
+
+async def serve(name, handler, inbox, outboxes, stop, ordered, workers):
+    # One reader thread feeds `workers` tasks through an asyncio queue. Synchronous process()
+    # calls run on a pool of `workers` threads, which asyncio.to_thread also uses, so an async
+    # handler's blocking calls are bounded by the stage's worker count as well.
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(workers, thread_name_prefix=name))
+    reader = ThreadPoolExecutor(1, thread_name_prefix=f"{name}-reader")
+    writer = ThreadPoolExecutor(1, thread_name_prefix=f"{name}-writer")
+    tasks = asyncio.Queue(maxsize=workers)
+    is_async = inspect.iscoroutinefunction(handler.process)
+
+    async def read():
+        messages = receive(name, inbox, stop, ordered)
+        while True:
+            message = await loop.run_in_executor(reader, next, messages, None)
+            if message is None:
+                break
+            await tasks.put(message)
+        for _ in range(workers):
+            await tasks.put(None)
+
+    async def work():
+        while True:
+            message = await tasks.get()
+            if message is None:
+                break
+            sequence, item = message
+            if item is not None:
+                item = await handler.process(item) if is_async else await loop.run_in_executor(None, handler.process, item)
+            for outbox in outboxes:
+                await loop.run_in_executor(writer, put, outbox, (sequence, item), stop)
+
+    handler.open()
+    try:
+        await asyncio.gather(read(), *(work() for _ in range(workers)))
+    finally:
+        reader.shutdown(wait=False)
+        writer.shutdown(wait=False)
+    handler.close()
+
+class StageGraph:
+    # Stages are given in graph order: every stage after the stages it takes input from
+    def __init__(self, stages, log_level=logging.INFO):
+        self.stages = {}
+        for stage in stages:
+            if stage.name in self.stages:
+                raise ValueError(f"Two stages are named '{stage.name}'")
+            for input_name in stage.inputs:
+                if input_name not in self.stages:
+                    raise ValueError(f"Stage '{stage.name}' takes input from '{input_name}', which is not an earlier stage")
+            if stage.ordered and len(stage.inputs) != 1:
+                raise ValueError(f"Ordered stage '{stage.name}' needs exactly one input")
+            self.stages[stage.name] = stage
+        self.log_level = log_level
+        self.outputs = {name: [stage.name for stage in stages if name in stage.inputs] for name in self.stages}
+
+        # Process-shared queues only where a process is on either end
+        self.stop = multiprocessing.Event()
+        self.errors = multiprocessing.Queue()
+        self.queues = {}
+        for stage in stages:
+            if stage.inputs:
+                shared = stage.kind == 'process' or any(self.stages[name].kind == 'process' for name in stage.inputs)
+                self.queues[stage.name] = multiprocessing.Queue(stage.queue_size) if shared else queue.Queue(stage.queue_size)
+        self.workers = {}
+        self.finished = set()
+
+    def start(self):
+        # Consumers first, so every queue has a reader before anything is put into it
+        for stage in reversed(list(self.stages.values())):
+            inbox = self.queues.get(stage.name)
+            outboxes = [self.queues[name] for name in self.outputs[stage.name]]
+            if stage.kind == 'asyncio':
+                workers = [threading.Thread(target=run_async_stage, name=stage.name, daemon=True,
+                                            args=(stage.name, stage.handler, inbox, outboxes, self.stop, self.errors, stage.ordered, stage.workers))]
+            elif stage.kind == 'thread':
+                workers = [threading.Thread(target=run_worker, name=f"{stage.name}-{i + 1}", daemon=True,
+                                            args=(stage.name, copy.copy(stage.handler), inbox, outboxes, self.stop, self.errors, stage.ordered))
+                           for i in range(stage.workers)]
+            else:
+                workers = [multiprocessing.Process(target=run_worker, name=f"{stage.name}-{i + 1}",
+                                                   args=(stage.name, stage.handler, inbox, outboxes, self.stop, self.errors, stage.ordered, self.log_level))
+                           for i in range(stage.workers)]
+            for worker in workers:
+                worker.start()
+            self.workers[stage.name] = workers
+        logger.info("Started stages " + ", ".join(f"{stage.name} ({stage.workers} {stage.kind})" for stage in self.stages.values()))
+
+    def check(self):
+        try:
+            name, error, details = self.errors.get_nowait()
+        except queue.Empty:
+            pass
+        else:
+            raise PipelineError(f"Stage '{name}' failed:\n{details}") from error
+        # A process worker of any stage that died without reporting (killed, out of memory,
+        # os._exit) would leave the stages around it waiting forever
+        for name, workers in self.workers.items():
+            for worker in workers:
+                if getattr(worker, 'exitcode', None):
+                    raise PipelineError(f"Stage '{name}' worker {worker.name} exited with code {worker.exitcode}")
+
+    def wait(self, name):
+        # Joins every worker of a stage, raising as soon as any stage reports an error or loses a process
+        for worker in self.workers[name]:
+            while worker.is_alive():
+                self.check()
+                worker.join(0.1)
+        self.check()
+
+    def finish(self, name):
+        # Sentinels for every stage fed by name whose inputs have now all finished
+        self.finished.add(name)
+        for output in self.outputs[name]:
+            stage = self.stages[output]
+            if all(input_name in self.finished for input_name in stage.inputs):
+                for _ in range(stage.receivers()):
+                    while True:
+                        try:
+                            self.queues[output].put(None, timeout=0.1)
+                            break
+                        except queue.Full:
+                            self.check()
+
+    def run(self):
+        self.start()
+        try:
+            for name in self.stages:
+                self.wait(name)
+                self.finish(name)
+                logger.debug(f"Stage '{name}' finished")
+        except BaseException:
+            self.abort()
+            raise
+
+    def abort(self, grace=5.0):
+        # Stops every stage: workers leave their loops at the next queue operation; processes
+        # that are still stuck (e.g. in ffmpeg's pipe) after the grace period are terminated
+        self.stop.set()
+        deadline = time.monotonic() + grace
+        for workers in self.workers.values():
+            for worker in workers:
+                worker.join(max(0.0, deadline - time.monotonic()))
+        for workers in self.workers.values():
+            for worker in workers:
+                if worker.is_alive() and hasattr(worker, 'terminate'):
+                    worker.terminate()
+                    worker.join()
+        logger.error("Pipeline stopped")
@@ -0,0 +1,71 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+from FrameUploader import LocalStore, Uploader, open_store
+from PipelineMetrics import configure_logging
+
+# Upload throughput of the Uploader for several pool sizes and pack sizes, offline: frames go to
+# a LocalStore that adds a fixed latency per request and fails a share of them at random, or to
+# any store URL given with --store (e.g. fake-gcs://localhost:4443/frames for a fake-gcs-server).
+
+def make_frames(directory, count, frame_bytes, seed=0):
+    # Random bytes, so the files neither compress nor deduplicate
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f"output_{i + 1:06d}.png")
+        with open(path, 'wb') as frame_file:
+            frame_file.write(rng.integers(0, 256, frame_bytes, dtype=np.uint8).tobytes())
+        paths.append(path)
+    return paths
+
+def run_case(directory, store_url, frames, frame_bytes, workers, pack_size, latency, failure_rate):
+    case_dir = os.path.join(directory, f"case_{workers}_{pack_size}")
+    paths = make_frames(os.path.join(case_dir, 'frames'), frames, frame_bytes)
+    if store_url:
+        store = open_store(store_url)
+    else:
+        store = LocalStore(os.path.join(case_dir, 'bucket'), latency=latency, failure_rate=failure_rate, seed=0)
+
+    started = time.perf_counter()
+    uploader = Uploader(store, os.path.join(case_dir, 'manifest.jsonl'), workers=workers, pack_size=pack_size, backoff=0.05)
+    uploader.upload_batch((path, f"benchmark/frames/{os.path.basename(path)}") for path in paths)
+    uploader.close()
+    seconds = time.perf_counter() - started
+    result = {
+        'workers': workers, 'pack_size': pack_size, 'frames': uploader.uploaded, 'failed': len(uploader.failed),
+        'seconds': seconds, 'frames_per_second': uploader.uploaded / seconds, 'megabytes_per_second': uploader.uploaded * frame_bytes / 1e6 / seconds,
+        'latency': None if store_url else latency, 'failure_rate': None if store_url else failure_rate,
+    }
+    shutil.rmtree(case_dir)
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark frame upload throughput against a local stand-in store.")
+    parser.add_argument('--store', default=None, help="Store URL to upload to instead of the simulated local store")
+    parser.add_argument('--frames', type=int, default=500, help="Number of frames per case")
+    parser.add_argument('--frame-kb', type=int, default=200, help="Size of each frame file in KB")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 8, 32], help="Upload pool sizes to test")
+    parser.add_argument('--pack-sizes', type=int, nargs='+', default=[1, 25], help="Frames per uploaded object to test")
+    parser.add_argument('--latency', type=float, default=0.05, help="Simulated seconds per request")
+    parser.add_argument('--failure-rate', type=float, default=0.02, help="Simulated share of failing requests")
+    parser.add_argument('--json', default=None, help="Also write the results to this JSON file")
+    args = parser.parse_args()
+    configure_logging(logging.WARNING)
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for workers in args.workers:
+            for pack_size in args.pack_sizes:
+                result = run_case(directory, args.store, args.frames, args.frame_kb * 1024, workers, pack_size, args.latency, args.failure_rate)
+                results.append(result)
+                print(json.dumps(result))
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(results, json_file, indent=2)